@@ -0,0 +1,22 @@
+import os
+import threading
+
+
+def replace_file(path: str, write, opener=None):
+    '''
+    Write a file by calling `write(f)` on a temp file next to `path`, then
+    swapping it in, so readers never see a partial file and a crash can't
+    truncate it. The temp name is unique per process and thread, so
+    concurrent writers don't clobber each other's temp files.
+    '''
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w', opener=opener) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
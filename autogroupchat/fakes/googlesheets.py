@@ -0,0 +1,203 @@
+'''
+In-process stand-in for the Google Sheets/Drive endpoints used by the
+Google Sheets scraper, for benchmarks and offline runs.
+
+    fake = FakeGoogleSheets(latency=0.1)
+    fake.add_spreadsheet("Roster", {"Sheet1": values})
+    asg = AutoScrapeGoogleSheets("Roster", "Sheet1", "", "configs/config_googleapi.json",
+                                 gspread_client=fake.client())
+'''
+import re
+import json
+import time
+import random
+import threading
+from collections import Counter
+from urllib.parse import urlparse, parse_qs, unquote
+
+from requests import Response, Session
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+DRIVE_URL = "https://www.googleapis.com/drive/v3/files"
+SHEETS_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+
+
+def make_response(request, status_code: int, data=None):
+    response = Response()
+    response.status_code = status_code
+    response.request = request
+    response.url = request.url
+    response.headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+    if status_code >= 400:
+        data = {"error": {"code": status_code, "message": f"fake error {status_code}", "status": "ERROR"}}
+    response._content = json.dumps(data if data is not None else {}).encode("utf-8")
+    response.encoding = "utf-8"
+    return response
+
+
+def column_number(letters: str):
+    number = 0
+    for c in letters.upper():
+        number = number * 26 + ord(c) - ord("A") + 1
+    return number
+
+
+def slice_a1(values: list, a1: str):
+    '''
+    Cut an A1 range like "A1:C10", "B:B" or "A2:Z" out of a list of rows
+    '''
+    match = re.match(r"^([A-Za-z]*)(\d*)(?::([A-Za-z]*)(\d*))?$", a1)
+    if not a1 or not match:
+        return values
+    col1, row1, col2, row2 = match.groups()
+    if a1.count(":") == 0:
+        col2, row2 = col1, row1
+    first_row = int(row1) - 1 if row1 else 0
+    last_row = int(row2) if row2 else len(values)
+    first_col = column_number(col1) - 1 if col1 else 0
+    last_col = column_number(col2) if col2 else None
+    rows = [row[first_col:last_col] for row in values[first_row:last_row]]
+    # the API drops trailing empty cells and rows
+    rows = [row[:max([i + 1 for i, v in enumerate(row) if v != ""], default=0)] for row in rows]
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+def transpose(rows: list):
+    # rows to columns, dropping trailing empty cells like the API does
+    width = max([len(row) for row in rows], default=0)
+    columns = [[row[j] if j < len(row) else "" for row in rows] for j in range(width)]
+    return [column[:max([i + 1 for i, v in enumerate(column) if v != ""], default=0)] for column in columns]
+
+
+class FakeGoogleSheets(BaseAdapter):
+    '''
+    :param float latency: seconds added to every request
+    :param float failure_rate: fraction of requests answered with a 500
+    :param int seed: random seed for failures
+    '''
+
+    def __init__(self, latency: float=0.0, failure_rate: float=0.0, seed: int=None):
+        super(FakeGoogleSheets, self).__init__()
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        # spreadsheet id -> {"name", "modifiedTime", "sheets": {title: rows}}
+        self.spreadsheets = {}
+        self.calls = Counter()
+        # number of cells returned by values requests
+        self.cells_sent = 0
+
+    def add_spreadsheet(self, name: str, sheets: dict, spreadsheet_id: str=None):
+        spreadsheet_id = spreadsheet_id or f"fake-{len(self.spreadsheets) + 1}"
+        self.spreadsheets[spreadsheet_id] = {"name": name, "sheets": sheets}
+        self.touch(spreadsheet_id)
+        return spreadsheet_id
+
+    def touch(self, spreadsheet_id: str):
+        # bump the Drive modified time, like an edit would
+        self.spreadsheets[spreadsheet_id]["modifiedTime"] = \
+            time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + f".{time.time_ns() % 10**9:09d}Z"
+
+    def install(self, session):
+        session.mount(DRIVE_URL, self)
+        session.mount(SHEETS_URL, self)
+        return session
+
+    def client(self):
+        # imported here so the fake doesn't need gspread unless it's used
+        import gspread
+        return gspread.Client(auth=None, session=self.install(Session()))
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.cells_sent = 0
+
+    def close(self):
+        pass
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(request.url)
+        params = parse_qs(url.query)
+
+        with self.lock:
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                return make_response(request, 500)
+
+            if request.url.startswith(DRIVE_URL):
+                file_id = url.path[len(urlparse(DRIVE_URL).path):].strip("/")
+                if file_id:
+                    self.calls["drive_get"] += 1
+                    return self.drive_get(request, file_id)
+                self.calls["drive_list"] += 1
+                return self.drive_list(request, params.get("q", [""])[0])
+
+            path = url.path[len(urlparse(SHEETS_URL).path):].strip("/")
+            spreadsheet_id, _, rest = path.partition("/")
+            if spreadsheet_id not in self.spreadsheets:
+                return make_response(request, 404)
+            if rest == "values:batchGet":
+                self.calls["values_batch_get"] += 1
+                return make_response(request, 200, {
+                    "spreadsheetId": spreadsheet_id,
+                    "valueRanges": [self.get_range(spreadsheet_id, r, params.get("majorDimension", ["ROWS"])[0])
+                                    for r in params.get("ranges", [])]})
+            if rest.startswith("values/"):
+                self.calls["values_get"] += 1
+                return make_response(request, 200, self.get_range(spreadsheet_id, unquote(rest[len("values/"):]),
+                                                                  params.get("majorDimension", ["ROWS"])[0]))
+            self.calls["spreadsheet_get"] += 1
+            return self.spreadsheet_get(request, spreadsheet_id)
+
+    def drive_file(self, spreadsheet_id):
+        spreadsheet = self.spreadsheets[spreadsheet_id]
+        return {"id": spreadsheet_id, "name": spreadsheet["name"],
+                "createdTime": spreadsheet["modifiedTime"],
+                "modifiedTime": spreadsheet["modifiedTime"]}
+
+    def drive_list(self, request, query):
+        match = re.search(r'name = "([^"]*)"', query)
+        files = [self.drive_file(i) for i, s in self.spreadsheets.items()
+                 if not match or s["name"] == match.group(1)]
+        return make_response(request, 200, {"kind": "drive#fileList", "files": files})
+
+    def drive_get(self, request, file_id):
+        if file_id not in self.spreadsheets:
+            return make_response(request, 404)
+        return make_response(request, 200, self.drive_file(file_id))
+
+    def spreadsheet_get(self, request, spreadsheet_id):
+        spreadsheet = self.spreadsheets[spreadsheet_id]
+        sheets = []
+        for index, (title, rows) in enumerate(spreadsheet["sheets"].items()):
+            sheets.append({"properties": {
+                "sheetId": index, "title": title, "index": index, "sheetType": "GRID",
+                "gridProperties": {"rowCount": len(rows),
+                                   "columnCount": max([len(r) for r in rows], default=0)}}})
+        return make_response(request, 200, {
+            "spreadsheetId": spreadsheet_id,
+            "properties": {"title": spreadsheet["name"], "locale": "en_US", "timeZone": "UTC"},
+            "sheets": sheets})
+
+    def get_range(self, spreadsheet_id, range_name, major_dimension="ROWS"):
+        sheets = self.spreadsheets[spreadsheet_id]["sheets"]
+        title, _, a1 = range_name.partition("!")
+        title = title.strip("'").replace("''", "'")
+        if title not in sheets:
+            # a bare range applies to the first sheet
+            title, a1 = next(iter(sheets)), range_name
+        values = slice_a1(sheets[title], a1)
+        if major_dimension == "COLUMNS":
+            values = transpose(values)
+        self.cells_sent += sum(len(row) for row in values)
+        value_range = {"range": range_name, "majorDimension": major_dimension}
+        if values:
+            value_range["values"] = values
+        return value_range
@@ -0,0 +1,356 @@
+'''
+In-process stand-in for the GroupMe API, for benchmarks and offline runs.
+
+FakeGroupMe is a `requests` transport adapter: mount it on a session (e.g. a
+maker's `client.session`) and every request to api.groupme.com or the image
+service is answered from memory instead of going over the network. It
+covers the endpoints AutoMakeGroupMe uses and can add latency, rate limit
+and inject failures.
+
+    fake = FakeGroupMe(latency=0.05, results_delay=0.5)
+    agc = get_maker(AutoMakeGroupMe, "configs/config_groupme.json")
+    fake.install(agc.client.session)
+
+For AsyncAutoMakeGroupMe mount its httpx transport instead:
+
+    agc.mount(fake.async_transport())
+'''
+import re
+import json
+import time
+import asyncio
+import random
+import hashlib
+import threading
+from collections import Counter, defaultdict
+from urllib.parse import urlparse, parse_qs
+
+from requests import Request, Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+API_URL = "https://api.groupme.com/v3/"
+IMAGE_URL = "https://image.groupme.com/"
+
+ME = {"id": "1000", "user_id": "1000", "name": "AutoGroupChat"}
+
+
+def make_response(request, status_code: int, data=None, payload: bool=False):
+    response = Response()
+    response.status_code = status_code
+    response.request = request
+    response.url = request.url
+    response.headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+    body = {"meta": {"code": status_code}}
+    if status_code >= 400:
+        body["meta"]["errors"] = [f"fake error {status_code}"]
+    if data is not None:
+        # the image service answers with `payload` instead of `response`
+        body["payload" if payload else "response"] = data
+    response._content = json.dumps(body).encode("utf-8")
+    response.encoding = "utf-8"
+    return response
+
+
+class FakeGroupMe(BaseAdapter):
+    '''
+    :param float latency: seconds added to every request
+    :param float latency_jitter: up to this many extra seconds at random
+    :param float rate_limit: requests per second before answering 429, None for unlimited
+    :param float failure_rate: fraction of requests answered with a 500
+    :param float results_delay: seconds before membership add results are ready
+    :param fail_numbers: phone numbers that GroupMe refuses to add
+    :param int seed: random seed for jitter and failures
+    '''
+
+    ROUTES = [
+        ("GET", r"users/me$", "get_me"),
+        ("GET", r"groups$", "list_groups"),
+        ("POST", r"groups$", "create_group"),
+        ("POST", r"groups/change_owners$", "change_owners"),
+        ("GET", r"groups/(?P<group_id>\w+)$", "get_group"),
+        ("POST", r"groups/(?P<group_id>\w+)/update$", "update_group"),
+        ("POST", r"groups/(?P<group_id>\w+)/destroy$", "destroy_group"),
+        ("POST", r"groups/(?P<group_id>\w+)/members/add$", "add_members"),
+        ("GET", r"groups/(?P<group_id>\w+)/members/results/(?P<results_id>[\w-]+)$", "get_results"),
+        ("POST", r"groups/(?P<group_id>\w+)/members/(?P<membership_id>\w+)/remove$", "remove_member"),
+        ("POST", r"groups/(?P<group_id>\w+)/memberships/update$", "update_membership"),
+        ("GET", r"groups/(?P<group_id>\w+)/messages$", "list_messages"),
+        ("POST", r"groups/(?P<group_id>\w+)/messages$", "create_message"),
+        ("POST", r"pictures$", "upload_picture"),
+    ]
+
+    def __init__(self,
+                 latency: float=0.0,
+                 latency_jitter: float=0.0,
+                 rate_limit: float=None,
+                 failure_rate: float=0.0,
+                 results_delay: float=0.0,
+                 fail_numbers=(),
+                 seed: int=None):
+        super(FakeGroupMe, self).__init__()
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_limit = rate_limit
+        self.failure_rate = failure_rate
+        self.results_delay = results_delay
+        self.fail_numbers = set(fail_numbers)
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.messages = defaultdict(list)
+        self.results = {}
+        self.next_id = 1
+        # token bucket for the rate limit
+        self.tokens = rate_limit or 0
+        self.last_refill = time.monotonic()
+        # name of handler -> number of calls / status codes seen
+        self.calls = Counter()
+        self.statuses = Counter()
+
+        self.routes = [(method, re.compile(pattern), handler)
+                       for method, pattern, handler in self.ROUTES]
+
+    def install(self, session):
+        session.mount(API_URL, self)
+        session.mount(IMAGE_URL, self)
+        return session
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.statuses.clear()
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def close(self):
+        pass
+
+    def async_transport(self):
+        '''
+        An httpx transport answering from this fake, latency is awaited
+        instead of slept so concurrent requests overlap
+        '''
+        # imported here so the fake doesn't need httpx unless it's used
+        import httpx
+        fake = self
+
+        class FakeGroupMeTransport(httpx.AsyncBaseTransport):
+            async def handle_async_request(self, request):
+                delay = fake.get_delay()
+                if delay:
+                    await asyncio.sleep(delay)
+                prepared = Request(request.method, str(request.url), headers=dict(request.headers),
+                                   data=await request.aread()).prepare()
+                response = fake.handle(prepared)
+                return httpx.Response(response.status_code, headers=dict(response.headers),
+                                      content=response.content, request=request)
+
+        return FakeGroupMeTransport()
+
+    def get_delay(self):
+        return self.latency + self.latency_jitter * self.random.random()
+
+    def send(self, request, **kwargs):
+        delay = self.get_delay()
+        if delay:
+            time.sleep(delay)
+        return self.handle(request)
+
+    def handle(self, request):
+        url = urlparse(request.url)
+        base = IMAGE_URL if request.url.startswith(IMAGE_URL) else API_URL
+        path = request.url[len(base):].split("?")[0].strip("/")
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = request.body
+        if isinstance(body, bytes) and base == API_URL:
+            body = body.decode("utf-8")
+        if base == API_URL:
+            body = json.loads(body) if body else {}
+
+        for method, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if method == request.method and match:
+                break
+        else:
+            return make_response(request, 404)
+
+        with self.lock:
+            self.calls[handler] += 1
+            if not self.take_token():
+                status, data = 429, None
+            elif self.failure_rate and self.random.random() < self.failure_rate:
+                status, data = 500, None
+            else:
+                status, data = getattr(self, handler)(body=body, params=params, **match.groupdict())
+            self.statuses[status] += 1
+        return make_response(request, status, data, payload=(base == IMAGE_URL))
+
+    def take_token(self):
+        if not self.rate_limit:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.rate_limit, self.tokens + (now - self.last_refill) * self.rate_limit)
+        self.last_refill = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def new_id(self):
+        self.next_id += 1
+        return str(self.next_id)
+
+    def user_id_for(self, phone_number=None, user_id=None, email=None):
+        if user_id:
+            return str(user_id)
+        # the same phone number is always the same user
+        return str(int(hashlib.sha1(str(phone_number or email).encode()).hexdigest()[:8], 16))
+
+    def make_member(self, user_id, nickname, roles=("user",)):
+        return {"id": self.new_id(), "user_id": user_id, "nickname": nickname,
+                "muted": False, "image_url": None, "autokicked": False,
+                "roles": list(roles)}
+
+    # handlers, called with the lock held. return (status_code, data)
+
+    def get_me(self, **kwargs):
+        return 200, dict(ME)
+
+    def list_groups(self, params, **kwargs):
+        page = int(params.get("page", 1))
+        per_page = int(params.get("per_page", 10))
+        groups = list(self.groups.values())[(page - 1) * per_page:page * per_page]
+        return 200, [dict(g) for g in groups]
+
+    def create_group(self, body, **kwargs):
+        group_id = self.new_id()
+        now = int(time.time())
+        self.groups[group_id] = {
+            "id": group_id, "group_id": group_id, "name": body.get("name"),
+            "description": body.get("description"), "image_url": body.get("image_url"),
+            "share_url": None, "office_mode": False, "type": "private",
+            "creator_user_id": ME["user_id"], "created_at": now, "updated_at": now,
+            "members": [self.make_member(ME["user_id"], ME["name"], ("admin", "owner"))],
+            "messages": {"count": 0},
+        }
+        return 201, dict(self.groups[group_id])
+
+    def get_group(self, group_id, **kwargs):
+        if group_id not in self.groups:
+            return 404, None
+        return 200, dict(self.groups[group_id])
+
+    def update_group(self, group_id, body, **kwargs):
+        if group_id not in self.groups:
+            return 404, None
+        group = self.groups[group_id]
+        for key in ("name", "description", "image_url", "office_mode", "share"):
+            if body.get(key) is not None:
+                group[key] = body[key]
+        group["updated_at"] = int(time.time())
+        return 200, dict(group)
+
+    def destroy_group(self, group_id, **kwargs):
+        if group_id not in self.groups:
+            return 404, None
+        del self.groups[group_id]
+        return 200, None
+
+    def change_owners(self, body, **kwargs):
+        results = []
+        for r in body.get("requests", []):
+            group = self.groups.get(r["group_id"])
+            status = "404"
+            if group:
+                for m in group["members"]:
+                    if m["user_id"] == r["owner_id"]:
+                        m["roles"] = ["admin", "owner"]
+                        status = "200"
+                    elif "owner" in m["roles"]:
+                        m["roles"] = ["admin"]
+            results.append({"group_id": r["group_id"], "owner_id": r["owner_id"], "status": status})
+        return 200, {"results": results}
+
+    def add_members(self, group_id, body, **kwargs):
+        if group_id not in self.groups:
+            return 404, None
+        group = self.groups[group_id]
+        added = []
+        for request in body.get("members", []):
+            if request.get("phone_number") in self.fail_numbers:
+                continue
+            user_id = self.user_id_for(request.get("phone_number"), request.get("user_id"),
+                                       request.get("email"))
+            if any(m["user_id"] == user_id for m in group["members"]):
+                continue
+            member = self.make_member(user_id, request["nickname"])
+            group["members"].append(member)
+            added.append(dict(member, guid=request.get("guid")))
+        results_id = f"{group_id}-{self.new_id()}"
+        self.results[results_id] = (time.monotonic() + self.results_delay, added)
+        return 202, {"results_id": results_id}
+
+    def get_results(self, results_id, **kwargs):
+        if results_id not in self.results:
+            return 404, None
+        ready_at, members = self.results[results_id]
+        if time.monotonic() < ready_at:
+            return 503, None
+        return 200, {"members": [dict(m) for m in members]}
+
+    def remove_member(self, group_id, membership_id, **kwargs):
+        group = self.groups.get(group_id)
+        if not group:
+            return 404, None
+        group["members"] = [m for m in group["members"] if m["id"] != membership_id]
+        return 200, None
+
+    def update_membership(self, group_id, body, **kwargs):
+        group = self.groups.get(group_id)
+        if not group:
+            return 404, None
+        for m in group["members"]:
+            if m["user_id"] == ME["user_id"]:
+                m["nickname"] = body["membership"].get("nickname") or m["nickname"]
+                return 200, dict(m)
+        return 404, None
+
+    def list_messages(self, group_id, params, **kwargs):
+        if group_id not in self.groups:
+            return 404, None
+        messages = list(reversed(self.messages[group_id]))
+        if params.get("before_id"):
+            ids = [m["id"] for m in messages]
+            if params["before_id"] in ids:
+                messages = messages[ids.index(params["before_id"]) + 1:]
+        messages = messages[:int(params.get("limit", 20))]
+        if not messages:
+            return 304, None
+        return 200, {"count": len(self.messages[group_id]), "messages": messages}
+
+    def create_message(self, group_id, body, **kwargs):
+        if group_id not in self.groups:
+            return 404, None
+        message = body.get("message", {})
+        # source_guid makes resends idempotent
+        for m in self.messages[group_id]:
+            if m["source_guid"] == message.get("source_guid"):
+                return 201, {"message": dict(m)}
+        stored = {"id": self.new_id(), "source_guid": message.get("source_guid"),
+                  "text": message.get("text"), "attachments": message.get("attachments", []),
+                  "user_id": ME["user_id"], "sender_id": ME["user_id"], "name": ME["name"],
+                  "group_id": group_id, "created_at": int(time.time()),
+                  "favorited_by": [], "system": False, "avatar_url": None,
+                  "sender_type": "user"}
+        self.messages[group_id].append(stored)
+        self.groups[group_id]["messages"]["count"] = len(self.messages[group_id])
+        return 201, {"message": dict(stored)}
+
+    def upload_picture(self, body, **kwargs):
+        digest = hashlib.sha1(body or b"").hexdigest()
+        url = f"https://i.groupme.com/{digest}"
+        return 200, {"url": url, "picture_url": url}
@@ -0,0 +1,297 @@
+'''
+Timing spans and counters for makers and scrapers.
+
+Code wraps each operation in a span:
+
+    with instrumentation.span("groupme.create_group"):
+        ...
+
+and the retry policy/HTTP hooks add retry counts, poll iterations and
+HTTP status codes to the innermost open span. Finished spans go to the
+configured sinks: a JSON summary at the end of the run, a Prometheus
+textfile, and/or one structured log line per span.
+
+Instrumentation is disabled until `configure` is called. While disabled
+`span` returns a shared no-op object, so it costs about one function call.
+'''
+import json
+import time
+import logging
+import threading
+import contextvars
+from collections import Counter, defaultdict
+
+from autogroupchat.atomicfile import replace_file
+
+global logger
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    __slots__ = ("name", "labels", "start", "duration", "retries", "polls",
+                 "http_statuses", "error")
+
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+        self.start = time.time()
+        self.duration = None
+        self.retries = 0
+        self.polls = 0
+        self.http_statuses = Counter()
+        self.error = None
+
+    def to_dict(self):
+        return {"name": self.name,
+                "labels": self.labels,
+                "start": self.start,
+                "duration": self.duration,
+                "retries": self.retries,
+                "polls": self.polls,
+                "http_statuses": dict(self.http_statuses),
+                "error": self.error}
+
+
+class _NullSpan:
+    # stands in for a Span while instrumentation is disabled
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+# open spans, innermost last. A context variable rather than a thread local
+# so concurrent asyncio tasks on one thread each see their own spans
+_span_stack = contextvars.ContextVar("autogroupchat_span_stack", default=())
+
+
+class _ActiveSpan:
+    __slots__ = ("instrumentation", "span", "perf_start", "token")
+
+    def __init__(self, instrumentation, span):
+        self.instrumentation = instrumentation
+        self.span = span
+
+    def __enter__(self):
+        self.token = _span_stack.set(_span_stack.get() + (self.span,))
+        self.perf_start = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.duration = time.perf_counter() - self.perf_start
+        if exc is not None:
+            self.span.error = repr(exc)
+        _span_stack.reset(self.token)
+        self.instrumentation._finish(self.span)
+        return False
+
+
+class Instrumentation:
+    def __init__(self):
+        self.enabled = False
+        self.sinks = []
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def configure(self, sinks: list):
+        with self.lock:
+            self.sinks = list(sinks)
+            self.spans = []
+            self.enabled = bool(self.sinks)
+
+    def disable(self):
+        self.configure([])
+
+    def span(self, name: str, **labels):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _ActiveSpan(self, Span(name, labels))
+
+    def current(self):
+        if not self.enabled:
+            return None
+        stack = _span_stack.get()
+        return stack[-1] if stack else None
+
+    def record_retry(self):
+        span = self.current()
+        if span is not None:
+            span.retries += 1
+
+    def record_poll(self):
+        span = self.current()
+        if span is not None:
+            span.polls += 1
+
+    def record_http_status(self, status_code: int):
+        span = self.current()
+        if span is not None:
+            span.http_statuses[status_code] += 1
+
+    def response_hook(self, response, *args, **kwargs):
+        # `requests` session hook, records the status of every HTTP response
+        self.record_http_status(response.status_code)
+        return response
+
+    def _finish(self, span):
+        with self.lock:
+            self.spans.append(span)
+            sinks = list(self.sinks)
+        for sink in sinks:
+            try:
+                sink.on_span(span)
+            except Exception as e:
+                logger.error(f"Metrics sink {sink} failed: {e!r}")
+
+    def summary(self, spans: list=None):
+        '''
+        Aggregate finished spans (default all of them) by name
+        '''
+        if spans is None:
+            with self.lock:
+                spans = list(self.spans)
+        grouped = defaultdict(list)
+        for span in spans:
+            grouped[span.name].append(span)
+
+        summary = {}
+        for name, group in sorted(grouped.items()):
+            durations = sorted(s.duration for s in group)
+            statuses = Counter()
+            for s in group:
+                statuses.update(s.http_statuses)
+            summary[name] = {
+                "count": len(group),
+                "errors": sum(1 for s in group if s.error),
+                "total_seconds": sum(durations),
+                "p50_seconds": durations[int(0.50 * (len(durations) - 1))],
+                "p99_seconds": durations[int(0.99 * (len(durations) - 1))],
+                "max_seconds": durations[-1],
+                "retries": sum(s.retries for s in group),
+                "polls": sum(s.polls for s in group),
+                "http_statuses": {str(k): v for k, v in sorted(statuses.items())},
+            }
+        return summary
+
+    def flush(self):
+        '''
+        Hand the run summary to every sink, then start a fresh run
+        '''
+        if not self.enabled:
+            return
+        # take the spans and start afresh at once, so spans finishing while
+        # the sinks write are kept for the next flush
+        with self.lock:
+            spans, self.spans = self.spans, []
+        summary = self.summary(spans)
+        for sink in self.sinks:
+            try:
+                sink.flush(summary)
+            except Exception as e:
+                logger.error(f"Metrics sink {sink} failed: {e!r}")
+
+
+class MetricsSink:
+    def on_span(self, span: Span):
+        pass
+
+    def flush(self, summary: dict):
+        pass
+
+
+class JsonSummarySink(MetricsSink):
+    '''
+    Writes the run summary as JSON to `path`, or logs it if no path is given
+    '''
+
+    def __init__(self, path: str=None):
+        self.path = path
+
+    def flush(self, summary: dict):
+        if not self.path:
+            logger.info("metrics = " + json.dumps(summary, indent=4))
+            return
+        with open(self.path, "w") as f:
+            json.dump(summary, f, indent=4)
+
+
+class PrometheusTextfileSink(MetricsSink):
+    '''
+    Writes the run summary in the Prometheus text format, e.g. for the node
+    exporter's textfile collector
+    '''
+
+    def __init__(self, path: str, prefix: str="autogroupchat"):
+        self.path = path
+        self.prefix = prefix
+
+    def format(self, summary: dict):
+        p = self.prefix
+        lines = [f"# TYPE {p}_span_duration_seconds summary",
+                 f"# TYPE {p}_span_errors_total counter",
+                 f"# TYPE {p}_span_retries_total counter",
+                 f"# TYPE {p}_span_polls_total counter",
+                 f"# TYPE {p}_http_responses_total counter"]
+        for name, s in summary.items():
+            label = f'span="{name}"'
+            lines += [f'{p}_span_duration_seconds{{{label},quantile="0.5"}} {s["p50_seconds"]:.6f}',
+                      f'{p}_span_duration_seconds{{{label},quantile="0.99"}} {s["p99_seconds"]:.6f}',
+                      f'{p}_span_duration_seconds_sum{{{label}}} {s["total_seconds"]:.6f}',
+                      f'{p}_span_duration_seconds_count{{{label}}} {s["count"]}',
+                      f'{p}_span_errors_total{{{label}}} {s["errors"]}',
+                      f'{p}_span_retries_total{{{label}}} {s["retries"]}',
+                      f'{p}_span_polls_total{{{label}}} {s["polls"]}']
+            for status, count in s["http_statuses"].items():
+                lines.append(f'{p}_http_responses_total{{{label},status="{status}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def flush(self, summary: dict):
+        # write then swap so the collector never reads a half written file
+        text = self.format(summary)
+        replace_file(self.path, lambda f: f.write(text))
+
+
+class StructuredLogSink(MetricsSink):
+    '''
+    Logs one JSON line per finished span
+    '''
+
+    def __init__(self, log: logging.Logger=None, level: int=logging.INFO):
+        self.log = log or logger
+        self.level = level
+
+    def on_span(self, span: Span):
+        if self.log.isEnabledFor(self.level):
+            self.log.log(self.level, json.dumps(span.to_dict()))
+
+
+instrumentation = Instrumentation()
+
+
+def configure_from_config(metrics_config: dict):
+    '''
+    Enable instrumentation from the optional `metrics` block of a config:
+
+        "metrics": {
+            "json_summary": "/tmp/autogroupchat_metrics.json",  (or true to log it)
+            "prometheus_textfile": "/var/lib/node_exporter/autogroupchat.prom",
+            "structured_log": true
+        }
+    '''
+    metrics_config = metrics_config or {}
+    sinks = []
+    if metrics_config.get("json_summary"):
+        path = metrics_config["json_summary"]
+        sinks.append(JsonSummarySink(path if isinstance(path, str) else None))
+    if metrics_config.get("prometheus_textfile"):
+        sinks.append(PrometheusTextfileSink(metrics_config["prometheus_textfile"]))
+    if metrics_config.get("structured_log"):
+        sinks.append(StructuredLogSink())
+    instrumentation.configure(sinks)
+    return instrumentation
@@ -0,0 +1,594 @@
+'''
+GroupMe maker on asyncio, talking to the REST API directly with httpx
+instead of going through the synchronous groupy client.
+
+Every instance owns an event loop running in a background thread, and its
+httpx client (and connection pool) lives on that loop. Coroutines can be
+awaited from any event loop, they're handed over to the maker's loop, and
+sync callers such as the scrapers block on `group_startup` as usual. Many
+group setups can run concurrently on one instance:
+
+    agc = get_maker(AsyncAutoMakeGroupMe, "configs/config_groupme.json")
+    await asyncio.gather(*[agc.group_startup_async(...) for group in groups])
+
+httpx is an optional dependency: pip install autogroupchat[async]
+'''
+import re
+import json
+import uuid
+import asyncio
+import hashlib
+import logging
+import datetime
+import threading
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from autogroupchat.instrumentation import instrumentation
+from autogroupchat.makers.automakegroupchat import AutoMakeGroupChat, MESSAGE_ALWAYS_SEND, get_maker
+from autogroupchat.makers.automakegroupme import MEMBERS_CHUNK_SIZE
+from autogroupchat.makers.groupplan import make_plan, left_plan, plan_steps
+from autogroupchat.makers.retrypolicy import RetryError
+
+API_URL = "https://api.groupme.com/v3/"
+IMAGE_URL = "https://image.groupme.com/"
+
+# seconds each group_startup step may take before it's cancelled, override
+# with a `step_timeouts` block in the maker config
+STEP_TIMEOUTS = {
+    "resolve_image": 60,
+    "plan_group": 60,
+    "create_group": 60,
+    "update_group": 60,
+    "change_group_owner": 90,
+    "add_members": 180,
+    "send_messages": 60,
+    "remove_self_group": 60,
+}
+
+global logger
+logger = logging.getLogger(__name__)
+
+
+class AsyncAutoMakeGroupMe(AutoMakeGroupChat):
+    '''
+    API documentation: https://dev.groupme.com/docs/v3
+
+    Groups are the plain dicts GroupMe returns rather than groupy objects.
+    '''
+
+    RETRY_EXCEPTIONS = (httpx.TransportError,) if httpx else ()
+
+    def __init__(self, *args, **kwargs):
+        if httpx is None:
+            raise ImportError(
+                "AsyncAutoMakeGroupMe needs httpx, install it with `pip install autogroupchat[async]`")
+        super(AsyncAutoMakeGroupMe, self).__init__(*args, **kwargs)
+        self.groupme_token = self.config['groupme_token']
+        self.autogroupchat_name = "AutoGroupMe"
+        self.step_timeouts = dict(STEP_TIMEOUTS, **self.config.get('step_timeouts', {}))
+
+        # created on the maker's loop the first time they're needed
+        self.loop = None
+        self.loop_thread = None
+        self.loop_lock = threading.Lock()
+        self.client = None
+        self.transport = None
+        self.my_user_id = None
+        self.message_window = None
+
+    def get_loop(self):
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.loop_thread = threading.Thread(
+                    target=self.loop.run_forever, name="AsyncAutoMakeGroupMe", daemon=True)
+                self.loop_thread.start()
+            return self.loop
+
+    def run_sync(self, coro):
+        '''
+        Run `coro` on the maker's loop and wait for the result, for sync code
+        '''
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop()).result()
+
+    async def run_async(self, coro):
+        '''
+        Await `coro` on the maker's loop from any event loop. Cancelling the
+        caller cancels `coro` too.
+        '''
+        loop = self.get_loop()
+        if asyncio.get_running_loop() is loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+    def mount(self, transport):
+        '''
+        Send requests through an httpx transport instead of the network,
+        e.g. FakeGroupMe.async_transport(). Call before the first request.
+        '''
+        self.transport = transport
+
+    def get_client(self):
+        # only called on the maker's loop, the client's connections belong to it
+        if self.client is None:
+            pool_size = int(self.config.get('http_pool_size', 100))
+            self.client = httpx.AsyncClient(
+                base_url=API_URL,
+                headers={'X-Access-Token': self.groupme_token},
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                timeout=float(self.config.get('http_timeout', 30)),
+                # HTTP/2 multiplexes requests over one connection, needs httpx[http2]
+                http2=bool(self.config.get('http2', False)),
+                transport=self.transport,
+                event_hooks={'response': [self.record_status]})
+        return self.client
+
+    async def record_status(self, response):
+        # record the HTTP status of every call for metrics
+        instrumentation.record_http_status(response.status_code)
+
+    def rate_limit_key(self):
+        # every maker using this token shares its rate limit, the key is a
+        # hash so the token isn't written to the rate limit state file
+        return "groupme-" + hashlib.sha256(self.config['groupme_token'].encode('utf-8')).hexdigest()[:16]
+
+    def close(self):
+        super(AsyncAutoMakeGroupMe, self).close()
+        if self.loop is None:
+            return
+        if self.client is not None:
+            self.run_sync(self.client.aclose())
+            self.client = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.loop = None
+
+    async def request(self, method: str, path: str, allow_statuses: tuple=(), **kwargs):
+        '''
+        Make an API request with retries, returns the `response` part of the
+        body. Raises httpx.HTTPStatusError for error statuses, except those
+        in `allow_statuses` which return None.
+        '''
+        client = self.get_client()
+
+        async def attempt():
+            response = await client.request(method, path, **kwargs)
+            if response.status_code not in allow_statuses:
+                response.raise_for_status()
+            return response
+
+        # ids replaced so spans group by endpoint, e.g. "POST groups/{id}/messages"
+        endpoint = re.sub(r"(?<=/)[^/]*\d[^/]*", "{id}", path)
+        with instrumentation.span(f"groupme.{method} {endpoint}"):
+            response = await self.retry_policy.call_async(attempt)
+        if response.status_code in allow_statuses or not response.content:
+            return None
+        return response.json().get('response')
+
+    async def get_my_user_id(self):
+        if self.my_user_id is None:
+            self.my_user_id = (await self.request("GET", "users/me"))['user_id']
+        return self.my_user_id
+
+    async def create_group(self, group_name: str, image_url: str=None, description: str=None):
+        group = await self.request("POST", "groups", json={
+            'name': group_name,
+            'description': description,
+            'image_url': image_url or None,
+            'share': False})
+        self.group_registry.add(group['id'], group_name, group['created_at'])
+
+        # rename self to autogroupme, unless that's already our nickname
+        me = next((m for m in group.get('members', [])
+                   if m['user_id'] == group.get('creator_user_id')), None)
+        if me is None or me['nickname'] != self.autogroupchat_name:
+            await self.request("POST", f"groups/{group['id']}/memberships/update",
+                               json={'membership': {'nickname': self.autogroupchat_name}})
+        return group
+
+    async def upload_image_async(self, data: bytes):
+        # the image service isn't under API_URL and answers with `payload`
+        client = self.get_client()
+
+        async def attempt():
+            response = await client.post(IMAGE_URL + "pictures", content=data)
+            response.raise_for_status()
+            return response
+
+        with instrumentation.span("groupme.POST pictures"):
+            response = await self.retry_policy.call_async(attempt)
+        return response.json()['payload']['url']
+
+    def upload_image(self, data: bytes):
+        # called from ImageCache in a worker thread, see resolve_image_async
+        return self.run_sync(self.upload_image_async(data))
+
+    async def resolve_image_async(self, image: str, upload: bool=True):
+        # reading/downloading the image blocks, keep it off the loop
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.resolve_image, image, upload)
+
+    async def get_results(self, group: dict, results_id: str):
+        # 503 (so None) until GroupMe has processed the add request
+        return await self.request("GET", f"groups/{group['id']}/members/results/{results_id}",
+                                  allow_statuses=(503,))
+
+    async def add_member_chunk(self, group: dict, member_requests: list):
+        '''
+        One members/add request, then poll for its results without blocking.
+        Returns (guids that failed to be added, members that were added).
+        '''
+        results = await self.request("POST", f"groups/{group['id']}/members/add",
+                                     json={'members': member_requests})
+        results = await self.retry_policy.poll_async(
+            lambda: self.get_results(group, results['results_id']))
+        added = {m.get('guid') for m in results.get('members', [])}
+        return {r['guid'] for r in member_requests} - added, results.get('members', [])
+
+    async def add_members_group(self, group: dict, members: dict, chunk_size: int=None):
+        '''
+        Add members in chunks. All the chunks are sent at once and their
+        results polled concurrently.
+        Returns {name: {"phone_number": str, "success": bool, "error": str}}
+        '''
+        if not chunk_size:
+            chunk_size = int(self.config.get('members_chunk_size', MEMBERS_CHUNK_SIZE))
+
+        members = list(members.items())
+        chunks = [[{'nickname': name, 'phone_number': number, 'guid': uuid.uuid4().hex}
+                   for name, number in members[i:i + chunk_size]]
+                  for i in range(0, len(members), chunk_size)]
+        results = await asyncio.gather(*[self.add_member_chunk(group, chunk) for chunk in chunks],
+                                       return_exceptions=True)
+
+        outcome = {}
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, BaseException):
+                if isinstance(result, asyncio.CancelledError):
+                    raise result
+                # whole chunk failed, mark every member in it as failed
+                failed_guids, error = {r['guid'] for r in chunk}, repr(result)
+            else:
+                failed_guids, error = result[0], "GroupMe did not add member"
+            for r in chunk:
+                success = r['guid'] not in failed_guids
+                outcome[r['nickname']] = {"phone_number": r['phone_number'],
+                                          "success": success,
+                                          "error": None if success else error}
+                if not success:
+                    logger.error(
+                        f"Error adding member: '{r['nickname']}' ({r['phone_number']}): {error}")
+        return outcome
+
+    async def change_group_owner(self, group: dict, name: str, phone_number: str):
+        '''
+        Add the admin and hand them the group. Returns True on success.
+        '''
+        guid = uuid.uuid4().hex
+        failed, added = await self.add_member_chunk(
+            group, [{'nickname': name, 'phone_number': phone_number, 'guid': guid}])
+        if failed:
+            logger.error(f"Error adding admin: '{name}' ({phone_number})")
+            return False
+
+        return await self.set_group_owner(group, added[0]['user_id'])
+
+    async def set_group_owner(self, group: dict, user_id: str):
+        results = await self.request("POST", "groups/change_owners", json={
+            'requests': [{'group_id': group['id'], 'owner_id': user_id}]})
+        success = all(r.get('status') == '200' for r in results.get('results', []))
+        if success:
+            self.group_registry.update(group['id'], owned=False)
+        return success
+
+    async def send_message_to_group(self, group: dict, message: str, source_guid: str=None):
+        # the same source_guid on every retry so a retried post isn't sent twice
+        async with self.get_message_window():
+            return await self.request("POST", f"groups/{group['id']}/messages", json={
+                'message': {'source_guid': source_guid or uuid.uuid4().hex,
+                            'text': message,
+                            'attachments': []}})
+
+    def get_message_window(self):
+        # bounds the messages in flight across all groups, made on the
+        # maker's loop because that's where it's waited on. Defaults to the
+        # connection pool size, the threaded window would starve the loop
+        if self.message_window is None:
+            self.message_window = asyncio.Semaphore(int(self.config.get(
+                'message_window', self.config.get('http_pool_size', 100))))
+        return self.message_window
+
+    async def post_in_order(self, group: dict, messages: list):
+        # one at a time, GroupMe shows messages in the order it gets them
+        for message in messages:
+            await self.send_message_to_group(group, message)
+
+    async def send_message_to_groups_async(self, groups: list, message: str):
+        '''
+        Post the same message to many groups at once. Returns whether it was
+        posted, per group.
+        '''
+        results = await asyncio.gather(*[self.send_message_to_group(group, message) for group in groups],
+                                       return_exceptions=True)
+        posted = []
+        for group, result in zip(groups, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error sending message to group {group.get('name')}: {result!r}")
+            posted.append(not isinstance(result, BaseException))
+        return posted
+
+    def send_message_to_groups(self, groups: list, message: str):
+        return self.run_sync(self.send_message_to_groups_async(groups, message))
+
+    async def remove_self_group(self, group: dict):
+        my_user_id = await self.get_my_user_id()
+        group = await self.request("GET", f"groups/{group['id']}")
+        for member in group.get('members', []):
+            if member['user_id'] == my_user_id:
+                await self.request("POST", f"groups/{group['id']}/members/{member['id']}/remove")
+        # we can't purge a group we're not in anymore, but keep it in the
+        # registry so a rerun today doesn't make it again
+        self.group_registry.mark_left(group['id'])
+
+    async def get_group(self, group_id: str):
+        return await self.request("GET", f"groups/{group_id}", allow_statuses=(404,))
+
+    async def search_group(self, group_name: str, day: datetime.date):
+        # groups are listed most recently active first, one made today is
+        # on the first page
+        my_user_id = await self.get_my_user_id()
+        for g in await self.request("GET", "groups", params={'per_page': 20}) or []:
+            if (g['name'] == group_name and g.get('creator_user_id') == my_user_id
+                    and datetime.date.fromtimestamp(g['created_at']) == day):
+                self.group_registry.add(g['id'], g['name'], g['created_at'])
+                return g
+        return None
+
+    async def get_group_state(self, group: dict):
+        # 304 when the group has no messages
+        messages = await self.request("GET", f"groups/{group['id']}/messages",
+                                      params={'limit': 100}, allow_statuses=(304,))
+        return {
+            'id': group['id'],
+            'description': group.get('description'),
+            'image_url': group.get('image_url'),
+            'members': {m['nickname']: {'user_id': m['user_id'], 'roles': m.get('roles', [])}
+                        for m in group.get('members', [])},
+            'messages': [m['text'] for m in (messages or {}).get('messages', []) if m.get('text')],
+        }
+
+    async def update_group(self, group: dict, description: str=None, image_url: str=None):
+        # the endpoint needs name and office_mode on every update
+        body = {'name': group['name'], 'office_mode': False}
+        if description is not None:
+            body['description'] = description
+        if image_url is not None:
+            body['image_url'] = image_url
+        return await self.request("POST", f"groups/{group['id']}/update", json=body)
+
+    async def plan_group(self,
+                         group_name: str,
+                         members: dict,
+                         admin: dict,
+                         messages: list,
+                         image: str=None,
+                         description: str=None,
+                         day: datetime.date=None):
+        '''
+        Async `AutoMakeGroupChat.plan_group`
+        '''
+        day = day or datetime.date.today()
+        group = None
+        found = self.group_registry.find(group_name, day)
+        if found:
+            group_id, entry = found
+            if entry.get('left'):
+                return None, left_plan(group_name, group_id)
+            group = await self.get_group(group_id)
+            if group is None:
+                self.group_registry.remove(group_id)
+        if group is None:
+            group = await self.search_group(group_name, day)
+        if group is None:
+            return None, make_plan(group_name, members, admin, messages)
+        return group, make_plan(group_name, members, admin, messages, image, description,
+                                state=await self.get_group_state(group))
+
+    async def reconcile_groups(self):
+        '''
+        Scan every group on the account: register AutoGroupChat groups the
+        registry is missing and drop registry entries for groups we're no
+        longer in.
+        '''
+        my_user_id = await self.get_my_user_id()
+        registered = self.group_registry.group_ids()
+        seen = set()
+        page = 1
+        while 1:
+            groups = await self.request("GET", "groups", params={'page': page, 'per_page': 100})
+            if not groups:
+                break
+            for g in groups:
+                seen.add(str(g['id']))
+                # if description shows that it's an AutoGroupChat group
+                if str(g['id']) not in registered and g.get('description') == MESSAGE_ALWAYS_SEND:
+                    owned = any(m['user_id'] == my_user_id and 'owner' in m.get('roles', [])
+                                for m in g.get('members', []))
+                    self.group_registry.add(g['id'], g['name'], g['created_at'], owned)
+            page += 1
+        for group_id in registered - seen:
+            self.group_registry.remove(group_id)
+        self.group_registry.mark_reconciled()
+
+    async def purge_groups_async(self, group_delete_age_days: int=30, reconcile: bool=None):
+        '''
+        Destroy (or leave, if not the owner) groups in the registry older
+        than group_delete_age_days, see AutoMakeGroupMe.purge_groups
+        '''
+        if reconcile is None:
+            reconcile = self.group_registry.needs_reconcile(
+                self.config.get('registry_reconcile_days', 7))
+        if reconcile:
+            await self.reconcile_groups()
+
+        timedelta = datetime.timedelta(days=int(group_delete_age_days))
+
+        async def purge(group_id, entry):
+            group_name = entry['name']
+            try:
+                if entry['owned']:
+                    logger.info(
+                        f"Found group {group_name} ({group_id}) older than {timedelta}. Destroying group.")
+                    await self.request("POST", f"groups/{group_id}/destroy")
+                else:
+                    logger.info(
+                        f"Found group {group_name} ({group_id}) older than {timedelta}. Leaving group.")
+                    await self.remove_self_group({'id': group_id})
+            except httpx.HTTPStatusError as e:
+                # 404 means it's already gone, anything else we try next time
+                if e.response.status_code != 404:
+                    logger.error(f"Error purging group {group_name} ({group_id}): {e!r}")
+                    return
+            except RetryError as e:
+                # out of retries or the circuit is open, try it next time
+                logger.error(f"Error purging group {group_name} ({group_id}): {e!r}")
+                return
+            self.group_registry.remove(group_id)
+
+        await asyncio.gather(*[purge(group_id, entry) for group_id, entry
+                               in self.group_registry.expired(group_delete_age_days)])
+
+    def purge_groups(self, group_delete_age_days: int=30, reconcile: bool=None):
+        return self.run_sync(self.purge_groups_async(group_delete_age_days, reconcile))
+
+    async def step(self, name: str, group_name: str, coro):
+        # one group_startup step, cancelled if it runs past its timeout
+        with instrumentation.span(f"maker.{name}", group=group_name):
+            return await asyncio.wait_for(coro, self.step_timeouts.get(name))
+
+    async def _group_startup(self,
+                             group_name: str,
+                             members: dict,
+                             admin: dict,
+                             startup_messages: list,
+                             image: str,
+                             description: str,
+                             dont_leave_group: bool,
+                             group_delete_age_days: int,
+                             purge: bool,
+                             reconcile: bool=False,
+                             dry_run: bool=False):
+        if not description:
+            description = MESSAGE_ALWAYS_SEND
+
+        if not startup_messages:
+            startup_messages = [f"Welcome to {group_name}. {description}"]
+        messages = [MESSAGE_ALWAYS_SEND] + list(startup_messages)
+
+        # groups can only use images hosted by GroupMe. A dry run only looks
+        # up images already uploaded
+        if image:
+            image = await self.step("resolve_image", group_name,
+                                    self.resolve_image_async(image, upload=not dry_run))
+
+        if reconcile or dry_run:
+            group, plan = await self.step("plan_group", group_name, self.plan_group(
+                group_name, members, admin, messages, image, description))
+            logger.info(f"Plan for {group_name} ({plan_steps(plan)} changes): "
+                        + json.dumps(plan, indent=4))
+            if dry_run:
+                return plan
+            if plan['left']:
+                logger.info(f"Already created and left {group_name} today, nothing to do.")
+                return None
+        else:
+            group, plan = None, make_plan(group_name, members, admin, messages)
+
+        if plan['create']:
+            group = await self.step("create_group", group_name,
+                                    self.create_group(group_name, image, description))
+        elif plan['update']:
+            await self.step("update_group", group_name, self.update_group(group, **plan['update']))
+
+        # post the messages while members are added, in order
+        messages_sent = asyncio.ensure_future(self.step(
+            "send_messages", group_name, self.post_in_order(group, plan['send_messages'])))
+        try:
+            # add admin first because it will fail if the admin is already a
+            # member of the group
+            if plan['change_owner']:
+                assert len(admin) == 1 and "Only one owner is allowed per group."
+                owner = plan['change_owner']
+                if owner['user_id']:
+                    # already a member, just hand the group over
+                    coro = self.set_group_owner(group, owner['user_id'])
+                else:
+                    coro = self.change_group_owner(group, owner['name'], owner['phone_number'])
+                await self.step("change_group_owner", group_name, coro)
+
+            if plan['add_members']:
+                member_outcome = await self.step("add_members", group_name,
+                                                 self.add_members_group(group, plan['add_members']))
+                failed = {name: o["phone_number"] for name, o in member_outcome.items()
+                          if not o["success"]}
+                logger.info(
+                    f"Added {len(member_outcome) - len(failed)} of {len(member_outcome)} members to {group_name}.")
+                if failed:
+                    logger.error(f"Failed to add members to {group_name}: {failed}")
+
+            await messages_sent
+        finally:
+            messages_sent.cancel()
+
+        if not dont_leave_group:
+            await self.step("remove_self_group", group_name, self.remove_self_group(group))
+
+        if purge:
+            with instrumentation.span("maker.purge_groups"):
+                await self.purge_groups_async(group_delete_age_days=group_delete_age_days)
+        return group
+
+    async def group_startup_async(clazz,
+                                  config_file: str,
+                                  group_name: str,
+                                  members: dict[str, str],
+                                  admin: dict[str, str]={},
+                                  startup_messages: list[str]=[],
+                                  image: str=None,
+                                  description: str=None,
+                                  dont_leave_group: bool=True,
+                                  group_delete_age_days: int=30,
+                                  purge: bool=True,
+                                  reconcile: bool=False,
+                                  dry_run: bool=False):
+        '''
+        Async `group_startup`, can be awaited from any event loop
+        '''
+        agc = get_maker(clazz, config_file)
+        return await agc.run_async(agc._group_startup(
+            group_name, members, admin, startup_messages, image, description,
+            dont_leave_group, group_delete_age_days, purge, reconcile, dry_run))
+
+    def group_startup(clazz,
+                      config_file: str,
+                      group_name: str,
+                      members: dict[str, str],
+                      admin: dict[str, str]={},
+                      startup_messages: list[str]=[],
+                      image: str=None,
+                      description: str=None,
+                      dont_leave_group: bool=True,
+                      group_delete_age_days: int=30,
+                      purge: bool=True,
+                      reconcile: bool=False,
+                      dry_run: bool=False):
+        agc = get_maker(clazz, config_file)
+        return agc.run_sync(agc._group_startup(
+            group_name, members, admin, startup_messages, image, description,
+            dont_leave_group, group_delete_age_days, purge, reconcile, dry_run))
+
@@ -1,43 +1,235 @@
+import os
 import json
 import logging
 import datetime
+import threading
+
+from autogroupchat.instrumentation import instrumentation
+from autogroupchat.makers.retrypolicy import RetryPolicy
+from autogroupchat.makers.ratelimiter import get_rate_limiter
+from autogroupchat.makers.messagedelivery import MessageDelivery, MESSAGE_WINDOW
+from autogroupchat.makers.groupplan import make_plan, left_plan, plan_steps
+from autogroupchat.makers.imagecache import get_image_cache, DEFAULT_IMAGE_CACHE_FILE
+from autogroupchat.makers.groupregistry import get_registry, registry_file_from_config
 
 MESSAGE_ALWAYS_SEND = "Group created by autogroupchat. Please contact s41l8hu2@duck.com with any issues."
 
 global logger
 logger = logging.getLogger(__name__)
 
+# makers are cached at module level so warm cloud function invocations
+# reuse the same API clients (and their keep-alive connections)
+_makers = {}
+_makers_lock = threading.Lock()
+
+
+def get_maker(clazz, config_file: str):
+    '''
+    Return a shared `clazz` instance for `config_file`. A new instance is
+    made if the config file changed since the cached one was built, e.g.
+    when the token was rotated.
+    '''
+    config_file = os.path.abspath(config_file)
+    key = (clazz, config_file, os.stat(config_file).st_mtime_ns)
+    with _makers_lock:
+        agc = _makers.get(key)
+        if agc is None:
+            # drop instances built from an older version of the config
+            for old_key in [k for k in _makers if k[:2] == key[:2]]:
+                _makers.pop(old_key).close()
+            agc = _makers[key] = clazz(config_file)
+        return agc
+
+
+def close_makers():
+    '''
+    Close every shared maker, e.g. before the process exits.
+    '''
+    with _makers_lock:
+        for agc in _makers.values():
+            agc.close()
+        _makers.clear()
+
 
 class AutoMakeGroupChat:
-    def __init__(self, config_file):
+    # errors without an HTTP status code that are still worth retrying,
+    # subclasses set these to their client library's transient errors
+    RETRY_EXCEPTIONS = ()
+
+    def __init__(self, config_file, retry_policy: RetryPolicy=None):
         self.config_file = config_file
         self.MESSAGE_ALWAYS_SEND = MESSAGE_ALWAYS_SEND
 
         with open(self.config_file) as f:
             self.config = json.load(f)
 
+        # retry policy can be passed in, or configured with a `retry` block
+        # (and a `rate_limit` block, see ratelimiter.get_rate_limiter) in the config file
+        self.retry_policy = retry_policy or RetryPolicy.from_config(
+            self.config.get('retry', {}), retry_exceptions=self.RETRY_EXCEPTIONS,
+            rate_limiter=get_rate_limiter(self.rate_limit_key(), self.config.get('rate_limit')))
+
+        # local record of the groups we created, used for purging
+        self.group_registry = get_registry(registry_file_from_config(self.config, self.config_file))
+
+        # group images already uploaded, by content
+        self.image_cache = get_image_cache(
+            self.config.get('image_cache_file', DEFAULT_IMAGE_CACHE_FILE))
+
         self.autogroupchat_name = "AutoGroupChat"
 
+        # started the first time messages are sent
+        self.message_delivery = None
+        self.message_delivery_lock = threading.Lock()
+
+    def rate_limit_key(self):
+        # makers with the same key share a rate limit, subclasses use
+        # something identifying the API account
+        return os.path.abspath(self.config_file)
+
+    def close(self):
+        # subclasses release their API clients/connections here, then call this
+        if self.message_delivery is not None:
+            self.message_delivery.close()
+            self.message_delivery = None
+
+    def get_message_delivery(self):
+        with self.message_delivery_lock:
+            if self.message_delivery is None:
+                self.message_delivery = MessageDelivery(
+                    self, self.config.get('message_window', MESSAGE_WINDOW))
+            return self.message_delivery
+
     def create_group(self, group_name: str, image: str, description: str):
         raise NotImplementedError
 
+    def upload_image(self, data: bytes):
+        '''
+        Upload image data to the chat service's image host, returns its URL
+        '''
+        raise NotImplementedError
+
+    def resolve_image(self, image: str, upload: bool=True):
+        '''
+        URL of `image` (a URL or a local file) on the chat service's image
+        host, uploaded at most once per content. Returns None if there's no
+        image or it can't be read or uploaded, the group is made without it.
+
+        With upload=False (dry runs) nothing is uploaded or downloaded: an
+        image that isn't known to be hosted is returned as given.
+        '''
+        try:
+            if not upload:
+                return self.image_cache.lookup(image) or image
+            return self.image_cache.resolve(image, self.upload_image)
+        except Exception as e:
+            logger.error(f"Error uploading image {image}, making the group without it: {e!r}")
+            return None
+
     def add_members_group(self, group, members: dict):
+        '''
+        Add every member to the group. Returns the outcome per member as
+        {name: {"phone_number": str, "success": bool, "error": str}}
+        '''
+        outcome = {}
         for name, number in members.items():
-            self.add_member_group(group, name, number)
+            outcome[name] = {"phone_number": number, "success": True, "error": None}
+            try:
+                self.add_member_group(group, name, number)
+            except Exception as e:
+                logger.error(f"Error adding member: '{name}' ({number}): {e!r}")
+                outcome[name].update(success=False, error=repr(e))
+        return outcome
 
     def add_member_group(self, name: str, phone_number: str):
         raise NotImplementedError
 
     def change_group_owner(self, group, name: str, phone_number: str):
+        '''
+        Add the admin to the group and make them the owner
+        '''
         raise NotImplementedError
 
-    def send_message_to_group(self, group, message: str):
+    def send_message_to_group(self, group, message: str, source_guid: str=None):
         raise NotImplementedError
 
+    def send_message_to_groups(self, groups: list, message: str):
+        '''
+        Post the same message to many groups at once. Returns whether it was
+        posted, per group.
+        '''
+        posted = []
+        for group, future in zip(groups, self.get_message_delivery().announce(groups, message)):
+            try:
+                future.result()
+                posted.append(True)
+            except Exception as e:
+                logger.error(f"Error sending message to group {group}: {e!r}")
+                posted.append(False)
+        return posted
+
     def remove_self_group(self, group):
         raise NotImplementedError
 
-    def purge_groups(self, group_delete_age_days: int):
+    def get_group(self, group_id: str):
+        '''
+        The group with this id, or None if it's gone
+        '''
+        raise NotImplementedError
+
+    def search_group(self, group_name: str, day: datetime.date):
+        '''
+        Look for a group named `group_name` created on `day` that isn't in the
+        registry, e.g. because the registry file was lost. None if not found.
+        '''
+        return None
+
+    def get_group_state(self, group):
+        '''
+        Snapshot of the group to diff against, see autogroupchat.makers.groupplan
+        '''
+        raise NotImplementedError
+
+    def update_group(self, group, description: str=None, image_url: str=None):
+        raise NotImplementedError
+
+    def set_group_owner(self, group, user_id: str):
+        '''
+        Hand the group to a user that's already a member
+        '''
+        raise NotImplementedError
+
+    def plan_group(self,
+                   group_name: str,
+                   members: dict,
+                   admin: dict,
+                   messages: list,
+                   image: str=None,
+                   description: str=None,
+                   day: datetime.date=None):
+        '''
+        Find the group made for `group_name` on `day` (default today) and work
+        out what's missing from it. Returns (group, plan), group is None if
+        there's no group to reuse.
+        '''
+        day = day or datetime.date.today()
+        group = None
+        found = self.group_registry.find(group_name, day)
+        if found:
+            group_id, entry = found
+            if entry.get('left'):
+                return None, left_plan(group_name, group_id)
+            group = self.get_group(group_id)
+            if group is None:
+                self.group_registry.remove(group_id)
+        if group is None:
+            group = self.search_group(group_name, day)
+        if group is None:
+            return None, make_plan(group_name, members, admin, messages)
+        return group, make_plan(group_name, members, admin, messages, image, description,
+                                state=self.get_group_state(group))
+
+    def purge_groups(self, group_delete_age_days: int, reconcile: bool=None):
         raise NotImplementedError
 
     def group_startup(clazz,
@@ -49,46 +241,107 @@ class AutoMakeGroupChat:
                       image: str=None,
                       description: str=None,
                       dont_leave_group: bool=True,
-                      group_delete_age_days: int=30):
-        agc = clazz(config_file)
+                      group_delete_age_days: int=30,
+                      purge: bool=True,
+                      reconcile: bool=False,
+                      dry_run: bool=False):
+        '''
+        Create a group, hand it to the admin, add the members and post the
+        startup messages. Returns the group.
+
+        With `reconcile`, a group already made for `group_name` today is
+        reused and only what's missing from it (members, owner, description,
+        image, messages) is done, so a rerun doesn't make a duplicate. With
+        `dry_run` nothing is changed, the plan of what would be done is
+        returned instead (see autogroupchat.makers.groupplan).
+        '''
+        agc = get_maker(clazz, config_file)
 
         if not description:
             description = MESSAGE_ALWAYS_SEND
 
+        # default startup message
+        if not startup_messages:
+            startup_messages = [
+                f"Welcome to {group_name}. {description}"]
+        messages = [MESSAGE_ALWAYS_SEND] + list(startup_messages)
+
+        # groups can only use images hosted by the chat service. A dry run
+        # only looks up images already uploaded
+        if image:
+            with instrumentation.span("maker.resolve_image", group=group_name):
+                image = agc.resolve_image(image, upload=not dry_run)
+
+        if reconcile or dry_run:
+            # reuse the group already made for this name today, if any, and
+            # only do what's missing from it
+            with instrumentation.span("maker.plan_group", group=group_name):
+                group, plan = agc.plan_group(group_name, members, admin, messages,
+                                             image, description)
+            logger.info(f"Plan for {group_name} ({plan_steps(plan)} changes): "
+                        + json.dumps(plan, indent=4))
+            if dry_run:
+                return plan
+            if plan['left']:
+                logger.info(f"Already created and left {group_name} today, nothing to do.")
+                return None
+        else:
+            group, plan = None, make_plan(group_name, members, admin, messages)
+
         # create group
-        group = agc.create_group(group_name, image, description)
+        if plan['create']:
+            with instrumentation.span("maker.create_group", group=group_name):
+                group = agc.create_group(group_name, image, description)
+        elif plan['update']:
+            with instrumentation.span("maker.update_group", group=group_name):
+                agc.update_group(group, **plan['update'])
+
+        # start posting MESSAGE_ALWAYS_SEND and the startup messages in the
+        # background, they go out in order while members are added
+        messages_sent = None
+        if plan['send_messages']:
+            messages_sent = agc.get_message_delivery().deliver(group, plan['send_messages'])
 
         # add admin first because it will fail if the admin is already a member
         # of the group
-        if admin:
+        if plan['change_owner']:
             assert len(admin) == 1 and "Only one owner is allowed per group."
 
-            admin_name, admin_phone_number = admin.popitem()
-            # add admin to the group
-            agc.add_member_group(group, admin_name, admin_phone_number)
-            # make admin new owner
-            agc.change_group_owner(group, admin_name, admin_phone_number)
+            owner = plan['change_owner']
+            with instrumentation.span("maker.change_group_owner", group=group_name):
+                if owner['user_id']:
+                    # already a member, just hand the group over
+                    agc.set_group_owner(group, owner['user_id'])
+                else:
+                    # add admin to the group and make them the new owner
+                    agc.change_group_owner(group, owner['name'], owner['phone_number'])
 
         # add members
-        for member_name, member_number in members.items():
-            agc.add_member_group(group, member_name, member_number)
+        if plan['add_members']:
+            with instrumentation.span("maker.add_members", group=group_name):
+                member_outcome = agc.add_members_group(group, plan['add_members'])
+            failed = {name: o["phone_number"] for name, o in member_outcome.items()
+                      if not o["success"]}
+            logger.info(
+                f"Added {len(member_outcome) - len(failed)} of {len(member_outcome)} members to {group_name}.")
+            if failed:
+                logger.error(f"Failed to add members to {group_name}: {failed}")
 
-        # send MESSAGE_ALWAYS_SEND
-        agc.send_message_to_group(group, MESSAGE_ALWAYS_SEND)
-
-        # default startup message
-        if not startup_messages:
-            startup_messages = [
-                f"Welcome to {group_name}. {description}"]
-        # send startup messages
-        for m in startup_messages:
-            agc.send_message_to_group(group, m)
+        # wait for the messages to finish posting
+        if messages_sent is not None:
+            with instrumentation.span("maker.send_messages", group=group_name):
+                messages_sent.result()
 
         if not dont_leave_group:
             # remove self from group
-            agc.remove_self_group(group)
+            with instrumentation.span("maker.remove_self_group", group=group_name):
+                agc.remove_self_group(group)
 
-        # purge groups made by AutoGroupChat older than 30 days
-        agc.purge_groups(group_delete_age_days=group_delete_age_days)
+        # purge groups made by AutoGroupChat older than 30 days. callers
+        # creating many groups in one run should pass purge=False and purge
+        # once at the end instead
+        if purge:
+            with instrumentation.span("maker.purge_groups"):
+                agc.purge_groups(group_delete_age_days=group_delete_age_days)
 
         return group
\ No newline at end of file
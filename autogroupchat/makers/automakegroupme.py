@@ -1,97 +1,184 @@
+import io
 import sys
 import os.path
+import uuid
+import hashlib
 import logging
 import argparse
 import datetime
 
 from groupy.client import Client
 from groupy.api.groups import Group
-from groupy.exceptions import BadResponse
+from groupy.exceptions import BadResponse, NoResponse
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 
-from autogroupchat.makers.automakegroupchat import AutoMakeGroupChat, MESSAGE_ALWAYS_SEND
+from autogroupchat.plugins import get_maker_class
+from autogroupchat.instrumentation import instrumentation
+from autogroupchat.makers.retrypolicy import get_status_code, RetryError
+from autogroupchat.makers.automakegroupchat import AutoMakeGroupChat, MESSAGE_ALWAYS_SEND, close_makers
+
+# number of members sent per memberships.add request
+MEMBERS_CHUNK_SIZE = 50
 
 global logger
 logger = logging.getLogger(__name__)
 
 
+def results_ready(request):
+    '''
+    `is_ready` of a groupy MembershipRequest. groupy raises on the 503
+    GroupMe answers until the results are ready, that's expected while
+    polling and shouldn't count as a failure (or trip the circuit breaker).
+    '''
+    try:
+        return request.is_ready()
+    except BadResponse as e:
+        if get_status_code(e) == 503:
+            return False
+        raise
+
+
 class AutoMakeGroupMe(AutoMakeGroupChat):
     '''
     to access API documentationo, go to 
     https://groupy.readthedocs.io/en/latest/pages/api.html
     '''
 
+    RETRY_EXCEPTIONS = (BadResponse, NoResponse, HTTPError)
+
     def __init__(self, *args, **kwargs):
         super(AutoMakeGroupMe, self).__init__(*args, **kwargs)
         self.groupme_token = self.config['groupme_token']
         self.autogroupchat_name = "AutoGroupMe"
 
         self.client = Client.from_token(self.groupme_token)
+        self.my_user_id = None
+        # the instance is shared between threads, size the connection pool
+        # so they don't wait on each other for a connection
+        pool_size = int(self.config.get('http_pool_size', 20))
+        self.client.session.mount('https://', HTTPAdapter(pool_connections=pool_size,
+                                                          pool_maxsize=pool_size))
+        # record the HTTP status of every call for metrics
+        self.client.session.hooks['response'].append(instrumentation.response_hook)
+
+    def rate_limit_key(self):
+        # every maker using this token shares its rate limit, the key is a
+        # hash so the token isn't written to the rate limit state file
+        return "groupme-" + hashlib.sha256(self.config['groupme_token'].encode('utf-8')).hexdigest()[:16]
+
+    def close(self):
+        super(AutoMakeGroupMe, self).close()
+        self.client.session.close()
 
     def _catch_bad_response(self, func, *args, **kwargs):
-        retval = None
-        # loop for making sure group has been created successfully.
+        # retry for making sure group has been created successfully.
         # there's a little race condition with the API here that this fixes
-        while 1:
-            try:
-                retval = func(*args, **kwargs)
+        def attempt():
+            retval = func(*args, **kwargs)
 
-                # wait for results to be ready
-                if hasattr(retval, "is_ready"):
-                    while not retval.is_ready():
-                        pass
+            # wait for results to be ready
+            if hasattr(retval, "is_ready"):
+                self.retry_policy.poll(lambda: results_ready(retval))
 
-                if hasattr(retval, "results"):
-                    if retval.results.failures:
-                        raise Exception(f"{func} call returned failure: {retval.results.failures}")
+            if hasattr(retval, "results"):
+                if retval.results and retval.results.failures:
+                    raise Exception(f"{func} call returned failure: {retval.results.failures}")
 
-                # break out of loop if success
+            return retval
+
+        name = getattr(func, '__qualname__', None) or getattr(func, '__name__', repr(func))
+        with instrumentation.span(f"groupme.{name}"):
+            return self.retry_policy.call(attempt)
+
+    def purge_groups(self, group_delete_age_days: int=30, reconcile: bool=None):
+        '''
+        Destroy (or leave, if not the owner) groups in the registry older
+        than group_delete_age_days. Only registry entries are touched, unless
+        a reconcile is requested or is due (every `registry_reconcile_days`,
+        default 7), in which case every group on the account is scanned first
+        to fix up drift between GroupMe and the registry.
+        '''
+        if reconcile is None:
+            reconcile = self.group_registry.needs_reconcile(
+                self.config.get('registry_reconcile_days', 7))
+        if reconcile:
+            self.reconcile_groups()
+
+        timedelta = datetime.timedelta(days=int(group_delete_age_days))
+        for group_id, entry in self.group_registry.expired(group_delete_age_days):
+            group_name = entry['name']
+            try:
+                if entry['owned']:
+                    # I am the owner, destroy
+                    logger.info(
+                        f"Found group {group_name} ({group_id}) older than {timedelta}. Destroying group.")
+                    self._catch_bad_response(self.client.groups.destroy, group_id)
+                else:
+                    # i am not the owner, leave
+                    logger.info(
+                        f"Found group {group_name} ({group_id}) older than {timedelta}. Leaving group.")
+                    group = self._catch_bad_response(self.client.groups.get, group_id)
+                    self._catch_bad_response(group.leave)
+            except BadResponse as e:
+                # 404 means it's already gone, anything else we try next time
+                if getattr(e.response, 'status_code', None) != 404:
+                    logger.error(f"Error purging group {group_name} ({group_id}): {e!r}")
+                    continue
+            except RetryError as e:
+                # out of retries or the circuit is open, try it next time
+                logger.error(f"Error purging group {group_name} ({group_id}): {e!r}")
+                continue
+            self.group_registry.remove(group_id)
+
+    def reconcile_groups(self):
+        '''
+        Scan every group on the account: register AutoGroupChat groups the
+        registry is missing and drop registry entries for groups we're no
+        longer in.
+        '''
+        my_user_id = self.get_my_user_id()
+        registered = self.group_registry.group_ids()
+        seen = set()
+        page = 1
+        while 1:
+            # a page at a time, so each request is rate limited and retried
+            groups = list(self._catch_bad_response(self.client.groups.list, page=page, per_page=100))
+            if not groups:
                 break
-            except (BadResponse, HTTPError):
-                pass
-        return retval
-
-    def purge_groups(self, group_delete_age_days: int=30):
-        for g in self.client.groups.list_all():
-            # if description shows that it's an AutoGroupChat group
-            if g.data['description'] == MESSAGE_ALWAYS_SEND:
-                created_ms = g.data['created_at']
-                created_datetime = datetime.datetime.fromtimestamp(created_ms)
-                now_datetime = datetime.datetime.today()
-                # if is older than timedelta, defaults to 30 days
-                timedelta = datetime.timedelta(days=int(group_delete_age_days))
-                if (now_datetime - created_datetime) > timedelta:
-                    if g.is_mine:
-                        # I am the owner, destroy
-                        logger.info(
-                            f"Found group {g} with description {g.data['description']} older than {timedelta}. Destroying group.")
-                        g.destroy()
-                    else:
-                        # i am not the owner, leave
-                        logger.info(
-                            f"Found group {g} with description {g.data['description']} older than {timedelta}. Leaving group.")
-                        g.leave()
+            for g in groups:
+                seen.add(str(g.id))
+                # if description shows that it's an AutoGroupChat group
+                if str(g.id) not in registered and g.data['description'] == MESSAGE_ALWAYS_SEND:
+                    owned = any(m.user_id == my_user_id and 'owner' in m.roles
+                                for m in g.members)
+                    self.group_registry.add(g.id, g.name, g.data['created_at'], owned)
+            page += 1
+        for group_id in registered - seen:
+            self.group_registry.remove(group_id)
+        self.group_registry.mark_reconciled()
 
     def create_group(self, group_name: str, image_url: str=None, description: str=None):
-        # create group
+        # one request sets everything about the group
         new_group = self._catch_bad_response(
-            self.client.groups.create, name=group_name)
-
-        self._catch_bad_response(self.client.groups.get, new_group.id)
+            self.client.groups.create, name=group_name, description=description or None,
+            image_url=image_url or None, share=False)
 
-        # rename self to autogroupme
-        self._catch_bad_response(
-            new_group.update_membership, self.autogroupchat_name)
+        # rename self to autogroupme, unless that's already our nickname
+        me = next((m for m in new_group.members if m.user_id == new_group.creator_user_id), None)
+        if me is None or me.nickname != self.autogroupchat_name:
+            self._catch_bad_response(
+                new_group.update_membership, self.autogroupchat_name)
 
-        # update group photo
-        if image_url:
-            self._catch_bad_response(new_group.update, image_url=image_url, office_mode=False)
-        # update group description
-        if description:
-            self._catch_bad_response(new_group.update, description=description, office_mode=False)
-        # new_group_id = new_group.id
+        self.group_registry.add(new_group.id, group_name, new_group.data['created_at'])
         return new_group
 
+    def upload_image(self, data: bytes):
+        # a new file object per attempt, a retry has to send the data again
+        with instrumentation.span("groupme.Images.upload"):
+            return self.retry_policy.call(
+                lambda: self.client.images.upload(io.BytesIO(data)))['url']
+
     def add_member_group(self, group: Group, member_display_name: str, member_number: str):
         try:
             return self._catch_bad_response(group.memberships.add, member_display_name, phone_number=member_number)
@@ -103,29 +190,113 @@ class AutoMakeGroupMe(AutoMakeGroupChat):
                 # otherwise raise the error
                 raise e
 
+    def add_members_group(self, group: Group, members: dict, chunk_size: int=None):
+        '''
+        Add members in chunks, one `memberships.add` request per chunk, and
+        poll each chunk's results once. Failures are mapped back to the
+        member they belong to using the request guid.
+        Returns {name: {"phone_number": str, "success": bool, "error": str}}
+        '''
+        if not chunk_size:
+            chunk_size = int(self.config.get('members_chunk_size', MEMBERS_CHUNK_SIZE))
+
+        outcome = {}
+        members = list(members.items())
+        for i in range(0, len(members), chunk_size):
+            member_requests = [{'nickname': name, 'phone_number': number}
+                               for name, number in members[i:i + chunk_size]]
+            try:
+                with instrumentation.span("groupme.Memberships.add_multiple"):
+                    # add_multiple sets a guid on each request dict
+                    member_add_request = self.retry_policy.call(
+                        group.memberships.add_multiple, *member_requests)
+                    self.retry_policy.poll(lambda: results_ready(member_add_request))
+                    member_add_result = member_add_request.get()
+                failed_guids = {f['guid'] for f in member_add_result.failures}
+                error = "GroupMe did not add member"
+            except Exception as e:
+                # whole chunk failed, mark every member in it as failed
+                failed_guids = {r.get('guid') for r in member_requests}
+                error = repr(e)
+
+            for r in member_requests:
+                success = r.get('guid') not in failed_guids
+                outcome[r['nickname']] = {"phone_number": r['phone_number'],
+                                          "success": success,
+                                          "error": None if success else error}
+                if not success:
+                    logger.error(
+                        f"Error adding member: '{r['nickname']}' ({r['phone_number']}): {error}")
+        return outcome
+
     def change_group_owner(self, group: Group, name: str, phone_number: str):
         '''
         Be sure to call `change_group_owner` before `add_member_group`
         because it will fail if the admin is already a member of the group
         '''
+        # _catch_bad_response waits for the results to be ready
         member_add_request = self._catch_bad_response(group.memberships.add,
                                                       name, phone_number=phone_number)
-        while 1:
-            if self._catch_bad_response(member_add_request.check_if_ready):
-                break
-        member_add_result = self._catch_bad_response(member_add_request.get)
+        member_add_result = member_add_request.get()
         member_add_success = member_add_result.members
         # member_add_failures = member_add_result.failures
 
         if len(member_add_success) == 1:
-            admin_id = member_add_success[0].user_id
-            self._catch_bad_response(group.change_owners, admin_id)
+            self.set_group_owner(group, member_add_success[0].user_id)
+
+    def set_group_owner(self, group: Group, user_id: str):
+        if self._catch_bad_response(group.change_owners, user_id):
+            self.group_registry.update(group.id, owned=False)
 
     def remove_self_group(self, group):
         self._catch_bad_response(group.leave)
+        # we can't purge a group we're not in anymore, but keep it in the
+        # registry so a rerun today doesn't make it again
+        self.group_registry.mark_left(group.id)
+
+    def get_group(self, group_id: str):
+        try:
+            return self._catch_bad_response(self.client.groups.get, group_id)
+        except BadResponse as e:
+            if get_status_code(e) == 404:
+                return None
+            raise
+
+    def search_group(self, group_name: str, day: datetime.date):
+        # groups are listed most recently active first, one made today is
+        # on the first page
+        for g in self._catch_bad_response(self.client.groups.list, per_page=20):
+            if (g.name == group_name and g.creator_user_id == self.get_my_user_id()
+                    and datetime.date.fromtimestamp(g.data['created_at']) == day):
+                self.group_registry.add(g.id, g.name, g.data['created_at'])
+                return g
+        return None
 
-    def send_message_to_group(self, group, message):
-        self._catch_bad_response(group.post, message)
+    def get_my_user_id(self):
+        if self.my_user_id is None:
+            self.my_user_id = self._catch_bad_response(self.client.user.get_me)['user_id']
+        return self.my_user_id
+
+    def get_group_state(self, group: Group):
+        messages = self._catch_bad_response(group.messages.list, limit=100)
+        return {
+            'id': group.id,
+            'description': group.data.get('description'),
+            'image_url': group.data.get('image_url'),
+            'members': {m.nickname: {'user_id': m.user_id, 'roles': getattr(m, 'roles', [])}
+                        for m in group.members},
+            'messages': [m.text for m in messages if m.text],
+        }
+
+    def update_group(self, group: Group, description: str=None, image_url: str=None):
+        self._catch_bad_response(group.update, description=description,
+                                 image_url=image_url, office_mode=False)
+
+    def send_message_to_group(self, group, message, source_guid: str=None):
+        # a fixed source_guid makes retries idempotent, GroupMe drops a
+        # message it has already seen with the same guid
+        self._catch_bad_response(group.messages.create, text=message,
+                                 source_guid=source_guid or uuid.uuid4().hex)
 
 
 def run(args):
@@ -135,24 +306,25 @@ def run(args):
         1]} if args.admin else {}
 
     # turn string into class with validation of subclass and existence
-    gc_class = getattr(sys.modules[__name__], args.group_creation_class, None)
-    if not gc_class:
-        raise Exception(
-            f"Invalid group creation class: args.group_creation_class={args.group_creation_class}, gc_class={gc_class}")
-    assert issubclass(
-        gc_class, AutoMakeGroupChat) and "gc_class must be subclass of AutoGroupChat"
-
-    gc_class.group_startup(
-        gc_class,
-        args.config_file,
-        args.group_name,
-        members,
-        admin,
-        args.startup_messages,
-        args.image,
-        args.description,
-        args.dont_leave_group,
-    )
+    gc_class = get_maker_class(args.group_creation_class)
+
+    try:
+        gc_class.group_startup(
+            gc_class,
+            args.config_file,
+            args.group_name,
+            members,
+            admin,
+            args.startup_messages,
+            args.image,
+            args.description,
+            args.dont_leave_group,
+            reconcile=args.reconcile,
+            dry_run=args.dry_run,
+        )
+    finally:
+        # release the shared clients' connections
+        close_makers()
 
 
 if __name__ == "__main__":
@@ -171,6 +343,10 @@ if __name__ == "__main__":
                         help="Don't recommend making this dynamic. This is assumed to be constant for purging old groups")
     parser.add_argument("--dont-leave-group", action='store_true')
     parser.add_argument("--group-creation-class", default="AutoMakeGroupMe")
+    parser.add_argument("--reconcile", action='store_true',
+                        help="reuse the group if it was already made today, only doing what's missing")
+    parser.add_argument("--dry-run", action='store_true',
+                        help="log what would be done without changing anything")
     parser.set_defaults(func=run)
 
     args = parser.parse_args(
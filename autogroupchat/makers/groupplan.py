@@ -0,0 +1,109 @@
+'''
+What group_startup has to do to bring a group in line with the sheet.
+
+A plan is a plain dict, so it can be logged or returned as the report of a
+dry run:
+
+    {
+        "group_name": str,
+        "group_id": str or None,     # existing group, None if it's created
+        "create": bool,
+        "left": bool,                # made earlier but we've left it since
+        "update": {"description": str, "image_url": str},
+        "change_owner": {"name": str, "phone_number": str, "user_id": str} or None,
+        "add_members": {name: phone_number},
+        "send_messages": [str],
+    }
+
+Existing groups are compared using a snapshot from the maker's
+`get_group_state`:
+
+    {
+        "id": str,
+        "description": str,
+        "image_url": str,
+        "members": {nickname: {"user_id": str, "roles": [str]}},
+        "messages": [str],           # text of the recent messages
+    }
+
+GroupMe doesn't tell us members' phone numbers, so members are matched by
+the nickname they were added with, which is their name in the sheet.
+'''
+
+
+def make_plan(group_name: str,
+              members: dict,
+              admin: dict,
+              messages: list,
+              image: str=None,
+              description: str=None,
+              state: dict=None):
+    '''
+    Plan for a group with no existing `state`: create it, hand it to the
+    admin, add everyone and post every message. With `state`, only what's
+    missing or different.
+    '''
+    admin_name, admin_phone_number = next(iter(admin.items())) if admin else (None, None)
+    if state is None:
+        return {
+            'group_name': group_name,
+            'group_id': None,
+            'create': True,
+            'left': False,
+            'update': {},
+            'change_owner': {'name': admin_name, 'phone_number': admin_phone_number,
+                             'user_id': None} if admin else None,
+            'add_members': dict(members),
+            'send_messages': list(messages),
+        }
+
+    update = {}
+    if description and state.get('description') != description:
+        update['description'] = description
+    if image and state.get('image_url') != image:
+        update['image_url'] = image
+
+    change_owner = None
+    if admin:
+        current = state['members'].get(admin_name)
+        if current is None or 'owner' not in current.get('roles', []):
+            change_owner = {'name': admin_name, 'phone_number': admin_phone_number,
+                            'user_id': current and current.get('user_id')}
+
+    sent = set(state['messages'])
+    return {
+        'group_name': group_name,
+        'group_id': str(state['id']),
+        'create': False,
+        'left': False,
+        'update': update,
+        'change_owner': change_owner,
+        'add_members': {name: number for name, number in members.items()
+                        if name not in state['members']},
+        'send_messages': [m for m in messages if m not in sent],
+    }
+
+
+def left_plan(group_name: str, group_id: str):
+    '''
+    Plan for a group that was already made and left, there's nothing we can
+    look at or change in it anymore
+    '''
+    return {
+        'group_name': group_name,
+        'group_id': str(group_id),
+        'create': False,
+        'left': True,
+        'update': {},
+        'change_owner': None,
+        'add_members': {},
+        'send_messages': [],
+    }
+
+
+def plan_steps(plan: dict):
+    '''
+    Number of changes in the plan, 0 if the group is already up to date
+    '''
+    return (bool(plan['create']) + bool(plan['update']) + bool(plan['change_owner'])
+            + bool(plan['add_members']) + len(plan['send_messages']))
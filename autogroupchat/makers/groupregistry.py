@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+
+from autogroupchat.atomicfile import replace_file
+
+try:
+    import fcntl
+except ImportError:
+    # no file locking on Windows, give each process its own registry file there
+    fcntl = None
+
+global logger
+logger = logging.getLogger(__name__)
+
+# registries are shared per file so concurrent makers don't overwrite
+# each other's entries
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(registry_file: str):
+    registry_file = os.path.abspath(registry_file)
+    with _registries_lock:
+        if registry_file not in _registries:
+            _registries[registry_file] = GroupRegistry(registry_file)
+        return _registries[registry_file]
+
+
+def registry_file_from_config(config: dict, config_file: str):
+    '''
+    `group_registry_file` of a maker config. It's required: a registry in a
+    directory that's wiped on restart (like the temp dir of a cloud
+    function) forgets the groups to purge and forces a full scan of the
+    account on every cold start.
+    '''
+    registry_file = config.get('group_registry_file')
+    if not registry_file:
+        raise ValueError(
+            f"{config_file} has no `group_registry_file`. Set it to a path that survives "
+            f"restarts (see configs_templates/config_groupme.json), one per GroupMe account.")
+    return os.path.expanduser(registry_file)
+
+
+class GroupRegistry:
+    '''
+    Local record of the groups autogroupchat created, stored as a JSON file:
+
+        {
+            "last_reconciled": 1700000000.0,
+            "groups": {
+                "<group_id>": {"name": str, "created_at": float, "owned": bool,
+                               "left": bool}
+            }
+        }
+
+    This lets purging only look at groups we know are ours instead of
+    listing every group on the account, and reconciling find the group made
+    earlier for the same name and date. Groups we left are kept (marked
+    `left`) until they'd have been purged, so a rerun doesn't make them
+    again.
+
+    The file may be shared by several processes (e.g. shards of one run).
+    Every change re-reads it and saves it under a lock on
+    `<registry_file>.lock`, so no process drops another's entries, and
+    reads pick up what other processes saved.
+    '''
+
+    def __init__(self, registry_file: str):
+        self.registry_file = registry_file
+        self.lock_file = f"{registry_file}.lock"
+        self.lock = threading.RLock()
+        self.groups = {}
+        self.last_reconciled = 0
+        # (mtime, size, inode) of the file as last loaded
+        self.loaded_stat = None
+        self.load()
+
+    @contextmanager
+    def file_lock(self):
+        # called with self.lock held
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_file, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self):
+        with self.lock:
+            try:
+                with open(self.registry_file) as f:
+                    stat = os.fstat(f.fileno())
+                    data = json.load(f)
+            except FileNotFoundError:
+                return
+            except ValueError:
+                logger.error(
+                    f"Group registry {self.registry_file} is corrupt, starting empty.")
+                return
+            self.groups = data.get('groups', {})
+            self.last_reconciled = data.get('last_reconciled', 0)
+            self.loaded_stat = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def refresh(self):
+        '''
+        Load the file again if another process saved it since
+        '''
+        with self.lock:
+            try:
+                stat = os.stat(self.registry_file)
+            except FileNotFoundError:
+                return
+            if (stat.st_mtime_ns, stat.st_size, stat.st_ino) != self.loaded_stat:
+                self.load()
+
+    def save(self):
+        # called with the lock and file lock held
+        data = {'last_reconciled': self.last_reconciled,
+                'groups': self.groups}
+        replace_file(self.registry_file, lambda f: json.dump(data, f, indent=4))
+        stat = os.stat(self.registry_file)
+        self.loaded_stat = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def modify(self, change):
+        '''
+        Apply `change()` to the latest registry on disk and save it if
+        `change` returns True
+        '''
+        with self.lock, self.file_lock():
+            self.load()
+            if change():
+                self.save()
+
+    def add(self, group_id: str, name: str, created_at: float=None, owned: bool=True):
+        def change():
+            self.groups[str(group_id)] = {
+                'name': name,
+                'created_at': created_at if created_at is not None else time.time(),
+                'owned': owned,
+            }
+            return True
+        self.modify(change)
+
+    def update(self, group_id: str, **fields):
+        def change():
+            if str(group_id) not in self.groups:
+                return False
+            self.groups[str(group_id)].update(fields)
+            return True
+        self.modify(change)
+
+    def remove(self, group_id: str):
+        self.modify(lambda: self.groups.pop(str(group_id), None) is not None)
+
+    def mark_left(self, group_id: str):
+        self.update(group_id, left=True)
+
+    def group_ids(self):
+        '''
+        Ids of the groups we're still in
+        '''
+        with self.lock:
+            self.refresh()
+            return {group_id for group_id, entry in self.groups.items()
+                    if not entry.get('left')}
+
+    def find(self, name: str, day: datetime.date=None):
+        '''
+        Returns (group_id, entry) of the latest group named `name` created on
+        `day` (local time, default today), or None
+        '''
+        day = day or datetime.date.today()
+        with self.lock:
+            self.refresh()
+            found = [(entry['created_at'], group_id, dict(entry))
+                     for group_id, entry in self.groups.items()
+                     if entry['name'] == name
+                     and datetime.date.fromtimestamp(entry['created_at']) == day]
+        if not found:
+            return None
+        _, group_id, entry = max(found)
+        return group_id, entry
+
+    def expired(self, group_delete_age_days: int):
+        '''
+        Returns [(group_id, entry)] for groups older than group_delete_age_days.
+        Expired groups we already left have nothing to purge, they're just
+        dropped.
+        '''
+        cutoff = time.time() - float(group_delete_age_days) * 24 * 60 * 60
+
+        def change():
+            left = [group_id for group_id, entry in self.groups.items()
+                    if entry.get('left') and entry['created_at'] < cutoff]
+            for group_id in left:
+                del self.groups[group_id]
+            return bool(left)
+
+        with self.lock:
+            self.modify(change)
+            return [(group_id, dict(entry)) for group_id, entry in self.groups.items()
+                    if entry['created_at'] < cutoff]
+
+    def needs_reconcile(self, reconcile_days: float):
+        with self.lock:
+            self.refresh()
+            return time.time() - self.last_reconciled > float(reconcile_days) * 24 * 60 * 60
+
+    def mark_reconciled(self):
+        def change():
+            self.last_reconciled = time.time()
+            return True
+        self.modify(change)
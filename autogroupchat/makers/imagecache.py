@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+from urllib.parse import urlparse
+
+import requests
+
+from autogroupchat.atomicfile import replace_file
+
+global logger
+logger = logging.getLogger(__name__)
+
+DEFAULT_IMAGE_CACHE_FILE = os.path.join(tempfile.gettempdir(), "autogroupchat_images.json")
+
+# hosts of GroupMe's image service, images there don't need uploading
+GROUPME_IMAGE_HOSTS = ("i.groupme.com", "image.groupme.com")
+
+# prefix of the cache keys of images given as a URL
+URL_KEY_PREFIX = "url:"
+
+
+def is_url(image: str):
+    return urlparse(image).scheme in ("http", "https")
+
+
+class ImageCache:
+    '''
+    Group images uploaded to the chat service, keyed by the SHA-256 of their
+    content and kept in a JSON file. Images given as a URL are also kept by
+    that URL, so they can be looked up without downloading them:
+
+        {"<sha256>": "<hosted url>", "url:<image url>": "<hosted url>"}
+
+    An image (a URL or a local file) is read once per process, and uploaded
+    only if the same content was never uploaded before, so many groups, and
+    later runs, sharing one logo reuse a single upload.
+    '''
+
+    def __init__(self, cache_file: str=DEFAULT_IMAGE_CACHE_FILE, download_timeout: float=30):
+        self.cache_file = cache_file
+        self.download_timeout = download_timeout
+        self.lock = threading.Lock()
+        self.hosted = None
+        # image as given -> hosted url, for this process
+        self.resolved = {}
+        # one lock per image so concurrent groups don't fetch it twice
+        self.image_locks = {}
+
+    def load(self):
+        # called with the lock held
+        if self.hosted is None:
+            self.hosted = {}
+            try:
+                with open(self.cache_file) as f:
+                    self.hosted = json.load(f)
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                logger.error(f"Image cache {self.cache_file} is corrupt, starting empty.")
+        return self.hosted
+
+    def save(self):
+        # called with the lock held
+        replace_file(self.cache_file, lambda f: json.dump(self.hosted, f, indent=4))
+
+    def read(self, image: str):
+        if is_url(image):
+            response = requests.get(image, timeout=self.download_timeout)
+            response.raise_for_status()
+            return response.content
+        with open(os.path.expanduser(image), 'rb') as f:
+            return f.read()
+
+    def lookup(self, image: str):
+        '''
+        Hosted URL of `image` if it was uploaded before, else None. Never
+        uploads, downloads or writes the cache: a URL is looked up by the URL
+        it was uploaded from, only a local file is read to hash its content.
+        '''
+        if not image:
+            return None
+        if urlparse(image).hostname in GROUPME_IMAGE_HOSTS:
+            return image
+        with self.lock:
+            if image in self.resolved:
+                return self.resolved[image]
+            if is_url(image):
+                return self.load().get(URL_KEY_PREFIX + image)
+        digest = hashlib.sha256(self.read(image)).hexdigest()
+        with self.lock:
+            return self.load().get(digest)
+
+    def resolve(self, image: str, upload):
+        '''
+        Hosted URL of `image`, uploading its content with `upload(data) -> url`
+        if it isn't hosted yet. Returns None if there's no image.
+        '''
+        if not image:
+            return None
+        if urlparse(image).hostname in GROUPME_IMAGE_HOSTS:
+            return image
+
+        with self.lock:
+            if image in self.resolved:
+                return self.resolved[image]
+            image_lock = self.image_locks.setdefault(image, threading.Lock())
+
+        with image_lock:
+            with self.lock:
+                if image in self.resolved:
+                    return self.resolved[image]
+
+            data = self.read(image)
+            digest = hashlib.sha256(data).hexdigest()
+            with self.lock:
+                url = self.load().get(digest)
+            if url is None:
+                logger.info(f"Uploading image {image} ({len(data)} bytes).")
+                url = upload(data)
+
+            with self.lock:
+                hosted = self.load()
+                new = {digest: url}
+                if is_url(image):
+                    new[URL_KEY_PREFIX + image] = url
+                if any(hosted.get(key) != value for key, value in new.items()):
+                    hosted.update(new)
+                    try:
+                        self.save()
+                    except OSError as e:
+                        # only an optimization, the image is uploaded again next run
+                        logger.warning(f"Could not save image cache: {e!r}")
+                self.resolved[image] = url
+            return url
+
+
+# shared per file so makers using the same file don't overwrite each other
+_image_caches = {}
+_image_caches_lock = threading.Lock()
+
+
+def get_image_cache(cache_file: str=DEFAULT_IMAGE_CACHE_FILE):
+    cache_file = os.path.abspath(cache_file)
+    with _image_caches_lock:
+        if cache_file not in _image_caches:
+            _image_caches[cache_file] = ImageCache(cache_file)
+        return _image_caches[cache_file]
@@ -0,0 +1,47 @@
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+global logger
+logger = logging.getLogger(__name__)
+
+# messages being posted at once, across all groups
+MESSAGE_WINDOW = 8
+
+
+class MessageDelivery:
+    '''
+    Posts startup messages in the background so they go out while members
+    are still being added.
+
+    GroupMe shows messages in the order it receives them, so the messages
+    of one group are posted one at a time, in order. Different groups are
+    posted to concurrently, with at most `window` messages in flight. Every
+    message gets a `source_guid` up front that's reused when it's retried,
+    so a resend after a lost response doesn't post it twice.
+    '''
+
+    def __init__(self, agc, window: int=MESSAGE_WINDOW):
+        self.agc = agc
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(window)),
+                                           thread_name_prefix="MessageDelivery")
+
+    def post_in_order(self, group, messages: list):
+        for message in messages:
+            self.agc.send_message_to_group(group, message, source_guid=uuid.uuid4().hex)
+
+    def deliver(self, group, messages: list):
+        '''
+        Start posting `messages` to `group` in order, returns a Future that's
+        done once they've all been posted
+        '''
+        return self.executor.submit(self.post_in_order, group, list(messages))
+
+    def announce(self, groups: list, message: str):
+        '''
+        Post the same message to every group. Returns one Future per group.
+        '''
+        return [self.deliver(group, [message]) for group in groups]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,183 @@
+import time
+import sqlite3
+import logging
+import threading
+import contextlib
+
+global logger
+logger = logging.getLogger(__name__)
+
+# used when a maker config has no `rate_limit` block, well under GroupMe's
+# limits so a run doesn't set off 429s before the limiter has adapted
+DEFAULT_RATE_LIMIT = {"rate": 5.0, "burst": 10.0, "max_rate": 20.0}
+
+
+class MemoryRateLimitState:
+    '''
+    Rate limiter state shared by the threads of one process
+    '''
+
+    def __init__(self, initial: dict):
+        self.state = dict(initial)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            yield self.state
+
+
+class SqliteRateLimitState:
+    '''
+    Rate limiter state in a SQLite file, shared by every process on the host
+    that points at the same file. Each update runs in an exclusive
+    transaction so processes don't hand out the same tokens.
+    '''
+
+    def __init__(self, path: str, key: str, initial: dict):
+        self.path = path
+        self.key = key
+        self.fields = list(initial)
+        self.lock = threading.Lock()
+        # autocommit mode, transactions are started explicitly below
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                          check_same_thread=False)
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, "
+                + ", ".join(f"{f} REAL" for f in self.fields) + ")")
+            self.connection.execute(
+                f"INSERT OR IGNORE INTO rate_limits (key, {', '.join(self.fields)}) VALUES (?"
+                + ", ?" * len(self.fields) + ")",
+                [key] + [initial[f] for f in self.fields])
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    f"SELECT {', '.join(self.fields)} FROM rate_limits WHERE key = ?", (self.key,)).fetchone()
+                state = dict(zip(self.fields, row))
+                yield state
+                self.connection.execute(
+                    f"UPDATE rate_limits SET {', '.join(f'{f} = ?' for f in self.fields)} WHERE key = ?",
+                    [state[f] for f in self.fields] + [self.key])
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            else:
+                self.connection.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class RateLimiter:
+    '''
+    Token bucket with an adaptive rate (AIMD).
+
+    Every API call takes a token first. Tokens refill at `rate` per second
+    up to `burst`. Each successful call raises the rate a little (about
+    `increase` per second of traffic, up to `max_rate`), and a throttled
+    call (429 or 5xx) multiplies it by `decrease_factor` (down to
+    `min_rate`), at most once per `decrease_cooldown` seconds so a burst of
+    429s only counts once.
+
+    With `state_file` the bucket lives in a SQLite file and is shared by
+    every process using that file, otherwise by the threads of this process.
+    '''
+
+    def __init__(self,
+                 key: str,
+                 rate: float=10.0,
+                 burst: float=10.0,
+                 min_rate: float=0.5,
+                 max_rate: float=50.0,
+                 increase: float=1.0,
+                 decrease_factor: float=0.5,
+                 decrease_cooldown: float=1.0,
+                 state_file: str=None):
+        self.key = key
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+
+        initial = {'tokens': burst, 'last_refill': time.time(), 'rate': rate, 'last_decrease': 0.0}
+        if state_file:
+            self.state = SqliteRateLimitState(state_file, key, initial)
+        else:
+            self.state = MemoryRateLimitState(initial)
+
+    @property
+    def rate(self):
+        with self.state.transaction() as s:
+            return s['rate']
+
+    def reserve(self):
+        '''
+        Take a token, returns how many seconds to wait before using it
+        '''
+        with self.state.transaction() as s:
+            now = time.time()
+            s['tokens'] = min(self.burst, s['tokens'] + (now - s['last_refill']) * s['rate'])
+            s['last_refill'] = now
+            # tokens go negative while callers are queued up waiting for them
+            s['tokens'] -= 1
+            if s['tokens'] >= 0:
+                return 0.0
+            return -s['tokens'] / s['rate']
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        # imported here, the sync makers don't need asyncio
+        import asyncio
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    def on_success(self):
+        with self.state.transaction() as s:
+            s['rate'] = min(self.max_rate, s['rate'] + self.increase / s['rate'])
+
+    def on_throttle(self):
+        with self.state.transaction() as s:
+            now = time.time()
+            if now - s['last_decrease'] < self.decrease_cooldown:
+                return
+            s['rate'] = max(self.min_rate, s['rate'] * self.decrease_factor)
+            s['last_decrease'] = now
+            logger.warning(f"API is throttling, slowing down to {s['rate']:.2f} requests/s.")
+
+
+# shared per (key, state file) so every maker using the same account and
+# process shares one bucket
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key: str, rate_limit_config: dict):
+    '''
+    Shared RateLimiter from the optional `rate_limit` block of a maker config,
+    e.g. {"rate": 5, "max_rate": 20, "state_file": "/tmp/groupme_rate.sqlite"}.
+    Without a block (None) DEFAULT_RATE_LIMIT is used, for this process only.
+    Returns None if the block is `false`, which turns rate limiting off.
+    '''
+    if rate_limit_config is None:
+        rate_limit_config = DEFAULT_RATE_LIMIT
+    if rate_limit_config is False:
+        return None
+    rate_limit_config = dict(rate_limit_config)
+    with _rate_limiters_lock:
+        cache_key = (key, rate_limit_config.get('state_file'))
+        if cache_key not in _rate_limiters:
+            _rate_limiters[cache_key] = RateLimiter(key, **rate_limit_config)
+        return _rate_limiters[cache_key]
@@ -0,0 +1,268 @@
+import time
+import random
+import logging
+import threading
+
+from autogroupchat.instrumentation import instrumentation
+
+global logger
+logger = logging.getLogger(__name__)
+
+
+class RetryError(Exception):
+    pass
+
+
+class RetryDeadlineExceeded(RetryError):
+    pass
+
+
+class CircuitOpenError(RetryError):
+    pass
+
+
+def get_status_code(e):
+    '''
+    Best effort at finding the HTTP status code behind an exception.
+    Works for `requests` errors and for wrappers that keep a `response`.
+    '''
+    response = getattr(e, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+class CircuitBreaker:
+    '''
+    Stops calling an API that keeps failing.
+
+    After `failure_threshold` retryable failures in a row the breaker opens
+    and every call fails fast with `CircuitOpenError`. Once `reset_timeout`
+    seconds have passed a single trial call is let through (half-open); if it
+    succeeds the breaker closes again, otherwise it re-opens.
+    '''
+
+    def __init__(self, failure_threshold: int=10, reset_timeout: float=60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(
+                    f"Circuit open after {self.failures} consecutive failures, not calling the API.")
+            # half-open: let this call through as a trial, but push the
+            # timer forward so concurrent callers keep failing fast
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.error(
+                        f"Opening circuit after {self.failures} consecutive failures.")
+                self.opened_at = time.monotonic()
+
+
+class RetryPolicy:
+    '''
+    Retry and polling policy shared by the makers.
+
+    `call` retries a function on retryable errors with exponential backoff
+    and jitter, up to `max_attempts` tries or `deadline` seconds, whichever
+    comes first. HTTP 429 and 5xx responses are retryable, any other 4xx
+    is fatal and raised immediately. Errors without a status code are retried
+    if they are instances of `retry_exceptions`. With a `rate_limiter` every
+    attempt waits for a token, and 429/5xx responses slow the limiter down.
+
+    `poll` waits for a condition (e.g. async results being ready) with the
+    same backoff instead of spinning. `call_async` and `poll_async` do the
+    same for coroutines without blocking the event loop.
+    '''
+
+    RETRYABLE_STATUS_CODES = (429,)
+
+    def __init__(self,
+                 max_attempts: int=8,
+                 base_delay: float=0.5,
+                 max_delay: float=30.0,
+                 multiplier: float=2.0,
+                 jitter: float=0.5,
+                 deadline: float=120.0,
+                 poll_interval: float=0.25,
+                 poll_max_interval: float=2.0,
+                 poll_timeout: float=60.0,
+                 retry_exceptions: tuple=(),
+                 circuit_breaker: CircuitBreaker=None,
+                 rate_limiter=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.deadline = deadline
+        self.poll_interval = poll_interval
+        self.poll_max_interval = poll_max_interval
+        self.poll_timeout = poll_timeout
+        self.retry_exceptions = tuple(retry_exceptions)
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        # optional RateLimiter every attempt takes a token from
+        self.rate_limiter = rate_limiter
+
+    @classmethod
+    def from_config(cls, config: dict, **kwargs):
+        '''
+        Build a policy from the optional `retry` block of a maker config file,
+        e.g. {"max_attempts": 5, "deadline": 60, "failure_threshold": 10}.
+        '''
+        config = dict(config or {})
+        breaker_keys = ('failure_threshold', 'reset_timeout')
+        breaker_config = {k: config.pop(k) for k in breaker_keys if k in config}
+        if breaker_config:
+            kwargs.setdefault('circuit_breaker', CircuitBreaker(**breaker_config))
+        kwargs.update(config)
+        return cls(**kwargs)
+
+    def is_throttled(self, e):
+        status_code = get_status_code(e)
+        return status_code is not None and \
+            (status_code in self.RETRYABLE_STATUS_CODES or status_code >= 500)
+
+    def is_retryable(self, e):
+        if get_status_code(e) is not None:
+            return self.is_throttled(e)
+        return isinstance(e, self.retry_exceptions)
+
+    def get_delay(self, attempt: int, base_delay: float=None, max_delay: float=None):
+        if base_delay is None:
+            base_delay = self.base_delay
+        if max_delay is None:
+            max_delay = self.max_delay
+        delay = min(max_delay, base_delay * (self.multiplier ** attempt))
+        # spread retries out so concurrent callers don't retry in lockstep
+        return delay * (1 - self.jitter * random.random())
+
+    def backoff(self, func, e, attempt: int, start: float):
+        '''
+        Bookkeeping after retryable error `e` on try number `attempt`.
+        Returns how long to sleep before the next try, or raises if the
+        attempts or the deadline are used up.
+        '''
+        self.circuit_breaker.record_failure()
+        if self.rate_limiter is not None and self.is_throttled(e):
+            self.rate_limiter.on_throttle()
+        if attempt >= self.max_attempts:
+            raise RetryError(
+                f"{func} failed after {attempt} attempts: {e!r}") from e
+        delay = self.get_delay(attempt - 1)
+        if time.monotonic() - start + delay > self.deadline:
+            raise RetryDeadlineExceeded(
+                f"{func} did not succeed within {self.deadline}s: {e!r}") from e
+        logger.debug(
+            f"{func} raised {e!r}, retry {attempt} in {delay:.2f}s")
+        instrumentation.record_retry()
+        return delay
+
+    def poll_backoff(self, condition, attempt: int, start: float, timeout: float):
+        delay = self.get_delay(attempt, self.poll_interval, self.poll_max_interval)
+        if time.monotonic() - start + delay > timeout:
+            raise RetryDeadlineExceeded(
+                f"{condition} was not ready within {timeout}s")
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        start = time.monotonic()
+        attempt = 0
+        while 1:
+            self.circuit_breaker.before_call()
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                retval = func(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    raise
+                attempt += 1
+                time.sleep(self.backoff(func, e, attempt, start))
+            else:
+                self.circuit_breaker.record_success()
+                if self.rate_limiter is not None:
+                    self.rate_limiter.on_success()
+                return retval
+
+    def poll(self, condition, timeout: float=None):
+        '''
+        Call `condition` until it returns something truthy, sleeping with
+        backoff in between. Raises `RetryDeadlineExceeded` on timeout.
+        '''
+        if timeout is None:
+            timeout = self.poll_timeout
+        start = time.monotonic()
+        attempt = 0
+        while 1:
+            instrumentation.record_poll()
+            retval = self.call(condition)
+            if retval:
+                return retval
+            delay = self.poll_backoff(condition, attempt, start, timeout)
+            attempt += 1
+            time.sleep(delay)
+
+    async def call_async(self, func, *args, **kwargs):
+        '''
+        `call` for coroutine functions, sleeps without blocking the event loop
+        '''
+        # imported here, the sync makers don't need asyncio
+        import asyncio
+
+        start = time.monotonic()
+        attempt = 0
+        while 1:
+            self.circuit_breaker.before_call()
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async()
+            try:
+                retval = await func(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    raise
+                attempt += 1
+                await asyncio.sleep(self.backoff(func, e, attempt, start))
+            else:
+                self.circuit_breaker.record_success()
+                if self.rate_limiter is not None:
+                    self.rate_limiter.on_success()
+                return retval
+
+    async def poll_async(self, condition, timeout: float=None):
+        '''
+        `poll` for a coroutine function `condition`
+        '''
+        import asyncio
+
+        if timeout is None:
+            timeout = self.poll_timeout
+        start = time.monotonic()
+        attempt = 0
+        while 1:
+            instrumentation.record_poll()
+            retval = await self.call_async(condition)
+            if retval:
+                return retval
+            delay = self.poll_backoff(condition, attempt, start, timeout)
+            attempt += 1
+            await asyncio.sleep(delay)
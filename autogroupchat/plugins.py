@@ -0,0 +1,82 @@
+'''
+Registry of scrapers and makers by name.
+
+Classes are registered as "module:attribute" strings and only imported the
+first time they're asked for, so naming a maker in a config doesn't import
+every other maker (and its API client) too. Third party packages can add
+their own under the `autogroupchat.makers` and `autogroupchat.scrapers`
+entry point groups.
+'''
+import logging
+import importlib
+import threading
+from importlib.metadata import entry_points
+
+global logger
+logger = logging.getLogger(__name__)
+
+MAKERS_ENTRY_POINT_GROUP = "autogroupchat.makers"
+SCRAPERS_ENTRY_POINT_GROUP = "autogroupchat.scrapers"
+
+MAKERS = {
+    "AutoMakeGroupMe": "autogroupchat.makers.automakegroupme:AutoMakeGroupMe",
+    "AsyncAutoMakeGroupMe": "autogroupchat.makers.asyncautomakegroupme:AsyncAutoMakeGroupMe",
+}
+
+SCRAPERS = {
+    "AutoScrapeGoogleSheets": "autogroupchat.scrapers.autoscrapegooglesheets:AutoScrapeGoogleSheets",
+}
+
+_lock = threading.RLock()
+
+
+def register_maker(name: str, target):
+    # target is a class or a "module:attribute" string
+    MAKERS[name] = target
+
+
+def register_scraper(name: str, target):
+    # target is a class or a "module:attribute" string
+    SCRAPERS[name] = target
+
+
+def _load(registry: dict, entry_point_group: str, name: str):
+    with _lock:
+        target = registry.get(name)
+        if target is None:
+            # not built in, look for a plugin package providing it
+            for entry_point in entry_points(group=entry_point_group, name=name):
+                target = entry_point.value
+                break
+        if target is None:
+            return None
+        if isinstance(target, str):
+            module_name, _, attribute = target.partition(":")
+            logger.debug(f"Importing {name} from {module_name}")
+            target = getattr(importlib.import_module(module_name), attribute)
+            registry[name] = target
+        return target
+
+
+def get_maker_class(name):
+    from autogroupchat.makers.automakegroupchat import AutoMakeGroupChat
+
+    # turn string into class with validation of subclass and existence
+    gc_class = name if not isinstance(name, str) else _load(MAKERS, MAKERS_ENTRY_POINT_GROUP, name)
+    if not gc_class:
+        raise Exception(
+            f"Invalid group creation class: args.group_creation_class={name}, gc_class={gc_class}")
+    assert issubclass(
+        gc_class, AutoMakeGroupChat) and "gc_class must be subclass of AutoGroupChat"
+    return gc_class
+
+
+def get_scraper_class(name):
+    from autogroupchat.scrapers.autoscrapegroup import AutoScrapeGroup
+
+    scraper_class = name if not isinstance(name, str) else _load(SCRAPERS, SCRAPERS_ENTRY_POINT_GROUP, name)
+    if not scraper_class:
+        raise Exception(f"Invalid scraper class: {name}")
+    assert issubclass(
+        scraper_class, AutoScrapeGroup) and "scraper_class must be subclass of AutoScrapeGroup"
+    return scraper_class
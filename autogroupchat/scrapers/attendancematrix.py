@@ -0,0 +1,98 @@
+import sys
+import logging
+
+import numpy as np
+import pandas as pd
+
+global logger
+logger = logging.getLogger(__name__)
+
+# rows 0 and 1 of a date column hold its date and time, marks start below
+FIRST_MARK_ROW = 2
+
+
+def header_text(cell):
+    # cells of padded rows are None or NaN
+    if cell is None or (not isinstance(cell, str) and pd.isna(cell)):
+        return ''
+    return sys.intern(str(cell))
+
+
+class AttendanceColumn:
+    '''
+    A date column of the sheet: its date and time as typed, and the sheet
+    rows marked in it
+    '''
+    __slots__ = ('date', 'time', 'rows')
+
+    def __init__(self, date: str, time: str, rows):
+        self.date = date
+        self.time = time
+        self.rows = rows
+
+
+class AttendanceMatrix:
+    '''
+    The date columns of a sheet compiled to one bit per (row, date) cell.
+
+    `bits[i]` holds the marks of date column `i`, packed 8 rows to a byte,
+    so a year of dates for 50,000 rows takes about 2MB instead of a
+    DataFrame of Python strings. Dates are parsed once into `dates`, and the
+    date and time headers as typed are kept as interned strings. Names and
+    phones live in the ContactIndex, rows are looked up there.
+    '''
+
+    def __init__(self, columns, labels: list, times: list, dates, bits, num_rows: int):
+        # sheet column of each date column
+        self.columns = columns
+        self.labels = labels
+        self.times = times
+        # datetime64[D], one per date column
+        self.dates = dates
+        # uint8, (number of dates, number of rows / 8)
+        self.bits = bits
+        self.num_rows = num_rows
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame, dates: pd.Series):
+        '''
+        Compile the columns of `df` whose header parsed to a date in
+        `dates` (see parse_header). A cell that isn't empty is a mark.
+        '''
+        dates = dates.dropna()
+        columns = dates.index.to_numpy()
+        labels = [header_text(cell) for cell in df.iloc[0][columns]]
+        if len(df) > 1:
+            times = [header_text(cell) for cell in df.iloc[1][columns]]
+        else:
+            times = [''] * len(columns)
+
+        marks = df[columns].iloc[FIRST_MARK_ROW:].to_numpy(dtype=object)
+        # same test as Series.fillna('').astype(bool) on string cells
+        marked = pd.notna(marks) & (marks != '')
+        bits = np.packbits(marked.T, axis=1)
+        return cls(columns, labels, times, dates.to_numpy(dtype='datetime64[D]'),
+                   bits, marks.shape[0])
+
+    def __len__(self):
+        return len(self.columns)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes + self.dates.nbytes + self.columns.nbytes
+
+    def due(self, day):
+        '''
+        Positions of the date columns for `day`, in sheet order
+        '''
+        return np.flatnonzero(self.dates == np.datetime64(day, 'D'))
+
+    def rows(self, i: int):
+        '''
+        Sheet rows marked in date column `i`
+        '''
+        marked = np.unpackbits(self.bits[i], count=self.num_rows)
+        return np.flatnonzero(marked) + FIRST_MARK_ROW
+
+    def column(self, i: int):
+        return AttendanceColumn(self.labels[i], self.times[i], self.rows(i))
@@ -1,77 +1,460 @@
-import sys
+import re
 import json
 import os.path
 import logging
 import argparse
 import datetime
-import pandas as pd
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-import gspread
+from autogroupchat.plugins import get_maker_class
+from autogroupchat.instrumentation import instrumentation, configure_from_config
+from autogroupchat.scrapers.autoscrapegroup import AutoScrapeGroup, parse_header
+from autogroupchat.scrapers.snapshotcache import get_snapshot_cache
+from autogroupchat.scrapers.credentialcache import (get_gspread_client, get_key_cache, open_spreadsheet,
+                                                    DEFAULT_CACHE_DIR)
 
-from autogroupchat.makers.automakegroupchat import AutoMakeGroupChat
-from autogroupchat.makers.automakegroupme import AutoMakeGroupMe
-from autogroupchat.scrapers.autoscrapegroup import AutoScrapeGroup
+# pandas, gspread and the makers are imported where they're used, so a cold
+# start only pays for them once a run needs them (see scrape_using_dict)
 
 # requires spreadsheets and drive scopes
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly',
           'https://www.googleapis.com/auth/drive.readonly']
 
+# sheets narrower than this are always downloaded whole
+SELECTIVE_FETCH_MIN_COLUMNS = 50
+
 global logger
 logger = logging.getLogger(__name__)
 
 
+def column_letters(col: int):
+    # 0 based column number to A1 letters, e.g. 27 -> AB
+    from gspread.utils import rowcol_to_a1
+
+    return re.sub(r"\d", "", rowcol_to_a1(1, col + 1))
+
+
+def column_spans(columns):
+    '''
+    Merge sorted column numbers into (first, last) spans of adjacent columns
+    '''
+    spans = []
+    for col in columns:
+        if spans and spans[-1][1] == col - 1:
+            spans[-1][1] = col
+        else:
+            spans.append([col, col])
+    return spans
+
+
+def values_to_df(values):
+    '''
+    DataFrame from either a list of rows, or {"columns": [[col, cells], ...]}
+    as downloaded by a column selective fetch. Columns keep their position in
+    the sheet as their label.
+    '''
+    import pandas as pd
+
+    if isinstance(values, dict):
+        columns = values['columns']
+        num_rows = max([len(cells) for col, cells in columns], default=0)
+        # pad with None like DataFrame(rows) does for short rows
+        return pd.DataFrame({int(col): cells + [None] * (num_rows - len(cells))
+                             for col, cells in columns}, dtype=object)
+    return pd.DataFrame(values)
+
+
 class AutoScrapeGoogleSheets(AutoScrapeGroup):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, force_refresh: bool=False, snapshot_dir: str=None,
+                 gspread_client=None, values: list=None, selective_fetch: bool=True,
+                 selective_fetch_min_columns: int=SELECTIVE_FETCH_MIN_COLUMNS,
+                 credential_cache_dir: str=DEFAULT_CACHE_DIR, **kwargs):
+        # set before super().__init__ because it may call auth and get_df.
+        # gspread_client and values let a batch run share one client and
+        # pass in values it already downloaded
+        self.force_refresh = force_refresh
+        self.snapshot_cache = get_snapshot_cache(snapshot_dir)
+        self.gspread_client = gspread_client
+        self.values = values
+        self.selective_fetch = selective_fetch
+        self.selective_fetch_min_columns = selective_fetch_min_columns
+        self.credential_cache_dir = credential_cache_dir
+        # (key, modified time) of the snapshot the sheet came from
+        self.snapshot_key = None
         super(AutoScrapeGoogleSheets, self).__init__(*args, **kwargs)
 
     def auth(self):
-        self.gspread_client = gspread.service_account(filename=self.api_config_file, scopes=SCOPES)
+        if self.gspread_client is None:
+            # shared client, reusing its access token and HTTP session
+            self.gspread_client = get_gspread_client(self.api_config_file, SCOPES,
+                                                     self.credential_cache_dir)
+        # record the HTTP status of every call for metrics
+        hooks = self.gspread_client.http_client.session.hooks['response']
+        if instrumentation.response_hook not in hooks:
+            hooks.append(instrumentation.response_hook)
 
     def get_df(self):
-        spreadsheet = self.gspread_client.open(self.spreadsheet)
-        worksheet = spreadsheet.worksheet(self.spreadsheet_worksheet)
-        values = worksheet.get(self.spreadsheet_range)
+        if self.values is not None:
+            values = self.values
+            if self.attendance_matrix:
+                # only the compiled sheet is kept
+                self.values = None
+            if not values:
+                print(
+                    f'No data found in spreadsheet `{self.spreadsheet}` sheet `{self.spreadsheet_worksheet}` range `{self.spreadsheet_range}`.')
+                return
+            return values_to_df(values)
+
+        spreadsheet = open_spreadsheet(self.gspread_client, self.spreadsheet,
+                                       get_key_cache(self.credential_cache_dir))
+
+        # only download the values if the file changed since the last snapshot.
+        # Which columns a selective fetch keeps depends on the day, so those
+        # snapshots are only good for the day they were taken
+        selective = self.selective_fetch and not self.spreadsheet_range
+        key = (self.spreadsheet, self.spreadsheet_worksheet, self.spreadsheet_range)
+        if selective:
+            key += (datetime.date.today().isoformat(),)
+        modified_time = spreadsheet.get_lastUpdateTime()
+
+        if self.attendance_matrix and not self.force_refresh:
+            compiled = self.snapshot_cache.get_compiled(key, modified_time)
+            if compiled is not None:
+                logger.info(
+                    f"Spreadsheet `{self.spreadsheet}` unchanged since {modified_time}, using its attendance matrix.")
+                self.info, self.contacts, self.attendance = compiled
+                return None
+
+        # with attendance_matrix only the compiled sheet stays in memory
+        remember = not self.attendance_matrix
+        self.snapshot_key = (key, modified_time)
+        snapshot = None
+        if not self.force_refresh:
+            snapshot = self.snapshot_cache.get(key, modified_time, remember=remember)
+
+        if snapshot:
+            values, df = snapshot
+            logger.info(
+                f"Spreadsheet `{self.spreadsheet}` unchanged since {modified_time}, using snapshot. "
+                f"Snapshot cache {self.snapshot_cache.stats()}")
+        else:
+            worksheet = spreadsheet.worksheet(self.spreadsheet_worksheet)
+            if selective and worksheet.col_count >= self.selective_fetch_min_columns:
+                values = self.get_selected_columns(spreadsheet, worksheet)
+            else:
+                values = list(worksheet.get(self.spreadsheet_range))
+            df = None
 
         if not values:
             print(
                 f'No data found in spreadsheet `{self.spreadsheet}` sheet `{self.spreadsheet_worksheet}` range `{self.spreadsheet_range}`.')
             return
 
-        df = pd.DataFrame(values)
+        if snapshot is None:
+            df = values_to_df(values)
+            self.snapshot_cache.put(key, modified_time, values, df, remember=remember)
+        elif df is None:
+            # snapshot came from disk, keep the DataFrame for warm invocations
+            df = values_to_df(values)
+            if remember:
+                self.snapshot_cache.set_df(key, df)
         return df
 
+    def attendance_compiled(self):
+        # warm invocations reuse the compiled sheet while it's unchanged
+        if self.snapshot_key is not None:
+            key, modified_time = self.snapshot_key
+            self.snapshot_cache.put_compiled(key, modified_time,
+                                             (self.info, self.contacts, self.attendance))
+
+    def get_selected_columns(self, spreadsheet, worksheet):
+        '''
+        Two phase fetch for wide sheets: download the header row, then only
+        the key/value and name/phone blocks and the columns dated today, in
+        one batched request. Returns {"columns": [[col, cells], ...]}, or an
+        empty dict if the sheet has no header.
+        '''
+        import pandas as pd
+        from gspread.utils import absolute_range_name
+
+        header_rows = worksheet.get("1:1")
+        if not header_rows or not header_rows[0]:
+            return {}
+        labels, dates = parse_header(pd.Series(header_rows[0]))
+
+        columns = set(dates.index[dates == pd.Timestamp(datetime.date.today())])
+        for label in ("key", "name"):
+            for col in labels.index[labels == label]:
+                # value and phone are in the column to the right
+                columns.update((col, col + 1))
+
+        spans = column_spans(sorted(columns))
+        ranges = [absolute_range_name(worksheet.title, f"{column_letters(first)}:{column_letters(last)}")
+                  for first, last in spans]
+        value_ranges = spreadsheet.values_batch_get(
+            ranges, params={'majorDimension': 'COLUMNS'}).get('valueRanges', []) if ranges else []
+
+        selected = []
+        for (first, last), value_range in zip(spans, value_ranges):
+            span_columns = value_range.get('values', [])
+            for col in range(first, last + 1):
+                cells = span_columns[col - first] if col - first < len(span_columns) else []
+                selected.append([col, list(cells)])
+        logger.info(
+            f"Spreadsheet `{self.spreadsheet}`: downloaded {len(selected)} of {len(header_rows[0])} columns.")
+        return {'columns': selected}
+
+
+def import_maker_class(name: str):
+    '''
+    Import pandas and the maker class `name` with its API client, the
+    modules a run needs once the sheet is downloaded
+    '''
+    import pandas  # noqa: F401
+    return get_maker_class(name)
+
 
 def scrape_using_dict(args):
-    # turn string into class with validation of subclass and existence
-    gc_class_string = args['group_creation_class']
-    gc_class = getattr(sys.modules[__name__], gc_class_string, None)
-    if not gc_class:
-        raise Exception(
-            f"Invalid group creation class: args.group_creation_class={gc_class_string}, gc_class={gc_class}")
-    assert issubclass(
-        gc_class, AutoMakeGroupChat) and "gc_class must be subclass of AutoGroupChat"
+    from autogroupchat.scrapers.groupleases import get_group_leases
+
+    # import the maker while the sheet downloads, most of the fetch is
+    # waiting on the network
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        maker_class = executor.submit(import_maker_class, args['group_creation_class'])
+
+        asg = AutoScrapeGoogleSheets(
+            spreadsheet=args['spreadsheet'],
+            spreadsheet_worksheet=args['worksheet'],
+            spreadsheet_range=args['range'],
+            api_config=args['api_config'],
+            scopes=args['scopes'],
+            force_refresh=args.get('force_refresh', False),
+            snapshot_dir=args.get('snapshot_dir'),
+            selective_fetch=args.get('selective_fetch', True),
+            credential_cache_dir=args.get('credential_cache_dir', DEFAULT_CACHE_DIR),
+            attendance_matrix=args.get('attendance_matrix', False),
+            lazy=True)
+        asg.fetch()
 
-    # overwrite arg field with the actual class after validation
-    args['group_creation_class'] = gc_class
+        # overwrite arg field with the actual class after validation
+        args['group_creation_class'] = maker_class.result()
 
-    asg = AutoScrapeGoogleSheets(
-        spreadsheet=args['spreadsheet'],
-        spreadsheet_worksheet=args['worksheet'],
-        spreadsheet_range=args['range'],
-        api_config=args['api_config'],
-        scopes=args['scopes'])
+    # optional `sharding` block, shares the groups with other processes
+    leases = get_group_leases(args.get('sharding'))
+    try:
+        return asg.create_groups(args['group_creation_class'],
+                                 args['group_creation_config'],
+                                 max_workers=args.get('max_workers', 1),
+                                 # one shard purging is enough
+                                 purge=leases is None or leases.shard == 0,
+                                 reconcile=args.get('reconcile', False),
+                                 dry_run=args.get('dry_run', False),
+                                 leases=leases)
+    finally:
+        if leases is not None:
+            leases.close()
 
-    asg.create_groups(args['group_creation_class'],
-                      args['group_creation_config'],)
+
+def scrape_shard(args, log_level):
+    # runs in a child process of scrape_sharded_using_dict
+    from autogroupchat.makers.automakegroupchat import close_makers
+
+    logging.basicConfig(level=log_level, format=f'[{log_level}] %(message)s')
+    try:
+        summary = scrape_using_dict(args)
+    finally:
+        close_makers()
+    # groups are API objects that don't survive pickling
+    return [dict(r, group=None) for r in summary]
+
+
+def scrape_sharded_using_dict(args, processes: int):
+    '''
+    Run `scrape_using_dict` in `processes` processes, each its own shard of
+    the groups due today (see autogroupchat/scrapers/groupleases.py).
+    Returns the summaries of every process, groups another process built
+    are marked `skipped`.
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    sharding = dict(args.get('sharding') or {}, num_shards=processes)
+    if not sharding.get('lease_file'):
+        sharding['lease_file'] = os.path.join(tempfile.gettempdir(), "autogroupchat_leases.sqlite")
+    log_level = logging.getLogger().getEffectiveLevel()
+    # spawn rather than fork, the parent may have threads and open connections
+    with ProcessPoolExecutor(max_workers=processes,
+                             mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(scrape_shard, dict(args, sharding=dict(sharding, shard=shard)), log_level)
+                   for shard in range(processes)]
+        return [future.result() for future in futures]
+
+
+def fetch_spreadsheet_values(gspread_client, spreadsheet_name, jobs, force_refresh=False, snapshot_dir=None,
+                             credential_cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    Download the ranges of every job in one spreadsheet with a single batched
+    request. Ranges with a fresh snapshot aren't downloaded again.
+    Returns a list of values, one per job.
+    '''
+    from gspread.utils import absolute_range_name
+
+    snapshot_cache = get_snapshot_cache(snapshot_dir)
+    spreadsheet = open_spreadsheet(gspread_client, spreadsheet_name, get_key_cache(credential_cache_dir))
+    modified_time = spreadsheet.get_lastUpdateTime()
+
+    values = [None] * len(jobs)
+    keys = [(spreadsheet_name, job.get('worksheet', 'Sheet1'), job.get('range', '')) for job in jobs]
+    if not force_refresh:
+        for i, key in enumerate(keys):
+            snapshot = snapshot_cache.get(key, modified_time)
+            if snapshot:
+                values[i] = snapshot[0]
+
+    to_fetch = [i for i, v in enumerate(values) if v is None]
+    if to_fetch:
+        ranges = [absolute_range_name(keys[i][1], keys[i][2] or None) for i in to_fetch]
+        value_ranges = spreadsheet.values_batch_get(ranges).get('valueRanges', [])
+        for i, value_range in zip(to_fetch, value_ranges):
+            values[i] = value_range.get('values', [])
+            snapshot_cache.put(keys[i], modified_time, values[i],
+                               remember=not jobs[i].get('attendance_matrix', False))
+    logger.info(
+        f"Spreadsheet `{spreadsheet_name}`: downloaded {len(to_fetch)} of {len(jobs)} ranges. "
+        f"Snapshot cache {snapshot_cache.stats()}")
+    return values
+
+
+def scrape_spreadsheet_jobs(gspread_client, spreadsheet_name, jobs):
+    reports = [{'spreadsheet': spreadsheet_name,
+                'worksheet': job.get('worksheet', 'Sheet1'),
+                'range': job.get('range', ''),
+                'success': False,
+                'groups': [],
+                'error': None} for job in jobs]
+    try:
+        values = fetch_spreadsheet_values(gspread_client, spreadsheet_name, jobs,
+                                          force_refresh=jobs[0].get('force_refresh', False),
+                                          snapshot_dir=jobs[0].get('snapshot_dir'),
+                                          credential_cache_dir=jobs[0].get('credential_cache_dir',
+                                                                           DEFAULT_CACHE_DIR))
+    except Exception as e:
+        logger.exception(f"Error fetching spreadsheet `{spreadsheet_name}`: {e!r}")
+        for report in reports:
+            report['error'] = repr(e)
+        return reports
+
+    for i, (job, report) in enumerate(zip(jobs, reports)):
+        # hand the values over, the scraper decides whether to keep them
+        job_values, values[i] = values[i], None
+        try:
+            asg = AutoScrapeGoogleSheets(
+                spreadsheet=spreadsheet_name,
+                spreadsheet_worksheet=report['worksheet'],
+                spreadsheet_range=report['range'],
+                api_config=job['api_config'],
+                scopes=job['scopes'],
+                gspread_client=gspread_client,
+                values=job_values,
+                attendance_matrix=job.get('attendance_matrix', False),
+                lazy=True)
+            report['groups'] = asg.create_groups(job['group_creation_class'],
+                                                 job['group_creation_config'],
+                                                 max_workers=job.get('max_workers', 1),
+                                                 purge=False,
+                                                 reconcile=job.get('reconcile', False),
+                                                 dry_run=job.get('dry_run', False))
+            report['success'] = all(g['success'] for g in report['groups'])
+        except Exception as e:
+            logger.exception(
+                f"Error scraping `{spreadsheet_name}` sheet `{report['worksheet']}` range `{report['range']}`: {e!r}")
+            report['error'] = repr(e)
+    return reports
+
+
+def scrape_batch_using_dict(args):
+    '''
+    Scrape many rosters in one run. `args` takes the same keys as
+    `scrape_using_dict` plus `batch`, a list of dicts that override them per
+    roster (usually `spreadsheet`, `worksheet` and `range`).
+
+    Ranges in the same spreadsheet are downloaded with one batched request,
+    different spreadsheets are scraped concurrently (`spreadsheet_workers`),
+    and old groups are purged once at the end. Returns one report per roster.
+    '''
+    jobs = []
+    for job in args['batch']:
+        job = dict(args, **job)
+        job.pop('batch')
+        job['group_creation_class'] = get_maker_class(job['group_creation_class'])
+        jobs.append(job)
+
+    # one authorized client per credentials file, shared with later runs
+    # in this process (see credentialcache)
+    gspread_clients = {}
+    for job in jobs:
+        if job['api_config'] not in gspread_clients:
+            gspread_clients[job['api_config']] = get_gspread_client(
+                job['api_config'], SCOPES, job.get('credential_cache_dir', DEFAULT_CACHE_DIR))
+
+    # group jobs by spreadsheet, keeping their order
+    spreadsheets = {}
+    for job in jobs:
+        spreadsheets.setdefault((job['api_config'], job['spreadsheet']), []).append(job)
+
+    reports = []
+    with ThreadPoolExecutor(max_workers=max(1, int(args.get('spreadsheet_workers', 4)))) as executor:
+        futures = [executor.submit(scrape_spreadsheet_jobs, gspread_clients[api_config],
+                                   spreadsheet_name, spreadsheet_jobs)
+                   for (api_config, spreadsheet_name), spreadsheet_jobs in spreadsheets.items()]
+        for future in futures:
+            reports.extend(future.result())
+
+    # purge old groups once per maker config
+    from autogroupchat.makers.automakegroupchat import get_maker
+
+    makers = {(job['group_creation_class'], job['group_creation_config']): job for job in jobs}
+    for (gc_class, gc_config), job in makers.items():
+        if job.get('dry_run'):
+            continue
+        try:
+            get_maker(gc_class, gc_config).purge_groups(
+                group_delete_age_days=job.get('group_delete_age_days', 30))
+        except Exception as e:
+            logger.exception(f"Error purging old groups: {e!r}")
+
+    failed = [(r['spreadsheet'], r['worksheet'], r['range']) for r in reports if not r['success']]
+    logger.info(f"Scraped {len(reports) - len(failed)} of {len(reports)} rosters successfully.")
+    if failed:
+        logger.error(f"Failed rosters: {failed}")
+    return reports
 
 
 def run(args):
+    from autogroupchat.makers.automakegroupchat import close_makers
+
     args_dict = args.__dict__
 
     # remove func key because it isnt serializable
     args_dict.pop('func')
 
-    scrape_using_dict(args_dict)
+    configure_from_config(args_dict.pop('metrics', None))
+    processes = args_dict.pop('processes')
+    lease_file = args_dict.pop('lease_file')
+    shard = args_dict.pop('shard')
+    num_shards = args_dict.pop('num_shards')
+    if lease_file:
+        args_dict['sharding'] = {'lease_file': lease_file, 'shard': shard, 'num_shards': num_shards}
+    try:
+        if processes > 1:
+            scrape_sharded_using_dict(args_dict, processes)
+        else:
+            scrape_using_dict(args_dict)
+    finally:
+        instrumentation.flush()
+        # release the shared maker clients' connections
+        close_makers()
 
 
 if __name__ == '__main__':
@@ -89,6 +472,28 @@ if __name__ == '__main__':
                         default="AutoMakeGroupMe")
     parser.add_argument("--group-creation-config",
                         default=f"{os.path.dirname(__file__)}/../../configs/config_groupme.json")
+    parser.add_argument("--force-refresh", action='store_true',
+                        help="download the sheet even if a snapshot is fresh")
+    parser.add_argument("--snapshot-dir", default=None,
+                        help="where to keep spreadsheet snapshots between runs")
+    parser.add_argument("--full-fetch", dest="selective_fetch", action='store_false',
+                        help="download the whole sheet instead of only the columns needed today")
+    parser.add_argument("--metrics-json", dest="metrics", type=lambda path: {"json_summary": path},
+                        help="write a JSON summary of timings, retries and HTTP statuses to this file")
+    parser.add_argument("--max-workers", type=int, default=1,
+                        help="number of groups to create in parallel")
+    parser.add_argument("--reconcile", action='store_true',
+                        help="reuse groups already made today, only doing what's missing from them")
+    parser.add_argument("--dry-run", action='store_true',
+                        help="log what would be done to each group without changing anything")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="split the groups between this many processes on this host")
+    parser.add_argument("--lease-file", default=None,
+                        help="SQLite file shared by processes splitting the groups between them")
+    parser.add_argument("--shard", type=int, default=0,
+                        help="this process's shard, from 0 to --num-shards - 1")
+    parser.add_argument("--num-shards", type=int, default=1,
+                        help="number of processes splitting the groups")
     parser.set_defaults(func=run)
 
     args = parser.parse_args(["<spreadsheet_id>"])
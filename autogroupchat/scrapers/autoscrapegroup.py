@@ -2,13 +2,33 @@ import json
 import os.path
 import logging
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from autogroupchat.instrumentation import instrumentation
+from autogroupchat.scrapers.contactindex import ContactIndex, DEFAULT_COUNTRY_CODE
+
+# pandas, the makers and the attendance matrix are imported where they're
+# used, so importing the scrapers stays cheap on a cold start
 
 global logger
 logger = logging.getLogger(__name__)
 
 
+def parse_header(header):
+    '''
+    Lower cased labels and parsed dates of a header row (a Series). Anything
+    that isn't a date becomes NaT, which never compares equal to a date.
+    '''
+    import pandas as pd
+
+    labels = header.astype("string").str.lower().fillna("")
+    dates = pd.to_datetime(header.where(labels != ""), format='%m/%d/%Y', errors='coerce')
+    return labels, dates
+
+
 class AutoScrapeGroup:
-    def __init__(self, spreadsheet, spreadsheet_worksheet, spreadsheet_range, api_config, token_config=None, scopes=None, *args, **kwargs):
+    def __init__(self, spreadsheet, spreadsheet_worksheet, spreadsheet_range, api_config, token_config=None, scopes=None, *args, lazy: bool=False,
+                 attendance_matrix: bool=False, **kwargs):
         self.spreadsheet = spreadsheet
         self.spreadsheet_worksheet = spreadsheet_worksheet
         self.spreadsheet_range = spreadsheet_range
@@ -21,14 +41,21 @@ class AutoScrapeGroup:
             self.token_config_file = f"{filename}_token{os.path.extsep}{ext}"
 
         self.args = args
-        self.auth()
-        self.df = self.get_df()
-
+        self.df = None
         self.info = {}
         self.groups_to_create = []
-        self.contacts = {}
+        self.contacts = ContactIndex((), (), ())
+        # with attendance_matrix=True the sheet is compiled to an
+        # AttendanceMatrix and the DataFrame dropped once it's parsed
+        self.attendance_matrix = attendance_matrix
+        self.attendance = None
+        self.fetched = False
+        self.parsed = False
 
-        self.process_df()
+        # with lazy=True nothing is fetched until the groups are asked for,
+        # see iter_groups
+        if not lazy:
+            self.load()
 
     def auth(self):
         raise NotImplementedError
@@ -36,97 +63,304 @@ class AutoScrapeGroup:
     def get_df(self):
         raise NotImplementedError
 
+    def fetch(self):
+        if self.fetched:
+            return
+        with instrumentation.span("scraper.auth", spreadsheet=self.spreadsheet):
+            self.auth()
+        with instrumentation.span("scraper.get_df", spreadsheet=self.spreadsheet):
+            self.df = self.get_df()
+        self.fetched = True
+
+    def load(self):
+        '''
+        Fetch and parse the whole sheet, filling `info`, `contacts` and
+        `groups_to_create`
+        '''
+        if self.parsed:
+            return
+        self.fetch()
+        with instrumentation.span("scraper.process_df", spreadsheet=self.spreadsheet):
+            self.process_df()
+        self.parsed = True
+
     def process_df(self):
-        for col in self.df:
-            self.process_column(col)
-
-    def create_groups(self, clazz, cls_config_file):
-        for group in self.groups_to_create:
-            group_metadata = self.info.copy()
-            date = group[0]
-            group_metadata['date'] = date if date else ''
-            time = group[1]
-            group_metadata['time'] = time if time else ''
-            group_metadata['group_name_unformatted'] = group_metadata['group_name']
-            group_metadata['group_name'] = group_metadata['group_name'].format(
-                date=group_metadata['date'], time=group_metadata['time'])
-            # if date or time were empty, replace double space with single.
-            group_metadata['group_name'] = group_metadata['group_name'].replace('  ', ' ')
-            # if only one startup message, convert it to a list from a string
-            startup_messages_list = group_metadata.get('startup_messages', [])
-            if isinstance(startup_messages_list, str):
-                startup_messages_list = [startup_messages_list]
-            group_metadata['startup_messages'] = [i.format(**group_metadata) 
-                                                  for i in startup_messages_list]
-
-            members = {}
-            # ignore the first two lines, they hold date and time respectively
-            for row in range(2, len(group)):
-                # if cell isn't empty, it's a mark that the person is included
-                if group[row]:
-                    member = self.contacts.get(row, {})  # defaults to empty so update doesnt fail
-                    # member is a dictionary, and we want to add it to members
-                    # so we use the update method to add/update.
-                    members.update(member)
-
-            group_metadata['members'] = members
-            logger.info("group_metadata = " +
-                        json.dumps(group_metadata, indent=4))
+        self.groups_to_create = list(self.iter_due_columns())
+
+    def iter_due_columns(self):
+        '''
+        Classify every header cell at once: key/value info, name/phone
+        contacts and date columns. Dates are parsed with one vectorized
+        conversion and compared against a single `today`.
+
+        `info` and `contacts` are set before the first column is yielded,
+        then each column due today is yielded as soon as it's found.
+
+        With `attendance_matrix` the sheet is compiled and the DataFrame
+        dropped first, and the due columns come from the matrix. If
+        `get_df` already set a compiled sheet there's nothing to parse.
+        '''
+        import pandas as pd
+        from autogroupchat.scrapers.attendancematrix import AttendanceMatrix
+
+        today = pd.Timestamp(datetime.date.today())
+
+        if self.attendance is None:
+            if self.df is None or self.df.empty:
+                return
+
+            labels, dates = parse_header(self.df.iloc[0])
+
+            for col in labels.index[labels == "key"]:
+                self.info = self.get_keyvalue_info(col)
+            for col in labels.index[labels == "name"]:
+                self.contacts = self.get_contacts(col)
+
+            if self.attendance_matrix:
+                with instrumentation.span("scraper.compile_attendance", spreadsheet=self.spreadsheet):
+                    self.attendance = AttendanceMatrix.from_df(self.df, dates)
+                # every cell needed is in info, contacts and the matrix now
+                self.df = None
+                self.attendance_compiled()
+
+        if self.attendance is not None:
+            for i in self.attendance.due(today):
+                logger.info(
+                    f"Column for date {self.attendance.dates[i]} is today, creating group.")
+                yield self.attendance.column(i)
+            return
+
+        for col in dates.index[dates < today]:
+            logger.debug(
+                f"Column for date {dates[col]} is already passed, not creating group.")
+        for col in dates.index[dates > today]:
+            logger.debug(
+                f"Column for date {dates[col]} is not today, waiting on creating group.")
+        for col in dates.index[dates == today]:
             logger.info(
-                f"Calling {clazz}.group_startup for group named {group_metadata['group_name']}")
-            logger.debug(f"group_metadata={group_metadata}")
-            clazz.group_startup(clazz,
-                                cls_config_file,
-                                group_metadata['group_name'],
-                                group_metadata['members'],
-                                group_metadata.get('admin', {}),
-                                group_metadata.get('startup_messages', []),
-                                group_metadata.get('image', ''),
-                                group_metadata.get('description', ''),
-                                group_metadata.get('dont_leave_group', True),
-                                group_metadata.get('group_delete_age_days', 30),)
-
-    def process_column(self, col_num):
-        column = self.df[col_num]
-        if not isinstance(column[0], str):
-            pass
-        elif column[0].lower() == "key":
-            self.info = self.get_keyvalue_info(col_num)
-        elif column[0].lower() == "value":
-            # this is processed with key
-            pass
-        elif column[0].lower() == "name":
-            self.contacts = self.get_contacts(col_num)
-        elif column[0].lower() == "number":
-            # this is processed with name
-            pass
+                f"Column for date {dates[col]} is today, creating group.")
+            yield self.df[col]
+
+    def attendance_compiled(self):
+        '''
+        Called once the sheet is compiled to `attendance`, e.g. to cache it
+        '''
+        pass
+
+    def iter_groups(self):
+        '''
+        Yield the metadata of each group due today. If the sheet wasn't
+        loaded yet it's fetched now and each group is yielded as soon as its
+        column is parsed, so its maker can start while the rest of the
+        sheet is still being processed.
+        '''
+        if self.parsed:
+            for group in self.groups_to_create:
+                yield self.get_group_metadata(group)
+            return
+
+        self.fetch()
+        self.groups_to_create = []
+        for group in self.iter_due_columns():
+            self.groups_to_create.append(group)
+            yield self.get_group_metadata(group)
+        self.parsed = True
+
+    def get_group_metadata(self, group):
+        from autogroupchat.scrapers.attendancematrix import AttendanceColumn
+
+        group_metadata = self.info.copy()
+        if isinstance(group, AttendanceColumn):
+            date, time, rows = group.date, group.time, group.rows
         else:
+            date, time = group[0], group[1]
+            # ignore the first two lines, they hold date and time respectively
+            marks = group.iloc[2:]
+            # if cell isn't empty, it's a mark that the person is included
+            rows = marks.index[marks.fillna('').astype(bool)]
+        group_metadata['date'] = date if date else ''
+        group_metadata['time'] = time if time else ''
+        group_metadata['group_name_unformatted'] = group_metadata['group_name']
+        group_metadata['group_name'] = group_metadata['group_name'].format(
+            date=group_metadata['date'], time=group_metadata['time'])
+        # if date or time were empty, replace double space with single.
+        group_metadata['group_name'] = group_metadata['group_name'].replace('  ', ' ')
+        # if only one startup message, convert it to a list from a string
+        startup_messages_list = group_metadata.get('startup_messages', [])
+        if isinstance(startup_messages_list, str):
+            startup_messages_list = [startup_messages_list]
+        group_metadata['startup_messages'] = [i.format(**group_metadata) 
+                                              for i in startup_messages_list]
+
+        group_metadata['members'] = self.contacts.members(rows)
+        return group_metadata
+
+    def start_group(self, clazz, cls_config_file, group_metadata, reconcile: bool=False,
+                    dry_run: bool=False):
+        logger.info("group_metadata = " +
+                    json.dumps(group_metadata, indent=4))
+        logger.info(
+            f"Calling {clazz}.group_startup for group named {group_metadata['group_name']}")
+        logger.debug(f"group_metadata={group_metadata}")
+        with instrumentation.span("scraper.group_startup", group=group_metadata['group_name']):
+            return clazz.group_startup(clazz,
+                                       cls_config_file,
+                                       group_metadata['group_name'],
+                                       group_metadata['members'],
+                                       group_metadata.get('admin', {}),
+                                       group_metadata.get('startup_messages', []),
+                                       group_metadata.get('image', ''),
+                                       group_metadata.get('description', ''),
+                                       group_metadata.get('dont_leave_group', True),
+                                       group_metadata.get('group_delete_age_days', 30),
+                                       purge=False,
+                                       reconcile=reconcile,
+                                       dry_run=dry_run)
+
+    def start_leased_group(self, leases, key: str, *args):
+        '''
+        `start_group` under a lease on the group. Returns (claimed, group),
+        claimed is False if another process has it or already built it.
+
+        The group is only marked built when `start_group` returns one. On
+        an error, or with no group (e.g. it was already made and left), the
+        lease is released right away rather than held until it expires.
+        '''
+        if not leases.claim(key):
+            logger.info(f"Group {key} is claimed by another process, skipping.")
+            return False, None
+        completed = False
+        try:
+            group = self.start_group(*args)
+            if group is not None:
+                leases.complete(key)
+                completed = True
+            return True, group
+        finally:
+            if not completed:
+                leases.release(key)
+
+    def create_groups(self, clazz, cls_config_file, max_workers: int=1, purge: bool=True,
+                      announcement: str=None, reconcile: bool=False, dry_run: bool=False,
+                      leases=None):
+        '''
+        Create every group due today, fetching and parsing the sheet first
+        if that hasn't happened yet.
+
+        Each group's startup chain (create, add members, send messages) runs
+        in order, but independent groups run in parallel on up to
+        `max_workers` threads. A failed group is logged and reported without
+        stopping the others. Old groups are purged once at the end unless
+        `purge` is False. Returns one summary dict per group, in sheet order.
+
+        `announcement` (or an `announcement` key in the sheet) is posted to
+        every group that was created, all in one batch once they exist.
+
+        With `reconcile`, groups already made today are reused and only
+        brought up to date. With `dry_run` nothing is changed, each summary
+        gets the `plan` of what would be done instead.
+
+        With `leases` (see autogroupchat.scrapers.groupleases) the groups are
+        shared with other processes: this one builds its own shard's groups
+        first, then unclaimed ones from other shards, and a group another
+        process claimed is reported as `skipped`.
+        '''
+        # already loaded with `clazz`, see plugins.get_maker_class
+        from autogroupchat.makers.automakegroupchat import get_maker
+        from autogroupchat.scrapers.groupleases import group_key
+
+        if dry_run:
+            # a dry run changes nothing, so there's nothing to claim
+            leases = None
+
+        summary = []
+        with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+            # submit each group as it's parsed instead of parsing them all first
+            submitted = []
+            other_shards = []
+            for i, group_metadata in enumerate(self.iter_groups()):
+                if leases is None:
+                    submitted.append((i, group_metadata, executor.submit(
+                        self.start_group, clazz, cls_config_file, group_metadata, reconcile, dry_run)))
+                    continue
+                key = group_key(self.spreadsheet, self.spreadsheet_worksheet,
+                                datetime.date.today(), group_metadata['group_name'])
+                if leases.owns_shard(key):
+                    submitted.append((i, group_metadata, executor.submit(
+                        self.start_leased_group, leases, key, clazz, cls_config_file,
+                        group_metadata, reconcile, dry_run)))
+                else:
+                    other_shards.append((i, key, group_metadata))
+            if leases is not None and leases.steal:
+                # help with the other shards once ours are all started
+                for i, key, group_metadata in other_shards:
+                    submitted.append((i, group_metadata, executor.submit(
+                        self.start_leased_group, leases, key, clazz, cls_config_file,
+                        group_metadata, reconcile, dry_run)))
+
+            for i, group_metadata, future in sorted(submitted, key=lambda s: s[0]):
+                result = {'group_name': group_metadata['group_name'],
+                          'success': False,
+                          'group': None,
+                          'error': None}
+                try:
+                    if dry_run:
+                        result['plan'] = future.result()
+                    elif leases is not None:
+                        claimed, result['group'] = future.result()
+                        result['skipped'] = not claimed
+                    else:
+                        result['group'] = future.result()
+                    result['success'] = True
+                except Exception as e:
+                    logger.exception(
+                        f"Error creating group named {group_metadata['group_name']}: {e!r}")
+                    result['error'] = repr(e)
+                summary.append(result)
+
+        if dry_run:
+            logger.info(f"Planned {len(summary)} groups, nothing was changed.")
+            return summary
+
+        announcement = announcement or self.info.get('announcement')
+        # no group if it was already made and left earlier today
+        created = [r for r in summary if r['success'] and r['group'] is not None]
+        if announcement and created:
             try:
-                date = datetime.datetime.strptime(column[0], '%m/%d/%Y')
-            except ValueError:
-                return
+                with instrumentation.span("maker.announce"):
+                    posted = get_maker(clazz, cls_config_file).send_message_to_groups(
+                        [r['group'] for r in created], announcement)
+                for result, announced in zip(created, posted):
+                    result['announced'] = announced
+            except Exception as e:
+                logger.exception(f"Error sending announcement: {e!r}")
 
-            # if it is not already passed
-            if date.date() < datetime.date.today():
-                logger.debug(
-                    f"Column for date {date} is already passed, not creating group.")
-                pass
-            # if it is scheduled for today
-            elif (date.date() - datetime.date.today()) < datetime.timedelta(days=1):
-                logger.info(
-                    f"Column for date {date} is today, creating group.")
-                self.groups_to_create.append(column)
-            else:
-                logger.debug(
-                    f"Column for date {date} is not today, waiting on creating group.")
+        # purge old groups once per run rather than once per group
+        if purge:
+            try:
+                with instrumentation.span("maker.purge_groups"):
+                    get_maker(clazz, cls_config_file).purge_groups(
+                        group_delete_age_days=self.info.get('group_delete_age_days', 30))
+            except Exception as e:
+                logger.exception(f"Error purging old groups: {e!r}")
+
+        failed = [r['group_name'] for r in summary if not r['success']]
+        skipped = sum(1 for r in summary if r.get('skipped'))
+        logger.info(
+            f"Created {len(summary) - len(failed) - skipped} of {len(summary)} groups"
+            + (f", {skipped} built by other processes." if skipped else "."))
+        if failed:
+            logger.error(f"Failed to create groups: {failed}")
+        return summary
 
     def get_keyvalue_info(self, col_num):
         assert self.df[col_num][0].lower() == "key" and \
             self.df[col_num + 1][0].lower() == "value"
 
         info = {}
-        keys = self.df[col_num]
-        values = self.df[col_num + 1]
+        # plain lists, indexing a Series cell by cell is slow
+        keys = self.df[col_num].tolist()
+        values = self.df[col_num + 1].tolist()
         last_key = ""
         # iterate to longer of keys or values
         for i in range(1, max(len(keys), len(values))):
@@ -149,11 +383,13 @@ class AutoScrapeGroup:
         assert self.df[col_num][0].lower() == "name" and \
             self.df[col_num + 1][0].lower() == "phone"
 
-        contacts = {}
         names = self.df[col_num]
         phones = self.df[col_num + 1]
-        for i in range(1, len(names)):
-            if names[i] and phones[i]:
-                contacts[i] = {names[i]: phones[i]}
-        logger.info("contacts = " + json.dumps(contacts, indent=4))
+        # skip the header row and any row missing a name or phone
+        has_contact = names.fillna('').astype(bool) & phones.fillna('').astype(bool)
+        has_contact.iloc[0] = False
+        contacts = ContactIndex(names.index[has_contact], names[has_contact], phones[has_contact],
+                                default_country_code=str(self.info.get('default_country_code', DEFAULT_COUNTRY_CODE)))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("contacts = " + json.dumps(contacts.to_dict(), indent=4))
         return contacts
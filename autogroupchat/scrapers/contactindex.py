@@ -0,0 +1,133 @@
+import re
+import sys
+import logging
+import operator
+from array import array
+from collections.abc import Mapping
+
+global logger
+logger = logging.getLogger(__name__)
+
+DEFAULT_COUNTRY_CODE = "1"
+
+NON_DIGITS = re.compile(r"\D")
+
+
+def normalize_phone(phone, default_country_code: str=DEFAULT_COUNTRY_CODE):
+    '''
+    Normalize a phone number as typed in a sheet to E.164 (+<country><number>).
+    Numbers without a leading `+` or `00` are taken to be national numbers in
+    `default_country_code`. Returns None if it can't be a valid number.
+    '''
+    if phone is None:
+        return None
+    phone = str(phone).strip()
+    digits = NON_DIGITS.sub("", phone)
+    if phone.startswith("+"):
+        pass
+    elif digits.startswith("00"):
+        digits = digits[2:]
+    else:
+        # drop a national trunk prefix, e.g. 07911 123456 in the UK
+        if default_country_code != "1":
+            digits = digits.lstrip("0")
+        if not digits.startswith(default_country_code) or \
+                (default_country_code == "1" and len(digits) == 10):
+            digits = default_country_code + digits
+
+    # E.164 allows at most 15 digits and country codes never start with 0
+    if not 8 <= len(digits) <= 15 or digits.startswith("0"):
+        return None
+    # North American numbers are always 1 + 10 digits
+    if digits.startswith("1") and len(digits) != 11:
+        return None
+    return "+" + digits
+
+
+class ContactIndex(Mapping):
+    '''
+    The roster of a sheet, built once and shared by every group of the day.
+
+    Phones are normalized to E.164 up front. Rows with a number that can't be
+    normalized are kept in `invalid` instead of being sent to the API, and
+    rows repeating a number already in the roster point at the first
+    contact with that number (listed in `duplicates`).
+
+    Names and phones are interned strings in two lists, and `row_slots` is an
+    array from sheet row to position in those lists (-1 for no contact).
+    As a mapping it keeps the old `{row: {name: phone}}` shape.
+    '''
+
+    def __init__(self, rows, names, phones, default_country_code: str=DEFAULT_COUNTRY_CODE):
+        self.names = []
+        self.phones = []
+        # row -> (name, phone as typed) for numbers that failed validation
+        self.invalid = {}
+        # row -> row of the first contact with the same number
+        self.duplicates = {}
+
+        rows = [operator.index(row) for row in rows]
+        self.row_slots = array('l', [-1]) * (max(rows, default=-1) + 1)
+        slot_by_phone = {}
+        first_row_by_phone = {}
+        for row, name, phone in zip(rows, names, phones):
+            normalized = normalize_phone(phone, default_country_code)
+            if normalized is None:
+                self.invalid[row] = (name, phone)
+                continue
+            slot = slot_by_phone.get(normalized)
+            if slot is None:
+                slot = slot_by_phone[normalized] = len(self.names)
+                first_row_by_phone[normalized] = row
+                self.names.append(sys.intern(str(name)))
+                self.phones.append(sys.intern(normalized))
+            else:
+                self.duplicates[row] = first_row_by_phone[normalized]
+            self.row_slots[row] = slot
+
+        for row, (name, phone) in self.invalid.items():
+            logger.warning(f"Row {row}: '{name}' has an invalid phone number '{phone}', not adding them to groups.")
+        for row, first_row in self.duplicates.items():
+            logger.warning(
+                f"Row {row}: phone number {self.phones[self.row_slots[row]]} is already used on row {first_row}, "
+                f"adding '{self.names[self.row_slots[row]]}' once.")
+
+    def slot(self, row):
+        try:
+            # sheet rows may come in as numpy integers
+            row = operator.index(row)
+        except TypeError:
+            return -1
+        if 0 <= row < len(self.row_slots):
+            return self.row_slots[row]
+        return -1
+
+    def __getitem__(self, row):
+        slot = self.slot(row)
+        if slot < 0:
+            raise KeyError(row)
+        return {self.names[slot]: self.phones[slot]}
+
+    def __iter__(self):
+        return (row for row, slot in enumerate(self.row_slots) if slot >= 0)
+
+    def __len__(self):
+        return sum(1 for slot in self.row_slots if slot >= 0)
+
+    def members(self, rows):
+        '''
+        {name: phone} for the contacts on `rows`, each number at most once.
+        Rows with an invalid number are logged and left out.
+        '''
+        slots = {}
+        for row in rows:
+            slot = self.slot(row)
+            if slot >= 0:
+                slots[slot] = None
+            elif row in self.invalid:
+                name, phone = self.invalid[row]
+                logger.warning(f"Not adding '{name}', invalid phone number '{phone}'.")
+        return {self.names[slot]: self.phones[slot] for slot in slots}
+
+    def to_dict(self):
+        return {row: self[row] for row in self}
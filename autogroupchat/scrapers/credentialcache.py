@@ -0,0 +1,193 @@
+'''
+Google credentials and spreadsheet lookups that outlive one scrape.
+
+`gspread.service_account` builds new credentials every time, so each
+scraper exchanged its key for a new access token, and `open(title)` listed
+Drive files to find the spreadsheet before every fetch. Here:
+
+ * one authorized gspread client (and its HTTP session) is kept per
+   credentials file and scopes, for warm invocations and batch runs
+ * access tokens are saved to `cache_dir` and reused by later processes
+   until they expire, so a new process skips the token endpoint too
+ * spreadsheet title -> key lookups are saved to `cache_dir`, so the
+   spreadsheet is opened by key without searching Drive
+
+The token files are only readable by the current user.
+'''
+import os
+import json
+import hashlib
+import logging
+import datetime
+import tempfile
+import threading
+
+from autogroupchat.atomicfile import replace_file
+
+global logger
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "autogroupchat_credentials")
+
+# shared per (credentials file, its mtime, scopes)
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def write_private_json(path: str, data: dict):
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    replace_file(path, lambda f: json.dump(data, f),
+                 opener=lambda tmp_path, flags: os.open(tmp_path, flags, 0o600))
+
+
+def token_path(credentials, cache_dir: str):
+    digest = hashlib.sha256(json.dumps(
+        [credentials.service_account_email, sorted(credentials.scopes or [])]).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f"token_{digest[:32]}.json")
+
+
+def load_token(credentials, path: str):
+    '''
+    Put a saved, unexpired access token on `credentials`. Returns whether
+    there was one.
+    '''
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+        credentials.token = saved['token']
+        # google-auth keeps expiry as naive UTC
+        credentials.expiry = datetime.datetime.fromisoformat(saved['expiry'])
+    except (OSError, ValueError, KeyError):
+        return False
+    if not credentials.valid:
+        credentials.token = None
+        return False
+    return True
+
+
+def save_tokens(credentials, path: str):
+    '''
+    Save the access token every time `credentials` are refreshed
+    '''
+    refresh = credentials.refresh
+
+    def refresh_and_save(request):
+        refresh(request)
+        try:
+            write_private_json(path, {'token': credentials.token,
+                                      'expiry': credentials.expiry.isoformat()})
+        except OSError as e:
+            # only an optimization, the next process gets a new token
+            logger.warning(f"Could not save access token: {e!r}")
+
+    credentials.refresh = refresh_and_save
+
+
+def get_gspread_client(api_config_file: str, scopes: list, cache_dir: str=DEFAULT_CACHE_DIR):
+    '''
+    Shared gspread client authorized with the service account in
+    `api_config_file`. A new one is made if the file changed, e.g. when the
+    key was rotated.
+    '''
+    # gspread and google-auth are only imported once a client is needed
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    api_config_file = os.path.abspath(api_config_file)
+    key = (api_config_file, os.stat(api_config_file).st_mtime_ns, tuple(scopes))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            credentials = Credentials.from_service_account_file(api_config_file, scopes=scopes)
+            if cache_dir:
+                path = token_path(credentials, cache_dir)
+                if load_token(credentials, path):
+                    logger.debug(f"Reusing saved access token for {credentials.service_account_email}.")
+                save_tokens(credentials, path)
+            client = _clients[key] = gspread.Client(auth=credentials)
+        return client
+
+
+class SpreadsheetKeyCache:
+    '''
+    Spreadsheet title -> key, per service account, in memory and in a JSON
+    file in `cache_dir`
+    '''
+
+    def __init__(self, cache_dir: str=DEFAULT_CACHE_DIR):
+        self.path = os.path.join(cache_dir, "spreadsheet_keys.json") if cache_dir else None
+        self.lock = threading.Lock()
+        self.keys = None
+
+    def load(self):
+        # called with the lock held
+        if self.keys is None:
+            self.keys = {}
+            if self.path:
+                try:
+                    with open(self.path) as f:
+                        self.keys = json.load(f)
+                except (OSError, ValueError):
+                    pass
+        return self.keys
+
+    def get(self, account: str, title: str):
+        with self.lock:
+            return self.load().get(f"{account}/{title}")
+
+    def put(self, account: str, title: str, key: str=None):
+        '''
+        Remember the key of `title`, or forget it if key is None
+        '''
+        with self.lock:
+            keys = self.load()
+            if key is None:
+                if keys.pop(f"{account}/{title}", None) is None:
+                    return
+            else:
+                if keys.get(f"{account}/{title}") == key:
+                    return
+                keys[f"{account}/{title}"] = key
+            if self.path:
+                try:
+                    write_private_json(self.path, keys)
+                except OSError as e:
+                    logger.warning(f"Could not save spreadsheet keys: {e!r}")
+
+
+_key_caches = {}
+_key_caches_lock = threading.Lock()
+
+
+def get_key_cache(cache_dir: str=DEFAULT_CACHE_DIR):
+    with _key_caches_lock:
+        if cache_dir not in _key_caches:
+            _key_caches[cache_dir] = SpreadsheetKeyCache(cache_dir)
+        return _key_caches[cache_dir]
+
+
+def open_spreadsheet(gspread_client, title: str, key_cache: SpreadsheetKeyCache=None):
+    '''
+    `gspread_client.open(title)`, but by key when the key of `title` is
+    known. Falls back to searching Drive if the cached key is gone or the
+    spreadsheet was renamed.
+    '''
+    from gspread.exceptions import SpreadsheetNotFound
+
+    key_cache = key_cache or get_key_cache()
+    credentials = getattr(gspread_client.http_client, 'auth', None)
+    account = getattr(credentials, 'service_account_email', None) or ''
+    key = key_cache.get(account, title)
+    if key:
+        try:
+            spreadsheet = gspread_client.open_by_key(key)
+            if spreadsheet.title == title:
+                return spreadsheet
+        except (SpreadsheetNotFound, PermissionError):
+            pass
+        logger.info(f"Cached key of spreadsheet `{title}` is stale, searching Drive.")
+        key_cache.put(account, title, None)
+
+    spreadsheet = gspread_client.open(title)
+    key_cache.put(account, title, spreadsheet.id)
+    return spreadsheet
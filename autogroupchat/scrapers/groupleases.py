@@ -0,0 +1,210 @@
+'''
+Splitting the groups due today between several processes or hosts.
+
+Every process scrapes the same sheet with the same lease file and its own
+shard number:
+
+    python -m autogroupchat.scrapers.autoscrapegooglesheets ... --lease-file leases.sqlite --shard 0 --num-shards 4
+
+Each group belongs to one shard, picked by a stable hash of the spreadsheet,
+worksheet, date and group name, and a process starts with the groups of its
+own shard. Before building a group it takes a lease on it in the SQLite
+lease file, and marks it done afterwards, so a group is only built once no
+matter how many processes see it. With `steal` (the default) a process that
+runs out of its own groups goes on to the other shards' groups that nobody
+has claimed yet, so a slow or missing process doesn't hold the others up.
+
+Leases are renewed while a group is being built. If a process dies its
+leases expire after `lease_seconds` and the group is free to be built by
+the next run (which should use `--reconcile` to finish it rather than
+start over). Groups that failed are released right away.
+
+All processes must see the same lease file. SQLite locking isn't reliable
+on network file systems, so hosts should share one through a local disk
+(e.g. run the processes on one VM) rather than NFS.
+'''
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import hashlib
+import logging
+import datetime
+import threading
+
+global logger
+logger = logging.getLogger(__name__)
+
+
+def group_key(spreadsheet: str, worksheet: str, day: datetime.date, group_name: str):
+    return json.dumps([spreadsheet, worksheet, day.isoformat(), group_name])
+
+
+def shard_of(key: str, num_shards: int):
+    '''
+    Stable shard of a group key, the same in every process (unlike hash())
+    '''
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16) % num_shards
+
+
+class GroupLeases:
+    '''
+    Claims on groups in a SQLite file shared by every process of a run
+    '''
+
+    def __init__(self,
+                 lease_file: str,
+                 shard: int=0,
+                 num_shards: int=1,
+                 lease_seconds: float=600,
+                 steal: bool=True):
+        if not 0 <= int(shard) < int(num_shards):
+            raise ValueError(f"shard must be between 0 and {int(num_shards) - 1}, got {shard}")
+        self.lease_file = lease_file
+        self.shard = int(shard)
+        self.num_shards = int(num_shards)
+        self.lease_seconds = float(lease_seconds)
+        self.steal = steal
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self.lock = threading.Lock()
+        # keys we hold a lease on, renewed by the heartbeat thread
+        self.held = set()
+        self.heartbeat = None
+        self.stopping = threading.Event()
+
+        # autocommit mode, transactions are started explicitly
+        self.connection = sqlite3.connect(lease_file, timeout=30, isolation_level=None,
+                                          check_same_thread=False)
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS group_leases ("
+                "group_key TEXT PRIMARY KEY, "
+                "owner TEXT NOT NULL, "
+                "state TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 1, "
+                "updated_at REAL NOT NULL)")
+
+    def owns_shard(self, key: str):
+        return shard_of(key, self.num_shards) == self.shard
+
+    def transaction(self, func, *args):
+        # run func(*args) in an exclusive transaction, with the lock held
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            return result
+
+    def _claim(self, key: str):
+        now = time.time()
+        row = self.connection.execute(
+            "SELECT owner, state, expires_at FROM group_leases WHERE group_key = ?", (key,)).fetchone()
+        if row is None:
+            self.connection.execute(
+                "INSERT INTO group_leases (group_key, owner, state, expires_at, updated_at) "
+                "VALUES (?, ?, 'leased', ?, ?)", (key, self.owner, now + self.lease_seconds, now))
+            return True
+        owner, state, expires_at = row
+        if state == 'done':
+            return False
+        if owner != self.owner and expires_at > now:
+            return False
+        if owner != self.owner:
+            logger.warning(f"Lease on {key} held by {owner} expired, taking it over.")
+        self.connection.execute(
+            "UPDATE group_leases SET owner = ?, state = 'leased', expires_at = ?, "
+            "attempts = attempts + 1, updated_at = ? WHERE group_key = ?",
+            (self.owner, now + self.lease_seconds, now, key))
+        return True
+
+    def claim(self, key: str):
+        '''
+        Take the lease on a group. Returns False if it's done or another
+        process holds it.
+        '''
+        claimed = self.transaction(self._claim, key)
+        if claimed:
+            with self.lock:
+                self.held.add(key)
+            self.start_heartbeat()
+        return claimed
+
+    def _finish(self, key: str, done: bool):
+        if done:
+            self.connection.execute(
+                "UPDATE group_leases SET state = 'done', updated_at = ? WHERE group_key = ? AND owner = ?",
+                (time.time(), key, self.owner))
+        else:
+            self.connection.execute(
+                "DELETE FROM group_leases WHERE group_key = ? AND owner = ? AND state = 'leased'",
+                (key, self.owner))
+
+    def complete(self, key: str):
+        '''
+        Mark a group built, nobody builds it again
+        '''
+        self.transaction(self._finish, key, True)
+        with self.lock:
+            self.held.discard(key)
+
+    def release(self, key: str):
+        '''
+        Give up the lease after a failure so the group can be tried again
+        '''
+        self.transaction(self._finish, key, False)
+        with self.lock:
+            self.held.discard(key)
+
+    def _renew(self, keys: list):
+        expires_at = time.time() + self.lease_seconds
+        for key in keys:
+            self.connection.execute(
+                "UPDATE group_leases SET expires_at = ?, updated_at = ? "
+                "WHERE group_key = ? AND owner = ? AND state = 'leased'",
+                (expires_at, time.time(), key, self.owner))
+
+    def renew(self):
+        with self.lock:
+            keys = list(self.held)
+        if keys:
+            self.transaction(self._renew, keys)
+
+    def start_heartbeat(self):
+        with self.lock:
+            if self.heartbeat is not None:
+                return
+            self.heartbeat = threading.Thread(target=self.run_heartbeat, name="GroupLeases", daemon=True)
+            self.heartbeat.start()
+
+    def run_heartbeat(self):
+        while not self.stopping.wait(self.lease_seconds / 3):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logger.error(f"Could not renew group leases: {e!r}")
+
+    def close(self):
+        self.stopping.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+        with self.lock:
+            self.connection.close()
+
+
+def get_group_leases(sharding_config: dict):
+    '''
+    GroupLeases from the optional `sharding` block of a scraper config,
+    e.g. {"lease_file": "/var/lib/autogroupchat/leases.sqlite", "shard": 0, "num_shards": 4}.
+    Returns None if there's no such block.
+    '''
+    if not sharding_config or not sharding_config.get('lease_file'):
+        return None
+    return GroupLeases(**sharding_config)
@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+
+from autogroupchat.atomicfile import replace_file
+
+global logger
+logger = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_DIR = os.path.join(tempfile.gettempdir(), "autogroupchat_snapshots")
+
+
+class SnapshotCache:
+    '''
+    Cache of spreadsheet values keyed by (spreadsheet, worksheet, range).
+
+    Each snapshot remembers the spreadsheet's modified time when it was taken
+    and is only used while that still matches. Snapshots are kept in memory
+    (with the DataFrame built from them, so warm invocations skip rebuilding
+    it) and on disk in `snapshot_dir` (raw values only).
+
+    Scrapers that compile the sheet to an attendance matrix pass
+    remember=False, so their values and DataFrame stay on disk only, and
+    keep the compiled sheet in memory instead (see put_compiled).
+    '''
+
+    def __init__(self, snapshot_dir: str=DEFAULT_SNAPSHOT_DIR):
+        self.snapshot_dir = snapshot_dir
+        self.memory = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, key: tuple):
+        digest = hashlib.sha1(json.dumps(list(key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.snapshot_dir, f"{digest}.json")
+
+    def get(self, key: tuple, modified_time: str, remember: bool=True):
+        '''
+        Returns (values, df) for a fresh snapshot, df may be None if it was
+        only found on disk. Returns None on a miss. A snapshot found on
+        disk is kept in memory unless `remember` is False.
+        '''
+        with self.lock:
+            snapshot = self.memory.get(key)
+            if snapshot is None or 'values' not in snapshot:
+                snapshot = self.load(key)
+            if snapshot is None or snapshot['modified_time'] != modified_time:
+                self.misses += 1
+                return None
+            if remember:
+                self.memory[key] = snapshot
+            self.hits += 1
+            return snapshot['values'], snapshot.get('df')
+
+    def put(self, key: tuple, modified_time: str, values: list, df=None, remember: bool=True):
+        snapshot = {'modified_time': modified_time, 'values': values, 'df': df}
+        with self.lock:
+            if remember:
+                self.memory[key] = snapshot
+            try:
+                os.makedirs(self.snapshot_dir, exist_ok=True)
+                path = self.get_path(key)
+                replace_file(path, lambda f: json.dump(
+                    {'modified_time': modified_time, 'values': values}, f))
+            except OSError as e:
+                # the disk copy is only an optimization
+                logger.warning(f"Could not write snapshot for {key}: {e!r}")
+
+    def get_compiled(self, key: tuple, modified_time: str):
+        '''
+        The compiled sheet put with put_compiled, or None if there's none
+        for this modified time
+        '''
+        with self.lock:
+            snapshot = self.memory.get(key)
+            if snapshot is None or snapshot['modified_time'] != modified_time \
+                    or 'compiled' not in snapshot:
+                return None
+            self.hits += 1
+            return snapshot['compiled']
+
+    def put_compiled(self, key: tuple, modified_time: str, compiled):
+        # replaces the values and DataFrame in memory, the disk copy stays
+        with self.lock:
+            self.memory[key] = {'modified_time': modified_time, 'compiled': compiled}
+
+    def set_df(self, key: tuple, df):
+        with self.lock:
+            if key in self.memory:
+                self.memory[key]['df'] = df
+
+    def load(self, key: tuple):
+        try:
+            with open(self.get_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+# shared across scrapers so warm invocations reuse it
+_snapshot_caches = {}
+_snapshot_caches_lock = threading.Lock()
+
+
+def get_snapshot_cache(snapshot_dir: str=None):
+    snapshot_dir = os.path.abspath(snapshot_dir or DEFAULT_SNAPSHOT_DIR)
+    with _snapshot_caches_lock:
+        if snapshot_dir not in _snapshot_caches:
+            _snapshot_caches[snapshot_dir] = SnapshotCache(snapshot_dir)
+        return _snapshot_caches[snapshot_dir]
@@ -0,0 +1,443 @@
+'''
+Long running worker for hosts that run autogroupchat on a VM instead of
+cloud functions.
+
+Jobs are the same config dicts the Pub/Sub function takes (see
+configs_templates/config_googlesheets_groupme.json), queued in a SQLite
+file. The worker stays resident, so pandas/gspread/groupy are imported
+once, and the Google Sheets and maker clients stay authorized and keep
+their connections between jobs.
+
+    # run the worker, 2 jobs at a time
+    python -m autogroupchat.worker run --queue /var/lib/autogroupchat/jobs.sqlite -c 2
+
+    # queue a job, e.g. from cron
+    python -m autogroupchat.worker enqueue --queue /var/lib/autogroupchat/jobs.sqlite \
+        configs/config_googlesheets_groupme.json
+
+SIGTERM/SIGINT stop taking new jobs and wait for the running ones to
+finish. Health and latency stats are logged every `stats_interval` seconds
+and, with `--health-file`, written there as JSON. Several workers can
+share one queue, each job is leased to its worker and only run again if
+the lease runs out (see JobQueue).
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import signal
+import sqlite3
+import logging
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from autogroupchat.atomicfile import replace_file
+
+global logger
+logger = logging.getLogger(__name__)
+
+# latencies kept for the percentiles in the stats
+LATENCY_WINDOW = 1000
+
+
+class JobQueue:
+    '''
+    Jobs in a SQLite file. Every worker and `enqueue` pointing at the same
+    file shares the queue, a job is claimed by one worker only.
+
+    A running job is leased to the worker that claimed it for
+    `lease_seconds`, and the worker renews the lease while the job runs.
+    Only jobs whose lease expired, because their worker died, are put back
+    in the queue, so starting another worker doesn't rerun jobs in flight.
+    '''
+
+    def __init__(self, path: str, lease_seconds: float=300):
+        self.path = path
+        self.lease_seconds = float(lease_seconds)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lock = threading.Lock()
+        # autocommit mode, transactions are started explicitly
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                          check_same_thread=False)
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "payload TEXT NOT NULL, "
+                "state TEXT NOT NULL DEFAULT 'queued', "
+                "enqueued_at REAL NOT NULL, "
+                "started_at REAL, "
+                "finished_at REAL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "error TEXT, "
+                "owner TEXT, "
+                "lease_expires_at REAL)")
+            # queues made before jobs had leases
+            columns = {row[1] for row in self.connection.execute("PRAGMA table_info(jobs)")}
+            for column, column_type in (("owner", "TEXT"), ("lease_expires_at", "REAL")):
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+
+    def transaction(self, func, *args):
+        # run func(*args) in an exclusive transaction, with the lock held
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            return result
+
+    def put(self, job: dict):
+        '''
+        Queue a job, returns its id
+        '''
+        with self.lock:
+            return self.connection.execute(
+                "INSERT INTO jobs (payload, enqueued_at) VALUES (?, ?)",
+                (json.dumps(job), time.time())).lastrowid
+
+    def _claim(self):
+        row = self.connection.execute(
+            "SELECT id, payload, enqueued_at FROM jobs WHERE state = 'queued' "
+            "ORDER BY id LIMIT 1").fetchone()
+        if row is not None:
+            now = time.time()
+            self.connection.execute(
+                "UPDATE jobs SET state = 'running', started_at = ?, attempts = attempts + 1, "
+                "owner = ?, lease_expires_at = ? WHERE id = ?",
+                (now, self.owner, now + self.lease_seconds, row[0]))
+        return row
+
+    def claim(self):
+        '''
+        Take the oldest queued job, returns (job_id, job, enqueued_at) or None
+        '''
+        row = self.transaction(self._claim)
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def renew(self, job_ids: list):
+        '''
+        Extend the leases on our running jobs
+        '''
+        if not job_ids:
+            return
+        expires_at = time.time() + self.lease_seconds
+        with self.lock:
+            self.connection.executemany(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND owner = ? AND state = 'running'",
+                [(expires_at, job_id, self.owner) for job_id in job_ids])
+
+    def finish(self, job_id: int, error: str=None):
+        # a job whose lease expired and was requeued isn't ours to finish
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET state = ?, finished_at = ?, error = ?, lease_expires_at = NULL "
+                "WHERE id = ? AND owner = ? AND state = 'running'",
+                ('failed' if error else 'done', time.time(), error, job_id, self.owner))
+
+    def requeue_expired(self):
+        '''
+        Put running jobs whose lease expired, i.e. whose worker died, back
+        in the queue. Returns how many.
+        '''
+        with self.lock:
+            # jobs claimed before leases existed expire lease_seconds after they started
+            return self.connection.execute(
+                "UPDATE jobs SET state = 'queued', owner = NULL, lease_expires_at = NULL "
+                "WHERE state = 'running' AND COALESCE(lease_expires_at, started_at + ?) < ?",
+                (self.lease_seconds, time.time())).rowcount
+
+    def counts(self):
+        with self.lock:
+            return dict(self.connection.execute(
+                "SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class WorkerStats:
+    '''
+    Counts and latencies of the jobs a worker ran: how long they waited in
+    the queue and how long they took.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.succeeded = 0
+        self.failed = 0
+        self.running = 0
+        self.last_finished_at = None
+        self.wait_times = deque(maxlen=LATENCY_WINDOW)
+        self.run_times = deque(maxlen=LATENCY_WINDOW)
+
+    def job_started(self, enqueued_at: float):
+        with self.lock:
+            self.running += 1
+            self.wait_times.append(time.time() - enqueued_at)
+
+    def job_finished(self, duration: float, success: bool):
+        with self.lock:
+            self.running -= 1
+            self.run_times.append(duration)
+            self.last_finished_at = time.time()
+            if success:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+
+    def to_dict(self):
+        with self.lock:
+            wait_times, run_times = list(self.wait_times), list(self.run_times)
+            return {
+                'uptime': time.time() - self.started_at,
+                'succeeded': self.succeeded,
+                'failed': self.failed,
+                'running': self.running,
+                'last_finished_at': self.last_finished_at,
+                'wait_p50': percentile(wait_times, 50),
+                'wait_p95': percentile(wait_times, 95),
+                'run_p50': percentile(run_times, 50),
+                'run_p95': percentile(run_times, 95),
+                'run_max': max(run_times, default=None),
+            }
+
+
+class Worker:
+    '''
+    Runs jobs from a JobQueue, at most `concurrency` at a time, until `stop`
+    is called.
+    '''
+
+    def __init__(self,
+                 queue: JobQueue,
+                 concurrency: int=1,
+                 poll_interval: float=1.0,
+                 stats_interval: float=60.0,
+                 health_file: str=None):
+        self.queue = queue
+        self.concurrency = max(1, int(concurrency))
+        self.poll_interval = poll_interval
+        self.stats_interval = stats_interval
+        self.health_file = health_file
+        self.stats = WorkerStats()
+        self.stopping = threading.Event()
+        # free job slots, a job is only claimed once there's one
+        self.slots = threading.Semaphore(self.concurrency)
+        # ids of the jobs running here, their leases are renewed
+        self.running = set()
+        self.running_lock = threading.Lock()
+
+    def run_job(self, job: dict):
+        # imported here so `enqueue` doesn't pay for pandas/gspread. The
+        # scrapers share their Google Sheets clients (see
+        # autogroupchat/scrapers/credentialcache.py) and makers between jobs
+        from autogroupchat.scrapers.autoscrapegooglesheets import scrape_using_dict, scrape_batch_using_dict
+
+        # the scrapers overwrite some keys, leave the queued job alone
+        job = dict(job)
+        if job.get('batch'):
+            failed = [r for r in scrape_batch_using_dict(job) if not r['success']]
+        else:
+            failed = [r for r in scrape_using_dict(job) if not r['success']]
+        if failed:
+            raise RuntimeError(f"{len(failed)} groups or rosters failed, see the log")
+
+    def process(self, job_id: int, job: dict, enqueued_at: float):
+        self.stats.job_started(enqueued_at)
+        start = time.perf_counter()
+        error = None
+        try:
+            logger.info(f"Starting job {job_id}.")
+            self.run_job(job)
+        except Exception as e:
+            logger.exception(f"Job {job_id} failed: {e!r}")
+            error = repr(e)
+        finally:
+            duration = time.perf_counter() - start
+            self.stats.job_finished(duration, error is None)
+            self.queue.finish(job_id, error)
+            with self.running_lock:
+                self.running.discard(job_id)
+            self.slots.release()
+            logger.info(f"Finished job {job_id} in {duration:.1f}s.")
+
+    def health(self):
+        health = self.stats.to_dict()
+        health['queue'] = self.queue.counts()
+        health['stopping'] = self.stopping.is_set()
+        return health
+
+    def renew_leases(self):
+        '''
+        Renew the leases of the jobs running here and requeue jobs of
+        workers that died
+        '''
+        with self.running_lock:
+            running = list(self.running)
+        self.queue.renew(running)
+        requeued = self.queue.requeue_expired()
+        if requeued:
+            logger.warning(f"Requeued {requeued} jobs whose worker stopped renewing them.")
+
+    def report(self):
+        from autogroupchat.instrumentation import instrumentation
+
+        # also bounds the spans kept in memory between reports
+        instrumentation.flush()
+        health = self.health()
+        logger.info("worker health = " + json.dumps(health))
+        if self.health_file:
+            # write then swap so readers never see a partial file
+            replace_file(self.health_file, lambda f: json.dump(health, f, indent=4))
+
+    def stop(self, *args):
+        if not self.stopping.is_set():
+            logger.info("Stopping, waiting for running jobs to finish.")
+        self.stopping.set()
+
+    def run(self):
+        from autogroupchat.makers.automakegroupchat import close_makers
+
+        last_report = time.monotonic()
+        last_renewal = None
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="Worker") as executor:
+            while not self.stopping.is_set():
+                if time.monotonic() - last_report >= self.stats_interval:
+                    self.report()
+                    last_report = time.monotonic()
+                if last_renewal is None or \
+                        time.monotonic() - last_renewal >= self.queue.lease_seconds / 3:
+                    self.renew_leases()
+                    last_renewal = time.monotonic()
+
+                if not self.slots.acquire(timeout=self.poll_interval):
+                    continue
+                claimed = None
+                try:
+                    claimed = self.queue.claim()
+                finally:
+                    if claimed is None:
+                        self.slots.release()
+                if claimed is None:
+                    self.stopping.wait(self.poll_interval)
+                    continue
+                with self.running_lock:
+                    self.running.add(claimed[0])
+                executor.submit(self.process, *claimed)
+            # leaving the with block waits for the running jobs, keep
+            # their leases while it does
+            while True:
+                with self.running_lock:
+                    if not self.running:
+                        break
+                self.renew_leases()
+                time.sleep(min(self.poll_interval, self.queue.lease_seconds / 3))
+
+        self.report()
+        close_makers()
+
+
+def run(args):
+    from autogroupchat.instrumentation import configure_from_config
+    configure_from_config(args.metrics)
+
+    queue = JobQueue(args.queue, lease_seconds=args.lease_seconds)
+    worker = Worker(queue,
+                    concurrency=args.concurrency,
+                    poll_interval=args.poll_interval,
+                    stats_interval=args.stats_interval,
+                    health_file=args.health_file)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    try:
+        worker.run()
+    finally:
+        queue.close()
+
+
+def enqueue(args):
+    queue = JobQueue(args.queue)
+    try:
+        for config_file in args.job_configs:
+            with open(config_file) as f:
+                job_id = queue.put(json.load(f))
+            logger.info(f"Queued {config_file} as job {job_id}.")
+    finally:
+        queue.close()
+
+
+def status(args):
+    queue = JobQueue(args.queue)
+    try:
+        print(json.dumps(queue.counts(), indent=4))
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--verbose', '-v', action='store_true')
+    subparsers = parser.add_subparsers()
+
+    run_parser = subparsers.add_parser("run", help="process queued jobs until stopped")
+    run_parser.add_argument("-q", "--queue", default="autogroupchat_jobs.sqlite")
+    run_parser.add_argument("-c", "--concurrency", type=int, default=1,
+                            help="jobs to run at once")
+    run_parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="seconds between looks at an empty queue")
+    run_parser.add_argument("--stats-interval", type=float, default=60.0,
+                            help="seconds between health reports")
+    run_parser.add_argument("--lease-seconds", type=float, default=300,
+                            help="seconds before a job of a worker that died is run again")
+    run_parser.add_argument("--health-file", default=None,
+                            help="write the health report to this JSON file")
+    run_parser.add_argument("--metrics-json", dest="metrics", type=lambda path: {"json_summary": path},
+                            help="write a JSON summary of timings, retries and HTTP statuses "
+                                 "every stats interval")
+    run_parser.set_defaults(func=run)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="queue job config files")
+    enqueue_parser.add_argument("-q", "--queue", default="autogroupchat_jobs.sqlite")
+    enqueue_parser.add_argument("job_configs", nargs="+")
+    enqueue_parser.set_defaults(func=enqueue)
+
+    status_parser = subparsers.add_parser("status", help="print the number of jobs per state")
+    status_parser.add_argument("-q", "--queue", default="autogroupchat_jobs.sqlite")
+    status_parser.set_defaults(func=status)
+
+    args = parser.parse_args()
+
+    log_level = logging.INFO
+    if args.verbose:
+        log_level = logging.DEBUG
+    logging.basicConfig(level=log_level, format=f'[{log_level}] %(message)s')
+    logger = logging.getLogger(__name__)
+
+    #---------------------------------------
+    if hasattr(args, 'func'):
+        args.func(args)
+    else:
+        parser.print_help()
+    #---------------------------------------
+    sys.exit()
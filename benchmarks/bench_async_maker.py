@@ -0,0 +1,98 @@
+'''
+Compare AutoMakeGroupMe on a thread pool against AsyncAutoMakeGroupMe on one
+event loop, setting up many groups concurrently against the in-process
+GroupMe fake (autogroupchat/fakes).
+
+    python benchmarks/bench_async_maker.py --groups 200 --threads 16 --latency 0.05
+'''
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from autogroupchat.fakes.groupme import FakeGroupMe
+from autogroupchat.makers.automakegroupme import AutoMakeGroupMe
+from autogroupchat.makers.asyncautomakegroupme import AsyncAutoMakeGroupMe
+from autogroupchat.makers.automakegroupchat import get_maker, close_makers
+
+
+def write_config(workdir, name):
+    config_file = os.path.join(workdir, f"config_{name}.json")
+    with open(config_file, "w") as f:
+        json.dump({"groupme_token": "fake",
+                   "group_registry_file": os.path.join(workdir, f"registry_{name}.json"),
+                   "http_pool_size": 200,
+                   # measure concurrency, not the client rate limit
+                   "rate_limit": False,
+                   "retry": {"base_delay": 0.05, "poll_interval": 0.05}}, f)
+    return config_file
+
+
+def make_fake(args):
+    return FakeGroupMe(latency=args.latency, latency_jitter=args.latency / 2,
+                       results_delay=args.results_delay, seed=1)
+
+
+def group_args(args, i):
+    members = {f"person {j}": f"+1555{j:07d}" for j in range(args.members)}
+    return (f"Bench {i}", members, {}, ["Welcome"], None, None, True, 30, False)
+
+
+def bench_threads(args, workdir):
+    config_file = write_config(workdir, "threads")
+    fake = make_fake(args)
+    fake.install(get_maker(AutoMakeGroupMe, config_file).client.session)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        futures = [executor.submit(AutoMakeGroupMe.group_startup, AutoMakeGroupMe, config_file,
+                                   *group_args(args, i)) for i in range(args.groups)]
+        for future in futures:
+            future.result()
+    return time.perf_counter() - start, fake
+
+
+def bench_async(args, workdir):
+    config_file = write_config(workdir, "async")
+    fake = make_fake(args)
+    get_maker(AsyncAutoMakeGroupMe, config_file).mount(fake.async_transport())
+
+    async def main():
+        await asyncio.gather(*[AsyncAutoMakeGroupMe.group_startup_async(
+            AsyncAutoMakeGroupMe, config_file, *group_args(args, i)) for i in range(args.groups)])
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    return time.perf_counter() - start, fake
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--members", type=int, default=20, help="members per group")
+    parser.add_argument("--threads", type=int, default=16, help="thread pool size for the sync maker")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per fake API call")
+    parser.add_argument("--results-delay", type=float, default=0.1,
+                        help="seconds before membership results are ready")
+    args = parser.parse_args()
+
+    # groupy logs a traceback for every 503 while polling results
+    logging.getLogger("groupy").setLevel(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, bench in (("threads", bench_threads), ("asyncio", bench_async)):
+            elapsed, fake = bench(args, workdir)
+            print(f"{name:<8} {args.groups} groups in {elapsed:6.2f}s, "
+                  f"{args.groups / elapsed * 60:8.1f} groups/min, "
+                  f"{fake.total_calls / args.groups:.1f} calls/group")
+        close_makers()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+'''
+Compare AutoScrapeGoogleSheets with and without `attendance_matrix` on a
+synthetic sheet served by the in-process Google Sheets fake
+(autogroupchat/fakes): the memory still held once the groups are parsed
+(by the scraper and the snapshot cache), the time to parse a cold and an
+unchanged (warm) sheet, and the time to select the members of every date
+column.
+
+    python benchmarks/bench_attendance.py --dates 365 --rows 50000
+'''
+import gc
+import sys
+import time
+import os.path
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bench_process_df import make_df
+from autogroupchat.fakes.googlesheets import FakeGoogleSheets
+from autogroupchat.scrapers.autoscrapegooglesheets import AutoScrapeGoogleSheets
+
+
+def scrape(sheets, workdir, attendance_matrix):
+    # the whole sheet is downloaded, as with a range or selective_fetch off
+    asg = AutoScrapeGoogleSheets("Bench", "Sheet1", "", os.path.join(workdir, "config_googleapi.json"),
+                                 gspread_client=sheets.client(), selective_fetch=False,
+                                 snapshot_dir=os.path.join(workdir, str(attendance_matrix)),
+                                 attendance_matrix=attendance_matrix, lazy=True)
+    groups = list(asg.iter_groups())
+    return asg, groups
+
+
+def retained_memory(sheets, workdir, attendance_matrix):
+    # what the scraper and the snapshot cache hold on to after parsing
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    asg, groups = scrape(sheets, workdir, attendance_matrix)
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return retained - before, peak - before, groups
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def select_members(asg):
+    # members of every date column, not just today's
+    if asg.attendance is not None:
+        matrix = asg.attendance
+        return [asg.contacts.members(matrix.rows(i)) for i in range(len(matrix))]
+    df = asg.df
+    members = []
+    for col in df.columns[4:]:
+        marks = df[col].iloc[2:]
+        members.append(asg.contacts.members(marks.index[marks.fillna('').astype(bool)]))
+    return members
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dates", type=int, default=365)
+    parser.add_argument("--rows", type=int, default=20000)
+    args = parser.parse_args()
+
+    sheets = FakeGoogleSheets()
+    sheets.add_spreadsheet("Bench", {"Sheet1": make_df(args.dates, args.rows).values.tolist()})
+
+    print(f"sheet: {args.dates} date columns x {args.rows} rows")
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, attendance_matrix in (("DataFrame", False), ("matrix", True)):
+            retained, peak, groups = retained_memory(sheets, workdir, attendance_matrix)
+            # the first scrape above filled the snapshot cache, time a cold
+            # one in a fresh directory and then a warm one
+            cold_time, _ = timed(lambda: scrape(sheets, os.path.join(workdir, "cold"), attendance_matrix))
+            warm_time, (asg, warm_groups) = timed(lambda: scrape(sheets, workdir, attendance_matrix))
+            assert warm_groups == groups, "warm scrape disagrees"
+            select_time, members = timed(lambda: select_members(asg))
+            results[name] = groups, members
+            print(f"{name:<10} retained {retained / 2**20:8.1f} MiB  peak {peak / 2**20:8.1f} MiB  "
+                  f"cold {cold_time * 1000:8.1f} ms  warm {warm_time * 1000:8.1f} ms  "
+                  f"members of every date {select_time * 1000:8.1f} ms")
+    assert results["DataFrame"] == results["matrix"], "paths disagree"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+'''
+End-to-end benchmark of scraping a sheet and creating its groups against the
+in-process GroupMe and Google Sheets fakes (autogroupchat/fakes), so no real
+API is called.
+
+Reports groups/minute, API calls per group and p50/p99 latency of each
+group_startup step for synthetic rosters of several sizes.
+
+    python benchmarks/bench_end_to_end.py --roster-sizes 10 100 500 --groups 10 --latency 0.02
+'''
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import tempfile
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from autogroupchat.fakes.groupme import FakeGroupMe
+from autogroupchat.fakes.googlesheets import FakeGoogleSheets
+from autogroupchat.makers.automakegroupme import AutoMakeGroupMe
+from autogroupchat.makers.automakegroupchat import get_maker, close_makers
+from autogroupchat.scrapers.autoscrapegooglesheets import AutoScrapeGoogleSheets
+
+STEPS = ["create_group", "add_members_group", "change_group_owner",
+         "send_message_to_group", "purge_groups"]
+
+
+class TimedAutoMakeGroupMe(AutoMakeGroupMe):
+    # step name -> list of durations in seconds, shared by every instance
+    step_times = defaultdict(list)
+    # perf_counter() at the end of each step, for time to first group
+    step_ends = defaultdict(list)
+
+    @classmethod
+    def timed(cls, name):
+        method = getattr(AutoMakeGroupMe, name)
+
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                cls.step_times[name].append(end - start)
+                cls.step_ends[name].append(end)
+        return wrapper
+
+
+for _step in STEPS:
+    setattr(TimedAutoMakeGroupMe, _step, TimedAutoMakeGroupMe.timed(_step))
+
+
+def make_sheet(roster_size, num_groups, past_dates=30):
+    '''
+    One key/value block, one roster, `past_dates` old date columns and
+    `num_groups` columns due today.
+    '''
+    today = datetime.date.today()
+    header = ["key", "value", "name", "phone"]
+    header += [(today - datetime.timedelta(days=d + 1)).strftime('%m/%d/%Y') for d in range(past_dates)]
+    header += [today.strftime('%m/%d/%Y')] * num_groups
+    rows = [header,
+            ["group_name", "Bench {date} {time}", "", ""] + [""] * past_dates + [f"{h}:00" for h in range(num_groups)],
+            ["admin", "", "", ""],
+            ["startup_messages", "Welcome to {group_name}", "", ""]]
+    for i in range(1, roster_size + 1):
+        row = ["", "", f"person {i}", f"+1555{i:07d}"]
+        row += ["x" if (i + d) % 2 else "" for d in range(past_dates + num_groups)]
+        if i < len(rows):
+            rows[i][2:4] = row[2:4]
+            rows[i] += row[4:]
+        else:
+            rows.append(row)
+    return rows
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run(roster_size, num_groups, args, workdir):
+    config_file = os.path.join(workdir, f"config_groupme_{roster_size}.json")
+    config = {"groupme_token": "fake",
+              "group_registry_file": os.path.join(workdir, f"registry_{roster_size}.json"),
+              "retry": {"base_delay": 0.05, "poll_interval": 0.05},
+              # only the fake's limit, unless --client-rate-limit
+              "rate_limit": False}
+    if args.client_rate_limit:
+        config["rate_limit"] = {"rate": args.client_rate_limit, "burst": args.client_rate_limit}
+    with open(config_file, "w") as f:
+        json.dump(config, f)
+
+    groupme = FakeGroupMe(latency=args.latency, latency_jitter=args.latency / 2,
+                          rate_limit=args.rate_limit, failure_rate=args.failure_rate,
+                          results_delay=args.results_delay, seed=1)
+    groupme.install(get_maker(TimedAutoMakeGroupMe, config_file).client.session)
+    sheets = FakeGoogleSheets(latency=args.latency)
+    sheets.add_spreadsheet("Bench", {"Sheet1": make_sheet(roster_size, num_groups, args.past_dates)})
+    TimedAutoMakeGroupMe.step_times.clear()
+    TimedAutoMakeGroupMe.step_ends.clear()
+
+    start = time.perf_counter()
+    asg = AutoScrapeGoogleSheets("Bench", "Sheet1", "", os.path.join(workdir, "config_googleapi.json"),
+                                 gspread_client=sheets.client(), force_refresh=True,
+                                 snapshot_dir=workdir, lazy=True)
+    summary = asg.create_groups(TimedAutoMakeGroupMe, config_file, max_workers=args.max_workers)
+    elapsed = time.perf_counter() - start
+
+    created = sum(1 for g in summary if g["success"])
+    first_group = min(TimedAutoMakeGroupMe.step_ends["create_group"], default=start) - start
+    print(f"roster {roster_size:>5} x {num_groups} groups: {created}/{len(summary)} created in {elapsed:.2f}s, "
+          f"{created / elapsed * 60:.1f} groups/min, "
+          f"first group after {first_group:.2f}s, "
+          f"{groupme.total_calls / max(1, len(summary)):.1f} GroupMe calls/group, "
+          f"{sum(sheets.calls.values())} Sheets calls ({sheets.cells_sent} cells), "
+          f"statuses {dict(groupme.statuses)}")
+    for step in STEPS:
+        times = TimedAutoMakeGroupMe.step_times.get(step, [])
+        if times:
+            print(f"    {step:<24} n={len(times):<4} p50 {percentile(times, 50) * 1000:8.1f} ms"
+                  f"  p99 {percentile(times, 99) * 1000:8.1f} ms")
+    close_makers()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--roster-sizes", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--groups", type=int, default=5, help="groups due today per sheet")
+    parser.add_argument("--past-dates", type=int, default=30, help="date columns already passed per sheet")
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per fake API call")
+    parser.add_argument("--results-delay", type=float, default=0.1,
+                        help="seconds before membership results are ready")
+    parser.add_argument("--rate-limit", type=float, default=None, help="requests per second")
+    parser.add_argument("--client-rate-limit", type=float, default=None,
+                        help="starting requests per second of the maker's own adaptive rate limiter")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    # groupy logs a traceback for every 503 while polling results
+    logging.getLogger("groupy").setLevel(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for roster_size in args.roster_sizes:
+            run(roster_size, args.groups, args, workdir)
+
+
+if __name__ == "__main__":
+    main()
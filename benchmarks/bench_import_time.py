@@ -0,0 +1,95 @@
+'''
+Measure the cold-start import cost of each entry point, and of the first
+call: importing an entry point is cheap because pandas, gspread and the
+maker are imported when a run first needs them, so `first call` times
+everything the first Cloud Function invocation imports before it talks to an
+API. Every measurement runs in a fresh interpreter so nothing is cached
+between them.
+
+    python benchmarks/bench_import_time.py --repeat 5
+'''
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+ENTRY_POINTS = [
+    "google_cloud_main",
+    "autogroupchat.plugins",
+    "autogroupchat.makers.automakegroupme",
+    "autogroupchat.scrapers.autoscrapegooglesheets",
+]
+
+# google_cloud_main, then what scrape_using_dict resolves and imports on its
+# first call: the scraper class, the gspread client and, on a thread while
+# the sheet downloads, pandas and the maker class
+FIRST_CALL = '''
+import google_cloud_main
+from autogroupchat.plugins import get_scraper_class
+from autogroupchat.scrapers.autoscrapegooglesheets import scrape_using_dict, import_maker_class
+get_scraper_class("AutoScrapeGoogleSheets")
+import gspread, google.oauth2.service_account
+import_maker_class("AutoMakeGroupMe")
+'''
+
+
+def import_time(code="pass"):
+    '''
+    Returns (total_us, {package: self_us}) from -X importtime for running
+    `code`. The default measures interpreter startup (site, .pth files) only.
+    '''
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    total = 0
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|")
+        # self times add up per package at any depth
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(self_us)
+        # nested imports are indented further and already included in
+        # their parent's cumulative time
+        if not name.startswith("  "):
+            total += int(cumulative)
+    return total, packages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5,
+                        help="number of most expensive packages to show")
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS)
+    parser.add_argument("--no-first-call", dest="first_call", action="store_false",
+                        help="only time importing the entry points")
+    args = parser.parse_args()
+
+    # imports done by the interpreter itself are the same for every entry point
+    baseline_runs = [import_time() for _ in range(args.repeat)]
+    baseline = min(total for total, _ in baseline_runs)
+    baseline_packages = set().union(*(packages for _, packages in baseline_runs))
+    print(f"interpreter startup imports: min {baseline / 1000:.1f} ms (subtracted below)")
+
+    measurements = [(module, f"import {module}") for module in args.modules]
+    if args.first_call:
+        measurements.append(("first call", FIRST_CALL))
+
+    for name, code in measurements:
+        runs = [import_time(code) for _ in range(args.repeat)]
+        totals = [total - baseline for total, _ in runs]
+        packages = runs[totals.index(sorted(totals)[len(totals) // 2])][1]
+        packages = {k: v for k, v in packages.items() if k not in baseline_packages}
+        top = sorted(packages.items(), key=lambda item: -item[1])[:args.top]
+        print(f"{name}: median {statistics.median(totals) / 1000:.1f} ms, "
+              f"min {min(totals) / 1000:.1f} ms")
+        for package, us in top:
+            print(f"    {package:<24} {us / 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+'''
+Compare the vectorized AutoScrapeGroup parser against the old column at a
+time one on a synthetic sheet. Both parse the sheet and build the metadata
+of every group due today. The old path runs the original cell by cell code
+for each step (header, key/value info, contacts, members).
+
+    python benchmarks/bench_process_df.py --dates 500 --rows 5000
+'''
+import sys
+import json
+import time
+import os.path
+import logging
+import argparse
+import datetime
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from autogroupchat.scrapers.autoscrapegroup import AutoScrapeGroup
+
+logger = logging.getLogger(__name__)
+
+
+def make_df(num_dates, num_rows):
+    today = datetime.date.today()
+    columns = []
+    # key/value block
+    keys = ["key", "group_name", "description"] + [""] * (num_rows - 3)
+    values = ["value", "Session {date} {time}", "benchmark group"] + [""] * (num_rows - 3)
+    columns += [keys, values]
+    # name/phone block
+    columns.append(["name"] + [f"person {i}" for i in range(1, num_rows)])
+    columns.append(["phone"] + [f"+1555{i:07d}" for i in range(1, num_rows)])
+    # date columns, mostly in the past, a few of them today
+    for d in range(num_dates):
+        date = today - datetime.timedelta(days=num_dates - d - 5)
+        column = [date.strftime('%m/%d/%Y'), "7pm"]
+        column += ["x" if (i + d) % 3 == 0 else "" for i in range(2, num_rows)]
+        columns.append(column)
+    return pd.DataFrame(columns).T
+
+
+class BenchScrapeGroup(AutoScrapeGroup):
+    def __init__(self, df):
+        self._df = df
+        super(BenchScrapeGroup, self).__init__("bench", "Sheet1", "", "bench.json")
+
+    def auth(self):
+        pass
+
+    def get_df(self):
+        return self._df
+
+
+class LegacyScrapeGroup(BenchScrapeGroup):
+    '''
+    The old column at a time parser, kept here for comparison
+    '''
+
+    def process_df(self):
+        self.contacts = {}
+        for col in self.df:
+            self.process_column(col)
+
+    def process_column(self, col_num):
+        column = self.df[col_num]
+        if not isinstance(column[0], str):
+            pass
+        elif column[0].lower() == "key":
+            self.info = self.get_keyvalue_info(col_num)
+        elif column[0].lower() == "value":
+            # this is processed with key
+            pass
+        elif column[0].lower() == "name":
+            self.contacts = self.get_contacts(col_num)
+        elif column[0].lower() == "number":
+            # this is processed with name
+            pass
+        else:
+            try:
+                date = datetime.datetime.strptime(column[0], '%m/%d/%Y')
+            except ValueError:
+                return
+
+            # if it is not already passed
+            if date.date() < datetime.date.today():
+                logger.debug(
+                    f"Column for date {date} is already passed, not creating group.")
+            # if it is scheduled for today
+            elif (date.date() - datetime.date.today()) < datetime.timedelta(days=1):
+                logger.info(
+                    f"Column for date {date} is today, creating group.")
+                self.groups_to_create.append(column)
+            else:
+                logger.debug(
+                    f"Column for date {date} is not today, waiting on creating group.")
+
+    def get_keyvalue_info(self, col_num):
+        assert self.df[col_num][0].lower() == "key" and \
+            self.df[col_num + 1][0].lower() == "value"
+
+        info = {}
+        keys = self.df[col_num]
+        values = self.df[col_num + 1]
+        last_key = ""
+        # iterate to longer of keys or values
+        for i in range(1, max(len(keys), len(values))):
+            # if last_key is set, but current key is not,
+            # then values should be set as a dictionary
+            if last_key and not keys[i] and values[i]:
+                if isinstance(info[last_key], list):
+                    # append new value to the list if already a list
+                    info[last_key].append(values[i])
+                else:
+                    # convert to list if not alredy a list
+                    info[last_key] = [info[last_key], values[i]]
+            if keys[i] and values[i]:
+                last_key = keys[i] # set last_key for keys that should have lists of values
+                info[keys[i]] = values[i]
+        logger.info("info = " + json.dumps(info, indent=4))
+        return info
+
+    def get_contacts(self, col_num):
+        assert self.df[col_num][0].lower() == "name" and \
+            self.df[col_num + 1][0].lower() == "phone"
+
+        contacts = {}
+        names = self.df[col_num]
+        phones = self.df[col_num + 1]
+        for i in range(1, len(names)):
+            if names[i] and phones[i]:
+                contacts[i] = {names[i]: phones[i]}
+        logger.info("contacts = " + json.dumps(contacts, indent=4))
+        return contacts
+
+    def get_group_metadata(self, group):
+        group_metadata = self.info.copy()
+        date = group[0]
+        group_metadata['date'] = date if date else ''
+        time = group[1]
+        group_metadata['time'] = time if time else ''
+        group_metadata['group_name_unformatted'] = group_metadata['group_name']
+        group_metadata['group_name'] = group_metadata['group_name'].format(
+            date=group_metadata['date'], time=group_metadata['time'])
+        # if date or time were empty, replace double space with single.
+        group_metadata['group_name'] = group_metadata['group_name'].replace('  ', ' ')
+        # if only one startup message, convert it to a list from a string
+        startup_messages_list = group_metadata.get('startup_messages', [])
+        if isinstance(startup_messages_list, str):
+            startup_messages_list = [startup_messages_list]
+        group_metadata['startup_messages'] = [i.format(**group_metadata)
+                                              for i in startup_messages_list]
+
+        members = {}
+        # ignore the first two lines, they hold date and time respectively
+        for row in range(2, len(group)):
+            # if cell isn't empty, it's a mark that the person is included
+            if group[row]:
+                member = self.contacts.get(row, {})  # defaults to empty so update doesnt fail
+                # member is a dictionary, and we want to add it to members
+                # so we use the update method to add/update.
+                members.update(member)
+
+        group_metadata['members'] = members
+        return group_metadata
+
+
+def bench(df, legacy, repeat):
+    scraper_class = LegacyScrapeGroup if legacy else BenchScrapeGroup
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        asg = scraper_class(df)
+        metadata = [asg.get_group_metadata(g) for g in asg.groups_to_create]
+        best = min(best, time.perf_counter() - start)
+    return best, metadata
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dates", type=int, default=365)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_df(args.dates, args.rows)
+    legacy_time, legacy_metadata = bench(df, True, args.repeat)
+    vector_time, vector_metadata = bench(df, False, args.repeat)
+    assert legacy_metadata == vector_metadata, "parsers disagree"
+
+    print(f"sheet: {args.dates} date columns x {args.rows} rows, "
+          f"{len(vector_metadata)} groups due today")
+    print(f"column at a time: {legacy_time * 1000:9.1f} ms")
+    print(f"vectorized:       {vector_time * 1000:9.1f} ms "
+          f"({legacy_time / vector_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+'''
+Check how many GroupMe requests a group setup costs, against the in-process
+GroupMe fake (autogroupchat/fakes). Exits non-zero if a maker makes more, or
+different, calls than expected, so an extra round trip doesn't slip in
+unnoticed.
+
+    python benchmarks/check_call_counts.py
+
+When a change is meant to alter the calls, update EXPECTED_CALLS.
+'''
+import os
+import sys
+import json
+import asyncio
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from autogroupchat.fakes.groupme import FakeGroupMe
+from autogroupchat.makers.automakegroupme import AutoMakeGroupMe
+from autogroupchat.makers.asyncautomakegroupme import AsyncAutoMakeGroupMe
+from autogroupchat.makers.automakegroupchat import get_maker, close_makers
+
+MEMBERS = {f"person {i}": f"+1555{i:07d}" for i in range(3)}
+ADMIN = {"Admin": "+15559999999"}
+MESSAGES = ["Welcome", "Meet at 7"]
+# already hosted by GroupMe, so no upload
+IMAGE = "https://i.groupme.com/0123456789abcdef"
+DESCRIPTION = "Call count check"
+
+# handler of the fake -> requests, per scenario
+EXPECTED_CALLS = {
+    # create with everything set, rename self, hand the group to the admin,
+    # add the members, post the startup messages (plus the always-sent one)
+    "create": {
+        "create_group": 1,
+        "update_membership": 1,
+        "add_members": 2,
+        "get_results": 2,
+        "change_owners": 1,
+        "create_message": 1 + len(MESSAGES),
+    },
+    # rerun with --reconcile: read the group back, nothing left to do
+    "reconcile": {
+        "get_group": 1,
+        "list_messages": 1,
+    },
+}
+
+
+def write_config(workdir, name):
+    config_file = os.path.join(workdir, f"config_{name}.json")
+    with open(config_file, "w") as f:
+        json.dump({"groupme_token": "fake",
+                   "group_registry_file": os.path.join(workdir, f"registry_{name}.json"),
+                   "image_cache_file": os.path.join(workdir, f"images_{name}.json"),
+                   "retry": {"base_delay": 0.01, "poll_interval": 0.01}}, f)
+    return config_file
+
+
+def group_args(reconcile):
+    return ("Call count", MEMBERS, ADMIN, MESSAGES, IMAGE, DESCRIPTION, True, 30, False, reconcile)
+
+
+def run_sync(workdir):
+    config_file = write_config(workdir, "sync")
+    fake = FakeGroupMe()
+    fake.install(get_maker(AutoMakeGroupMe, config_file).client.session)
+    for scenario in EXPECTED_CALLS:
+        fake.reset_counters()
+        AutoMakeGroupMe.group_startup(AutoMakeGroupMe, config_file,
+                                      *group_args(scenario == "reconcile"))
+        yield scenario, fake
+
+
+def run_async(workdir):
+    config_file = write_config(workdir, "async")
+    fake = FakeGroupMe()
+    get_maker(AsyncAutoMakeGroupMe, config_file).mount(fake.async_transport())
+    for scenario in EXPECTED_CALLS:
+        fake.reset_counters()
+        asyncio.run(AsyncAutoMakeGroupMe.group_startup_async(
+            AsyncAutoMakeGroupMe, config_file, *group_args(scenario == "reconcile")))
+        yield scenario, fake
+
+
+def main():
+    # groupy logs a traceback for every 503 while polling results
+    logging.getLogger("groupy").setLevel(logging.CRITICAL)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, run in (("threads", run_sync), ("asyncio", run_async)):
+            for scenario, fake in run(workdir):
+                calls = {handler: count for handler, count in fake.calls.items() if count}
+                expected = EXPECTED_CALLS[scenario]
+                ok = calls == expected
+                failed = failed or not ok
+                print(f"{name:<8} {scenario:<10} {sum(calls.values()):3d} calls "
+                      f"{'ok' if ok else 'MISMATCH'}")
+                if not ok:
+                    for handler in sorted(set(calls) | set(expected)):
+                        if calls.get(handler, 0) != expected.get(handler, 0):
+                            print(f"    {handler}: {calls.get(handler, 0)}, "
+                                  f"expected {expected.get(handler, 0)}")
+        close_makers()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
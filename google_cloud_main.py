@@ -2,7 +2,10 @@ import json
 import base64
 import logging
 
-from autogroupchat.scrapers.autoscrapegooglesheets import scrape_using_dict
+# cheap to import, pandas, gspread and the maker are only imported once a
+# run needs them (see autogroupchat/scrapers/autoscrapegooglesheets.py)
+from autogroupchat.instrumentation import instrumentation, configure_from_config
+from autogroupchat.scrapers.autoscrapegooglesheets import scrape_using_dict, scrape_batch_using_dict
 
 global logger
 
@@ -29,7 +32,16 @@ def autogroupchat_pubsub(event, context):
     logging.basicConfig(level=log_level, format=f'[{log_level}] %(message)s')
     logger = logging.getLogger(__name__)
 
-    scrape_using_dict(config)
+    # optional `metrics` block, see autogroupchat/instrumentation.py
+    configure_from_config(config.get('metrics'))
+    try:
+        # a `batch` list in the config scrapes several rosters in one run
+        if config.get('batch'):
+            scrape_batch_using_dict(config)
+        else:
+            scrape_using_dict(config)
+    finally:
+        instrumentation.flush()
 
 
 if __name__ == "__main__":
@@ -18,6 +18,20 @@ setup(
     long_description=LONG_DESCRIPTION,
     packages=find_packages(),
     install_requires=requirements,
+    extras_require={
+        # AsyncAutoMakeGroupMe
+        'async': ['httpx'],
+    },
+    # makers/scrapers are looked up by name through these, see autogroupchat/plugins.py
+    entry_points={
+        'autogroupchat.makers': [
+            'AutoMakeGroupMe = autogroupchat.makers.automakegroupme:AutoMakeGroupMe',
+            'AsyncAutoMakeGroupMe = autogroupchat.makers.asyncautomakegroupme:AsyncAutoMakeGroupMe',
+        ],
+        'autogroupchat.scrapers': [
+            'AutoScrapeGoogleSheets = autogroupchat.scrapers.autoscrapegooglesheets:AutoScrapeGoogleSheets',
+        ],
+    },
 
     keywords=['GroupMe', 'Google Sheets',
               "Group Chat", "Messaging", "Automation"],